@@ -0,0 +1,174 @@
+import json
+import argparse
+import numpy as np
+from results_store import read_results
+
+# 每次 bootstrap 向量化处理的 (重采样次数 x 条目数) 上限，控制内存
+BOOTSTRAP_BLOCK_ELEMENTS = 1 << 24
+
+
+def load_runs(paths):
+    """读取并拼接多个结果文件 (例如同一次 sweep 的 drone / walk / egovid)"""
+    runs = [read_results(path) for path in paths]
+    return {name: np.concatenate([run[name] for run in runs]) for name in runs[0]}
+
+
+def group_index(columns, group_by):
+    """按一个或多个列分组，返回 (组名数组, 每行的组下标)"""
+    n = len(columns["test_id"])
+    if not group_by:
+        return np.array(["all"]), np.zeros(n, dtype=np.int64)
+    keys = columns[group_by[0]]
+    for name in group_by[1:]:
+        keys = np.char.add(np.char.add(keys, " | "), columns[name])
+    labels, inverse = np.unique(keys, return_inverse=True)
+    return labels, inverse.reshape(-1)
+
+
+def bootstrap_means(values, groups, n_groups, n_boot, seed=0):
+    """
+    各组均值的 Poisson bootstrap：每次重采样给每个条目一个 Poisson(1) 权重，
+    用 bincount 一次算出所有组的加权均值，返回 (n_boot, n_groups) 矩阵。
+    """
+    rng = np.random.default_rng(seed)
+    n = len(values)
+    block = max(1, min(n_boot, BOOTSTRAP_BLOCK_ELEMENTS // max(n, 1)))
+    means = []
+    for start in range(0, n_boot, block):
+        b = min(block, n_boot - start)
+        weights = rng.poisson(1.0, size=(b, n)).astype(np.float64)
+        # 第 i 次重采样的第 g 组映射到 i * n_groups + g，一次 bincount 覆盖整个块
+        flat = (np.arange(b)[:, None] * n_groups + groups[None, :]).ravel()
+        sums = np.bincount(flat, weights=(weights * values[None, :]).ravel(), minlength=b * n_groups)
+        counts = np.bincount(flat, weights=weights.ravel(), minlength=b * n_groups)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means.append((sums / counts).reshape(b, n_groups))
+    return np.concatenate(means) if means else np.empty((0, n_groups))
+
+
+def grouped_stats(values, groups, labels, n_boot, ci, seed=0):
+    """values 中的 NaN 视为无分数：计入 n 但不参与均值"""
+    n_groups = len(labels)
+    valid = ~np.isnan(values)
+    total = np.bincount(groups, minlength=n_groups)
+    count = np.bincount(groups[valid], minlength=n_groups)
+    sums = np.bincount(groups[valid], weights=values[valid], minlength=n_groups)
+    sumsq = np.bincount(groups[valid], weights=values[valid] ** 2, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / count
+        std = np.sqrt(np.maximum(sumsq / count - mean ** 2, 0.0))
+
+    low = high = np.full(n_groups, np.nan)
+    if n_boot and valid.any():
+        boot = bootstrap_means(values[valid], groups[valid], n_groups, n_boot, seed)
+        alpha = (1.0 - ci) / 2.0
+        with np.errstate(invalid="ignore"):
+            low, high = np.nanpercentile(boot, [100 * alpha, 100 * (1 - alpha)], axis=0)
+
+    return [{"group": str(labels[g]), "n": int(total[g]), "scored": int(count[g]),
+             "mean": _round(mean[g]), "std": _round(std[g]),
+             "ci_low": _round(low[g]), "ci_high": _round(high[g])}
+            for g in range(n_groups)]
+
+
+def _round(value, digits=4):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def summarize(columns, group_by, n_boot, ci):
+    labels, groups = group_index(columns, group_by)
+    rows = grouped_stats(columns["score"], groups, labels, n_boot, ci)
+    failed = np.bincount(groups, weights=(columns["status"] != "ok").astype(np.float64), minlength=len(labels))
+    for row, n_failed in zip(rows, failed):
+        row["unscored_rate"] = round(float(n_failed) / row["n"], 4) if row["n"] else None
+    return rows
+
+
+def diff_runs(base, new, group_by, n_boot, ci):
+    """按 test_id 对齐两次运行，统计 new - base 的分数差 (分组按 base 的列)"""
+    _, base_idx, new_idx = np.intersect1d(base["test_id"], new["test_id"], assume_unique=False,
+                                          return_indices=True)
+    aligned = {name: col[base_idx] for name, col in base.items()}
+    delta = new["score"][new_idx] - aligned["score"]
+
+    labels, groups = group_index(aligned, group_by)
+    rows = grouped_stats(delta, groups, labels, n_boot, ci)
+    n_groups = len(labels)
+    valid = ~np.isnan(delta)
+    for name, mask in (("up", valid & (delta > 0)), ("down", valid & (delta < 0))):
+        counts = np.bincount(groups[mask], minlength=n_groups)
+        for row, c in zip(rows, counts):
+            row[name] = int(c)
+    status_changed = np.bincount(groups, weights=(aligned["status"] != new["status"][new_idx]).astype(np.float64),
+                                 minlength=n_groups)
+    for row, c in zip(rows, status_changed):
+        row["status_changed"] = int(c)
+
+    coverage = {
+        "matched": int(len(base_idx)),
+        "only_base": int(len(base["test_id"]) - len(base_idx)),
+        "only_new": int(len(new["test_id"]) - len(new_idx)),
+    }
+    return rows, coverage
+
+
+def print_table(rows, columns):
+    widths = {c: max([len(c)] + [len(_fmt(r.get(c))) for r in rows]) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for r in rows:
+        print("  ".join(_fmt(r.get(c)).ljust(widths[c]) for c in columns))
+
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grouped score statistics over judge results")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def common(p):
+        p.add_argument("--group_by", nargs='*', default=["category"],
+                       choices=["mode", "category", "prompt_key", "original_id", "tier", "status"],
+                       help="Columns to group by (none = overall)")
+        p.add_argument("--bootstrap", type=int, default=1000, help="Bootstrap resamples for the CI (0 = off)")
+        p.add_argument("--ci", type=float, default=0.95)
+        p.add_argument("--output_json", default=None)
+
+    p_summary = sub.add_parser("summary", help="Mean / std / bootstrap CI per group")
+    p_summary.add_argument("results", nargs='+',
+                           help="Result files (.npz / .parquet / _judged_direct.json(l)); concatenated")
+    common(p_summary)
+
+    p_diff = sub.add_parser("diff", help="Per-group score change between two runs, matched on test_id")
+    p_diff.add_argument("--base", nargs='+', required=True)
+    p_diff.add_argument("--new", nargs='+', required=True)
+    common(p_diff)
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        columns = load_runs(args.results)
+        rows = summarize(columns, args.group_by, args.bootstrap, args.ci)
+        print(f"📊 {len(columns['test_id'])} items, grouped by {', '.join(args.group_by) or 'all'}")
+        print_table(rows, ["group", "n", "scored", "mean", "std", "ci_low", "ci_high", "unscored_rate"])
+        report = {"groups": rows}
+    else:
+        rows, coverage = diff_runs(load_runs(args.base), load_runs(args.new), args.group_by,
+                                   args.bootstrap, args.ci)
+        print(f"📊 Score change (new - base): {coverage['matched']} matched items, "
+              f"{coverage['only_base']} only in base, {coverage['only_new']} only in new")
+        print_table(rows, ["group", "n", "scored", "mean", "ci_low", "ci_high", "up", "down", "status_changed"])
+        report = {"coverage": coverage, "groups": rows}
+
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
+        print(f"💾 Saved report to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
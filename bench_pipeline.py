@@ -0,0 +1,483 @@
+"""
+离线 benchmark：不需要 GPU 和模型，测量 build -> judge 流水线中 CPU 侧各阶段的耗时、吞吐与峰值内存。
+
+- 生成合成的 drone / walk / egovid 元数据和 JPEG 目录树 (规模可配置)
+- 用确定性的 FakeEngine 替代 vllm.LLM，按每个 decode step 的延迟模拟生成耗时；
+  评测直接调用 vlm_judge.judge_streaming / judge_in_memory，提示词生成直接调用 test_prompt_vllm.run_mode，
+  FakeEngine 作为它们的推理后端 (图片同样按 --max_pixels 缩放)
+- 分阶段报告：source load、existence check、image decode、prompt build、generation、
+  extract_json 解析、结果写出
+
+用法示例：
+    python bench_pipeline.py --mode drone --items 500 --mods 4 --report_json bench.json
+    python bench_pipeline.py --scenario prompt_gen --mode walk --items 500
+"""
+import os
+import io
+import re
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import resource
+from functools import partial
+from contextlib import contextmanager
+
+from PIL import Image
+
+import build
+import vlm_judge
+import test_prompt_vllm
+from image_prefetch import prefetch, load_rgb
+from image_cache import ImageCache, resize_to_budget
+from llm_backends import GenerationResult, per_request
+from prompt_builder import PromptBuilder
+from run_metrics import RunMetrics
+from token_budget import TokenBudget
+
+
+# ===================== 合成数据 =====================
+
+def make_jpegs(count, size, seed=0):
+    """生成 count 张不同内容的 JPEG (bytes)，写文件时循环复用"""
+    width, height = size
+    blobs = []
+    for i in range(count):
+        img = Image.new("RGB", (width, height), ((seed + i * 37) % 256, (i * 91) % 256, (i * 53) % 256))
+        # 加一些结构，避免 JPEG 压缩得过小、解码成本失真
+        for x in range(0, width, max(1, width // 16)):
+            img.paste(((i * 13 + x) % 256, 128, 255 - (x % 256)), (x, 0, min(width, x + 8), height))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        blobs.append(buf.getvalue())
+    return blobs
+
+
+def generate_dataset(root, mode, items, mods, missing, size, distinct_images):
+    """在 root 下生成源 JSON 与图片目录树，返回 (源 JSON 路径, 生成帧数量)"""
+    blobs = make_jpegs(distinct_images, size)
+    first_dir = os.path.join(root, "first_frames")
+    last_root = os.path.join(root, "results", mode, "generated_frames")
+    os.makedirs(first_dir, exist_ok=True)
+
+    def write(path, n):
+        with open(path, 'wb') as f:
+            f.write(blobs[n % len(blobs)])
+
+    source = []
+    n_files = 0
+    for i in range(items):
+        item_id = f"{mode}_{i:06d}"
+        first_path = os.path.join(first_dir, f"{item_id}.jpg")
+        write(first_path, i)
+        entry = {"id": item_id, "first_frame_path": first_path, "instruction": f"synthetic instruction {i}"}
+
+        if mode in ['drone', 'walk']:
+            last_dir = os.path.join(last_root, item_id)
+            os.makedirs(last_dir, exist_ok=True)
+            entry["last_frame_path"] = last_dir
+            for k in range(1, mods + 1):
+                key = f"SC4_MOD_{k}"
+                entry[key] = f"The person in frame {i} walks towards the camera, variant {k}."
+                # 确定性地缺失一部分文件，覆盖 missing 分支
+                if _fraction(f"{item_id}/{key}") >= missing:
+                    write(os.path.join(last_dir, f"{key}.jpg"), i + k)
+                    n_files += 1
+        else:
+            last_dir = os.path.join(last_root, f"{i // 1000:03d}")
+            os.makedirs(last_dir, exist_ok=True)
+            last_path = os.path.join(last_dir, f"{item_id}.jpg")
+            entry["last_frame_path"] = last_path
+            entry["lf_prompt_v4_minimal"] = f"Place object {i} on the table. Background unchanged."
+            if _fraction(item_id) >= missing:
+                write(last_path, i + 1)
+                n_files += 1
+        source.append(entry)
+
+    source_json = os.path.join(root, f"{mode}.json")
+    with open(source_json, 'w', encoding='utf-8') as f:
+        json.dump(source, f, ensure_ascii=False)
+    return source_json, n_files
+
+
+def _fraction(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+
+
+# ===================== Fake Engine =====================
+
+# SC 批量模板的开头 "Task: Generate 3 distinct ..." / "Task: Write 5 ..."
+MOD_COUNT_PATTERN = re.compile(r"Task: \w+ (\d+)")
+
+
+class FakeEngine:
+    """
+    确定性假引擎，实现与 llm_backends 相同的 generate(requests, sampling) 接口，
+    直接作为 vlm_judge / test_prompt_vllm 的推理后端使用。
+
+    提示词与 VLLMBackend 一样经 PromptBuilder 渲染 (计入 prompt_build)；提示词 token 数按 budget
+    (与评测相同的像素预算) 从图片尺寸估计。一个批次的耗时 = 输出 token 数 × 每个 decode step 的延迟
+    (批内并行 decode)。评测请求返回 {"reasoning", "score"}，分数由请求文本的 hash 决定；
+    SC 批量模板返回 MOD_1..MOD_n，egovid 返回一句编辑指令。messy_fraction 比例的输出带 markdown 包裹
+    或前后缀，用来覆盖 extract_json 的回退分支。
+    """
+
+    def __init__(self, token_latency_ms=0.5, output_tokens=200, messy_fraction=0.2, budget=None, timer=None):
+        self.token_latency = token_latency_ms / 1000.0
+        self.output_tokens = output_tokens
+        self.messy_fraction = messy_fraction
+        self.budget = budget
+        self.timer = timer or StageTimer()
+        self.render = PromptBuilder(vlm_judge.render_judge_prompt)
+
+    def respond(self, text, max_tokens):
+        digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+        filler = " ".join(["token"] * max(1, max_tokens - 10))
+        match = MOD_COUNT_PATTERN.search(text)
+        if match:
+            body = json.dumps({f"MOD_{k}": f"Variant {k}: {filler}" for k in range(1, int(match.group(1)) + 1)})
+        elif "[Edit Command]" in text:
+            return f"Edit {digest[:8]}: {filler}"
+        else:
+            body = json.dumps({"reasoning": filler, "score": int(digest[:4], 16) % 11})
+        if _fraction(digest) < self.messy_fraction:
+            body = f"Here is my evaluation:\n```json\n{body}\n```"
+        return body
+
+    def generate(self, requests, sampling):
+        with self.timer.measure("prompt_build", len(requests)):
+            prompts = [self.render(messages) for messages in requests]
+
+        with self.timer.measure("generation", len(requests)):
+            results = []
+            for messages, prompt, params in zip(requests, prompts, per_request(sampling, len(requests))):
+                max_tokens = min(self.output_tokens, params.get("max_tokens", self.output_tokens))
+                text = "".join(part["text"] for msg in messages for part in msg["content"] if part["type"] == "text")
+                prompt_tokens = self.budget.request_tokens(messages) if self.budget else len(prompt)
+                results.append(GenerationResult(text=self.respond(text, max_tokens), prompt_tokens=prompt_tokens,
+                                                output_tokens=max_tokens, finish_reason="stop"))
+            time.sleep(max((r.output_tokens for r in results), default=0) * self.token_latency)
+        return results
+
+
+# ===================== 计时与内存 =====================
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # 非 Linux：退化为进程迄今为止的峰值
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTimer:
+    """累计每个阶段的耗时与处理条数，并在阶段运行期间采样峰值 RSS"""
+
+    def __init__(self, sample_interval=0.01):
+        self.stages = {}
+        self.sample_interval = sample_interval
+
+    def measure(self, name, count=0):
+        return _Stage(self, name, count)
+
+    def record(self, name, seconds, count, peak_rss=None):
+        """peak_rss 为 None 表示该阶段未单独采样 (例如从 RunMetrics 导入的阶段)"""
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "items": 0, "peak_rss_mb": None})
+        stage["seconds"] += seconds
+        stage["items"] += count
+        if peak_rss is not None:
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"] or 0.0, peak_rss / 1024 ** 2)
+
+    def import_stages(self, stage_seconds, names, counts, peaks=None):
+        """
+        把 RunMetrics 记录的阶段耗时按 names ({RunMetrics 阶段名: 报告阶段名}) 并入报告；
+        peaks 为 SampledMetrics 采到的各阶段峰值 RSS (字节)
+        """
+        peaks = peaks or {}
+        for source, name in names.items():
+            if source in stage_seconds:
+                self.record(name, stage_seconds[source], counts.get(source, 0), peaks.get(source))
+
+    def report(self):
+        rows = []
+        for name, stage in self.stages.items():
+            rate = stage["items"] / stage["seconds"] if stage["seconds"] > 0 else float("inf")
+            rows.append(dict(stage=name, items_per_sec=round(rate, 2), **stage))
+        return rows
+
+
+class _Stage:
+    def __init__(self, timer, name, count):
+        self.timer, self.name, self.count = timer, name, count
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.timer.sample_interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        self.timer.record(self.name, elapsed, self.count, self.peak)
+
+
+class SampledMetrics(RunMetrics):
+    """
+    RunMetrics 的阶段同样采样峰值 RSS：一个后台线程周期采样，计入当时所有进行中的阶段；
+    阶段进出时各补采一次，短阶段也至少有两个样本。只有累计耗时的阶段 (add_stage_time，
+    如 image_decode_wait) 在记录时采样一次。与 StageTimer 一样，RSS 是整个进程的，
+    并发阶段的内存会互相计入。
+    """
+
+    def __init__(self, job, dataset, sample_interval=0.01):
+        super().__init__(job, dataset)
+        self.peak_rss = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._interval = sample_interval
+        self._thread = None
+
+    def _observe(self, names, rss):
+        for name in names:
+            self.peak_rss[name] = max(self.peak_rss.get(name, 0), rss)
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            rss = current_rss()
+            with self._lock:
+                self._observe(list(self._active), rss)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            self._active[name] = self._active.get(name, 0) + 1
+            self._observe([name], current_rss())
+        try:
+            with super().stage(name):
+                yield
+        finally:
+            with self._lock:
+                self._observe([name], current_rss())
+                self._active[name] -= 1
+                if not self._active[name]:
+                    del self._active[name]
+
+    def add_stage_time(self, name, seconds):
+        super().add_stage_time(name, seconds)
+        with self._lock:
+            if name not in self._active:
+                self._observe([name], current_rss())
+
+
+# ===================== 流水线 =====================
+
+def run_pipeline(args, root):
+    timer = StageTimer()
+
+    t0 = time.perf_counter()
+    source_json, n_files = generate_dataset(root, args.mode, args.items, args.mods, args.missing,
+                                            args.image_size, args.distinct_images)
+    print(f"🧪 Synthetic {args.mode} dataset: {args.items} source items, {n_files} generated frames "
+          f"({time.perf_counter() - t0:.1f}s)")
+
+    # --- build.py ---
+    with timer.measure("source_load", args.items):
+        source_map = build.load_source_data(source_json)
+
+    with timer.measure("existence_check", len(source_map)) as stage:
+        stats = {'total_keys': 0, 'missing': 0}
+        if args.mode in ['drone', 'walk']:
+            directories = [item['last_frame_path'] for item in source_map.values()]
+            dir_index = build.build_dir_index(directories, args.workers)
+            testset = list(build.iter_drone_walk(source_map, args.mode, None, dir_index, stats))
+        else:
+            directories = [os.path.dirname(item['last_frame_path']) for item in source_map.values()]
+            dir_index = build.build_dir_index(directories, args.workers)
+            testset = list(build.iter_egovid(source_map, args.mode, None, dir_index, stats))
+        stage.count = len(testset)
+
+    testset_path = os.path.join(root, f"{args.mode}_metadata.json")
+    with timer.measure("testset_write", len(testset)):
+        build.write_testset(testset_path, testset)
+
+    # --- vlm_judge.py：真实的流式 / 一次性评测，FakeEngine 作为推理后端 ---
+    # 与 vlm_judge.py 的 main 相同：像素预算对所有图片生效
+    load_image = lambda path: resize_to_budget(load_rgb(path), args.max_pixels)
+    if args.image_cache:
+        load_image = ImageCache(os.path.join(root, "image_cache"), args.max_pixels).load
+    build_input = partial(vlm_judge.build_judge_input, load_image=load_image)
+
+    sampling = {"temperature": 0.1, "max_tokens": 1024}
+    budget = TokenBudget(args.max_model_len or 7000, sampling["max_tokens"], None, args.max_pixels)
+    engine = FakeEngine(args.token_latency_ms, args.output_tokens, args.messy_fraction, budget, timer)
+    spec = vlm_judge.JudgeSpec(build_input, sampling, vlm_judge.parse_direct_output, budget,
+                               vlm_judge.RetryPolicy(args.failure_retries, None, vlm_judge.DIRECT_OUTPUT_FORMAT))
+
+    output_file = vlm_judge.judged_output_path(testset_path)
+    # --workdir 重复使用时不从上次的 checkpoint 续跑
+    for path in (output_file, output_file + ".ckpt.jsonl"):
+        if os.path.exists(path):
+            os.remove(path)
+    metrics = SampledMetrics("bench", testset_path)
+    with timer.measure("judge_total", len(testset)), metrics:
+        if args.judge_mode == "stream":
+            vlm_judge.judge_streaming(engine, spec, testset_path, output_file, args.window_size,
+                                      num_workers=args.workers, queue_depth=args.prefetch_depth, metrics=metrics)
+        else:
+            vlm_judge.judge_in_memory(engine, spec, testset_path, output_file, num_workers=args.workers,
+                                      metrics=metrics)
+    # 解码在后台线程中进行，image_decode_wait 是主线程等待解码的时间 (与推理重叠后剩余的部分)
+    timer.import_stages(metrics.stage_seconds,
+                        {"image_decode_wait": "image_decode_wait", "image_decode": "image_decode_all",
+                         "parse": "extract_json", "checkpoint_write": "checkpoint_write",
+                         "result_write": "result_write"},
+                        {"image_decode_wait": len(testset), "image_decode": len(testset),
+                         "parse": metrics.parse_ok + metrics.parse_failed, "checkpoint_write": len(testset),
+                         "result_write": len(testset)},
+                        metrics.peak_rss)
+    judged = sum(1 for item in vlm_judge.iter_test_items(output_file)
+                 if vlm_judge.has_score(item.get('eval_direct')))
+
+    # 单独测一次纯解码吞吐 (不与其他阶段重叠)
+    sample = testset[:min(len(testset), args.decode_sample)]
+    with timer.measure("image_decode", len(sample)):
+        list(prefetch([sample], build_input, args.workers, 0))
+
+    return timer, {"testset_items": len(testset), "judged": judged, "parse_failures": metrics.parse_failed,
+                   "failed_items": len(metrics.failures), "recovered": dict(metrics.recovered)}
+
+
+def run_prompt_gen(args, root):
+    """提示词生成：合成源 JSON -> test_prompt_vllm.build_tasks -> run_mode (journal、去重、预取解码)"""
+    timer = StageTimer()
+
+    t0 = time.perf_counter()
+    source_json, _ = generate_dataset(root, args.mode, args.items, args.mods, args.missing,
+                                      args.image_size, args.distinct_images)
+    print(f"🧪 Synthetic {args.mode} dataset: {args.items} source items ({time.perf_counter() - t0:.1f}s)")
+
+    with timer.measure("source_load", args.items):
+        with open(source_json, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # egovid 只为还没有指令的条目生成
+        for item in data:
+            item.pop('lf_prompt_v4_minimal', None)
+
+    with timer.measure("task_build") as stage:
+        tasks = test_prompt_vllm.build_tasks(data, args.mode)
+        stage.count = len(tasks)
+
+    sampling = {"temperature": 0.2, "max_tokens": 1024}
+    budget = TokenBudget(args.max_model_len or 32768, sampling["max_tokens"], None, args.max_pixels)
+    engine = FakeEngine(args.token_latency_ms, args.output_tokens, args.messy_fraction, budget, timer)
+    metrics = SampledMetrics("prompt_gen", source_json)
+    with timer.measure("prompt_gen_total", len(tasks)), metrics:
+        test_prompt_vllm.run_mode(engine, sampling, args.mode, source_json, data, tasks, args.batch_size,
+                                  budget=budget, prefetch_workers=args.workers, prefetch_depth=args.prefetch_depth,
+                                  fingerprint={"model": "fake", "max_pixels": args.max_pixels},
+                                  dedupe=not args.no_dedupe, metrics=metrics)
+    with timer.measure("journal_compact", len(data)):
+        test_prompt_vllm.compact_journal(source_json, data)
+
+    # run_mode 的分阶段耗时写在它的运行报告里
+    with open(os.path.splitext(source_json)[0] + "_prompt_gen.report.json", 'r', encoding='utf-8') as f:
+        report = json.load(f)["summary"]
+    timer.import_stages(report["stage_seconds"],
+                        {"image_decode_wait": "image_decode_wait", "journal_write": "journal_write"},
+                        {"image_decode_wait": report["requests"], "journal_write": len(tasks)},
+                        metrics.peak_rss)
+    generated = report["requests"]
+    return timer, {"tasks": len(tasks), "generated": generated, "deduplicated": len(tasks) - generated,
+                   "parse_failures": report["parse_failures"]}
+
+
+def print_report(rows, summary):
+    print(f"\n{'stage':<20}{'items':>10}{'seconds':>12}{'items/s':>14}{'peak RSS MB':>14}")
+    for row in rows:
+        peak = "-" if row['peak_rss_mb'] is None else f"{row['peak_rss_mb']:.1f}"
+        print(f"{row['stage']:<20}{row['items']:>10}{row['seconds']:>12.3f}"
+              f"{row['items_per_sec']:>14.1f}{peak:>14}")
+    print(f"\n📊 {summary}")
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline CPU-side benchmark for build.py -> vlm_judge.py "
+                                                 "and test_prompt_vllm.py")
+    parser.add_argument("--scenario", choices=["judge", "prompt_gen"], default="judge",
+                        help="judge: build.py + vlm_judge.py; prompt_gen: test_prompt_vllm.py run_mode")
+    parser.add_argument("--mode", choices=['drone', 'walk', 'egovid'], default='drone')
+    parser.add_argument("--items", type=int, default=200, help="Source items to synthesise")
+    parser.add_argument("--mods", type=int, default=4, help="SC4_MOD_k keys per drone/walk item")
+    parser.add_argument("--missing", type=float, default=0.05, help="Fraction of generated frames left missing")
+    parser.add_argument("--image_size", type=parse_size, default=(1280, 720), help="WxH of synthetic frames")
+    parser.add_argument("--distinct_images", type=int, default=16, help="Distinct JPEG contents to cycle through")
+    parser.add_argument("--judge_mode", choices=["stream", "memory"], default="stream",
+                        help="stream: vlm_judge.judge_streaming (--stream); memory: judge_in_memory")
+    parser.add_argument("--window_size", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=50, help="Tasks per generate() call (prompt_gen)")
+    parser.add_argument("--no_dedupe", action="store_true", help="Disable prompt_gen task de-duplication")
+    parser.add_argument("--failure_retries", type=int, default=1, help="Judge re-generation attempts")
+    parser.add_argument("--max_model_len", type=int, default=None,
+                        help="Context length for the token budget (default: 7000 judge / 32768 prompt_gen)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--prefetch_depth", type=int, default=1)
+    parser.add_argument("--image_cache", action="store_true", help="Decode through ImageCache")
+    parser.add_argument("--max_pixels", type=int, default=0, help="Pixel budget per image (default 0 = no cap, as the judge)")
+    parser.add_argument("--token_latency_ms", type=float, default=0.5, help="Fake engine latency per decode step")
+    parser.add_argument("--output_tokens", type=int, default=200, help="Fake engine tokens per output")
+    parser.add_argument("--messy_fraction", type=float, default=0.2, help="Outputs needing extract_json fallbacks")
+    parser.add_argument("--decode_sample", type=int, default=256, help="Items for the standalone decode stage")
+    parser.add_argument("--workdir", default=None, help="Where to generate data (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated workdir")
+    parser.add_argument("--report_json", default=None, help="Write the stage report as JSON")
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix="judge_bench_")
+    os.makedirs(root, exist_ok=True)
+    try:
+        run = run_prompt_gen if args.scenario == "prompt_gen" else run_pipeline
+        timer, summary = run(args, root)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    rows = timer.report()
+    print_report(rows, summary)
+    if args.report_json:
+        config = {k: v for k, v in vars(args).items() if k != "report_json"}
+        with open(args.report_json, 'w', encoding='utf-8') as f:
+            json.dump({"config": config, "summary": summary, "stages": rows}, f, indent=4)
+        print(f"💾 Report saved to: {args.report_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,29 @@ import json
 import argparse
 import re
 import sys
+import hashlib
+import textwrap
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+KEY_PATTERN = re.compile(r'^SC\d+_MOD_\d+$')
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Build Image Editing Testset")
     parser.add_argument("--mode", type=str, required=True, choices=['drone', 'egovid', 'walk'], help="Dataset mode")
     parser.add_argument("--source_json", type=str, required=True, help="Path to original metadata JSON")
     parser.add_argument("--image_dir", type=str, required=True, help="Directory for verification (Egovid) or Ignored")
-    parser.add_argument("--output_path", type=str, required=True, help="Path to save the output testset JSON")
+    parser.add_argument("--output_path", type=str, required=True, help="Path to save the output testset JSON (.jsonl for streaming JSON Lines output)")
     parser.add_argument("--filter_ids", type=str, default=None, help="Optional: Comma separated IDs to filter")
-    return parser.parse_args()
+    parser.add_argument("--workers", type=int, default=16, help="Threads for scanning last_frame directories")
+    parser.add_argument("--incremental", action="store_true", help="Emit a delta testset of items added/changed since the last judged state (consumed by vlm_judge.py --incremental)")
+    parser.add_argument("--manifest", type=str, default=None, help="Manifest of the last judged state (default: <output>_judged_direct.manifest.json)")
+    args = parser.parse_args()
+    if args.incremental and args.filter_ids:
+        # 过滤后的测试集与 manifest 对比会把其余条目全部算作删除
+        parser.error("--filter_ids cannot be combined with --incremental")
+    return args
 
 def load_source_data(json_path):
     print(f"📖 Loading source data from {json_path}...")
@@ -28,136 +41,281 @@ def load_source_data(json_path):
         print(f"❌ Error loading source JSON: {e}")
         sys.exit(1)
 
+def list_dir(directory, with_stats=False):
+    """
+    列出目录下的文件 (一次 scandir，代替逐个文件 stat)，返回 {文件名: (size, mtime_ns)}；
+    with_stats=False 时值为 None。目录不存在时返回空 dict。
+    """
+    entries = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not with_stats:
+                    entries[entry.name] = None
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries[entry.name] = (st.st_size, st.st_mtime_ns)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return entries
+
+def build_dir_index(directories, workers, with_stats=False):
+    """并行扫描所有目录，返回 {目录: {文件名: stat}}；目录统一 normpath"""
+    directories = sorted({os.path.normpath(d) for d in directories})
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(directories, pool.map(partial(list_dir, with_stats=with_stats), directories)))
+
+def _split(full_path):
+    directory, name = os.path.split(os.path.normpath(full_path))
+    return directory or '.', name
+
+def path_exists(dir_index, full_path):
+    directory, name = _split(full_path)
+    return name in dir_index.get(directory, {})
+
+def path_stat(dir_index, full_path):
+    directory, name = _split(full_path)
+    return dir_index.get(directory, {}).get(name)
+
+# ===================== 增量构建 (Manifest) =====================
+# manifest 记录上一次评测完成时各条目的状态，由 vlm_judge.py --incremental 在写出结果后提交；
+# build.py 只读取它并写出 delta 与待提交的 manifest，连续多次构建而不评测时 delta 仍相对已评测状态计算
+
+def delta_paths(output_path):
+    """增量构建的产物：(delta 测试集路径, 待提交的 manifest 路径)"""
+    root, ext = os.path.splitext(output_path)
+    return f"{root}_delta{ext}", f"{root}_delta.manifest.json"
+
+def judged_manifest_path(output_path):
+    """默认 manifest 放在评测结果 (<output>_judged_direct.json) 旁边"""
+    return os.path.splitext(output_path)[0] + "_judged_direct.manifest.json"
+
+def manifest_record(item, dir_index):
+    """manifest 记录：[path, size, mtime_ns, prompt_hash, 首帧 size, 首帧 mtime_ns]，任一字段变化即视为 changed"""
+    size, mtime_ns = path_stat(dir_index, item['last_frame_path']) or (None, None)
+    ref_path = item.get('first_frame_path')
+    ref_size, ref_mtime_ns = (path_stat(dir_index, ref_path) if ref_path else None) or (None, None)
+    prompt_hash = hashlib.sha1((item.get('prompt') or '').encode('utf-8')).hexdigest()[:16]
+    return [item['last_frame_path'], size, mtime_ns, prompt_hash, ref_size, ref_mtime_ns]
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('items', {})
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable manifest {manifest_path}: {e}")
+        return {}
+
+def save_manifest(manifest_path, manifest):
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def write_testset(path, items):
+    if path.endswith(".jsonl"):
+        with open(path, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(items, f, indent=4, ensure_ascii=False)
+
+def write_log(log_path, rows_path, header, delta=None):
+    """
+    按 json.dump(indent=4) 的格式拼出日志：header 中的字段、rows_path 中逐行暂存的 items、可选的 delta。
+    items 从暂存文件逐行读取，不在内存中保留；写完后删除暂存文件
+    """
+    with open(log_path, 'w', encoding='utf-8') as f_log, open(rows_path, 'r', encoding='utf-8') as rows:
+        f_log.write("{\n")
+        for key, value in header.items():
+            f_log.write(f"    {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)},\n")
+        f_log.write('    "items": [')
+        count = 0
+        for line in rows:
+            f_log.write(",\n" if count else "\n")
+            f_log.write(textwrap.indent(json.dumps(json.loads(line), indent=4, ensure_ascii=False), " " * 8))
+            count += 1
+        f_log.write("\n    ]" if count else "]")
+        if delta is not None:
+            f_log.write(',\n    "delta": ' + json.dumps(delta, indent=4, ensure_ascii=False).replace("\n", "\n    "))
+        f_log.write("\n}")
+    os.remove(rows_path)
+
+def iter_drone_walk(source_map, mode, target_ids, dir_index, stats):
+    for original_id, item in source_map.items():
+        if target_ids and original_id not in target_ids:
+            continue
+
+        json_path = item.get('last_frame_path', '')
+        if not json_path: continue
+
+        for key, prompt_text in item.items():
+            if KEY_PATTERN.match(key):
+                stats['total_keys'] += 1
+                full_path = os.path.join(json_path, f"{key}.jpg")
+
+                if path_exists(dir_index, full_path):
+                    yield {
+                        "test_id": f"{original_id}_{key}",
+                        "original_id": original_id,
+                        "prompt": prompt_text,
+                        "prompt_key": key,
+                        "last_frame_path": full_path,
+                        "first_frame_path": item.get('first_frame_path'),
+                        "mode": mode
+                    }
+                else:
+                    stats['missing'] += 1
+                    if stats['missing'] <= 3:
+                        print(f"❌ [Missing] {full_path}")
+
+def iter_egovid(source_map, mode, target_ids, dir_index, stats):
+    for original_id, item in source_map.items():
+        if target_ids and original_id not in target_ids:
+            continue
+        
+        # 1. 获取路径
+        # 根据提供的 metadata，路径直接就在 last_frame_path 字段里
+        relative_path = item.get('last_frame_path')
+        
+        if not relative_path:
+            continue
+            
+        # 2. 验证文件是否存在
+        # 假设 metadata 中的路径是相对于运行目录的 (如 results/exp_unified/...)
+        if path_exists(dir_index, relative_path):
+            # 3. 获取 Prompt (优先取 lf_prompt_v4_minimal)
+            prompt = item.get('lf_prompt_v4_minimal')
+            if not prompt:
+                # 如果 minimal 没有，尝试 fallback 到 instruction 或其他字段
+                prompt = item.get('instruction', '')
+            
+            yield {
+                "test_id": original_id, # Egovid ID 本身就是唯一的
+                "original_id": original_id,
+                "prompt": prompt,
+                "prompt_key": "lf_prompt_v4_minimal",
+                "last_frame_path": relative_path,
+                "first_frame_path": item.get('first_frame_path'),
+                "mode": mode
+            }
+        else:
+            stats['missing'] += 1
+            if stats['missing'] <= 3:
+                print(f"❌ [Missing] JSON path not found on disk: {relative_path}")
+
 def main():
     args = parse_args()
     source_map = load_source_data(args.source_json)
     
-    testset = []
     target_ids = set(args.filter_ids.split(',')) if args.filter_ids else None
     
     print(f"📂 Current Working Directory: {os.getcwd()}")
-    
+
     # ==========================================
-    # 模式 A: Drone / Walk (原有逻辑：正则匹配 key)
+    # 目录索引：每个 last_frame 目录只 scandir 一次
     # ==========================================
+    selected = [item for original_id, item in source_map.items()
+                if not target_ids or original_id in target_ids]
     if args.mode in ['drone', 'walk']:
-        print(f"🚀 Mode [{args.mode}]: Iterating JSON with Regex Matching")
-        
-        total_keys_found = 0
-        files_missing = 0
-        
-        for original_id, item in source_map.items():
-            if target_ids and original_id not in target_ids:
-                continue
-
-            json_path = item.get('last_frame_path', '')
-            if not json_path: continue
-
-            pattern = re.compile(r'^SC\d+_MOD_\d+$')
-
-            for key, prompt_text in item.items():
-                if pattern.match(key):
-                    total_keys_found += 1
-                    full_path = os.path.join(json_path, f"{key}.jpg")
-                    
-                    if os.path.exists(full_path):
-                        testset.append({
-                            "test_id": f"{original_id}_{key}",
-                            "original_id": original_id,
-                            "prompt": prompt_text,
-                            "prompt_key": key,
-                            "last_frame_path": full_path,
-                            "first_frame_path": item.get('first_frame_path'),
-                            "mode": args.mode
-                        })
-                    else:
-                        files_missing += 1
-                        if files_missing <= 3:
-                            print(f"❌ [Missing] {full_path}")
-
-        print(f"   - Total keys processed: {total_keys_found}")
-        print(f"   - Files missing: {files_missing}")
+        directories = [item['last_frame_path'] for item in selected if item.get('last_frame_path')]
+    else:
+        directories = [os.path.dirname(item['last_frame_path']) for item in selected if item.get('last_frame_path')]
+    if args.incremental:
+        # 首帧变化同样需要重新评测
+        directories += [os.path.dirname(item['first_frame_path']) for item in selected if item.get('first_frame_path')]
+    dir_index = build_dir_index(directories, args.workers, with_stats=args.incremental)
+    print(f"🗂️ Indexed {len(dir_index)} directories with {args.workers} workers")
+
+    stats = {'total_keys': 0, 'missing': 0, 'valid': 0}
 
     # ==========================================
+    # 模式 A: Drone / Walk (原有逻辑：正则匹配 key)
     # 模式 B: Egovid (修改后：直接读取 JSON 路径)
     # ==========================================
-    elif args.mode == 'egovid':
+    if args.mode in ['drone', 'walk']:
+        print(f"🚀 Mode [{args.mode}]: Iterating JSON with Regex Matching")
+        items = iter_drone_walk(source_map, args.mode, target_ids, dir_index, stats)
+    else:
         print(f"🚀 Mode [{args.mode}]: Iterating JSON and verifying last_frame_path")
-        
-        files_missing = 0
-        
-        for original_id, item in source_map.items():
-            if target_ids and original_id not in target_ids:
-                continue
-            
-            # 1. 获取路径
-            # 根据提供的 metadata，路径直接就在 last_frame_path 字段里
-            relative_path = item.get('last_frame_path')
-            
-            if not relative_path:
-                continue
-                
-            # 2. 验证文件是否存在
-            # 假设 metadata 中的路径是相对于运行目录的 (如 results/exp_unified/...)
-            if os.path.exists(relative_path):
-                # 3. 获取 Prompt (优先取 lf_prompt_v4_minimal)
-                prompt = item.get('lf_prompt_v4_minimal')
-                if not prompt:
-                    # 如果 minimal 没有，尝试 fallback 到 instruction 或其他字段
-                    prompt = item.get('instruction', '')
-                
-                testset.append({
-                    "test_id": original_id, # Egovid ID 本身就是唯一的
-                    "original_id": original_id,
-                    "prompt": prompt,
-                    "prompt_key": "lf_prompt_v4_minimal",
-                    "last_frame_path": relative_path,
-                    "first_frame_path": item.get('first_frame_path'),
-                    "mode": args.mode
-                })
-            else:
-                files_missing += 1
-                if files_missing <= 3:
-                    print(f"❌ [Missing] JSON path not found on disk: {relative_path}")
-        
-        print(f"   - Files missing: {files_missing}")
+        items = iter_egovid(source_map, args.mode, target_ids, dir_index, stats)
 
     # ==========================================
     # 输出 JSON 文件 (Dataset Output)
+    # .jsonl 输出边生成边写，不在内存中保留完整测试集
     # ==========================================
-    os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
-    with open(args.output_path, 'w', encoding='utf-8') as f:
-        json.dump(testset, f, indent=4, ensure_ascii=False)
+    log_dir = os.path.join("results", "exp_unified", "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    # 增量模式：与上次评测完成时的 manifest 对比，记录新增 / 变化的条目
+    manifest_path = args.manifest or judged_manifest_path(args.output_path)
+    old_manifest = load_manifest(manifest_path) if args.incremental else {}
+    new_manifest = {}
+    delta_items = []
+
+    # 日志条目边构建边逐行写入暂存文件，最后再拼成日志
+    log_path = os.path.join(log_dir, f"{args.mode}.json")
+    log_rows_path = log_path + ".rows.tmp"
+    log_rows = open(log_rows_path, 'w', encoding='utf-8')
+
+    def track(item):
+        log_rows.write(json.dumps({"test_id": item['test_id'], "last_frame_path": item['last_frame_path']},
+                                  ensure_ascii=False) + "\n")
+        stats['valid'] += 1
+        if args.incremental:
+            record = manifest_record(item, dir_index)
+            new_manifest[item['test_id']] = record
+            old_record = old_manifest.get(item['test_id'])
+            if old_record != record:
+                delta_items.append(dict(item, change="added" if old_record is None else "changed"))
+        return item
+
+    os.makedirs(os.path.dirname(args.output_path) or '.', exist_ok=True)
+    if args.output_path.endswith(".jsonl"):
+        write_testset(args.output_path, (track(item) for item in items))
+    else:
+        write_testset(args.output_path, [track(item) for item in items])
+    log_rows.close()
+
+    if args.mode in ['drone', 'walk']:
+        print(f"   - Total keys processed: {stats['total_keys']}")
+    print(f"   - Files missing: {stats['missing']}")
         
-    print(f"✅ JSON Build Complete! Valid items: {len(testset)}")
+    print(f"✅ JSON Build Complete! Valid items: {stats['valid']}")
     print(f"💾 Saved Dataset to: {args.output_path}")
 
+    delta = None
+    if args.incremental:
+        removed = sorted(set(old_manifest) - set(new_manifest))
+        delta_path, pending_path = delta_paths(args.output_path)
+        write_testset(delta_path, delta_items)
+        # manifest 由 vlm_judge.py --incremental 评测完成后提交
+        save_manifest(pending_path, {"mode": args.mode, "manifest_path": manifest_path, "items": new_manifest})
+
+        n_added = sum(1 for item in delta_items if item['change'] == "added")
+        delta = {
+            "delta_path": delta_path,
+            "added": n_added,
+            "changed": len(delta_items) - n_added,
+            "removed": removed
+        }
+        print(f"🔁 Delta: {n_added} added, {delta['changed']} changed, {len(removed)} removed")
+        print(f"💾 Saved Delta to: {delta_path} (pending manifest: {pending_path}, committed by vlm_judge.py --incremental)")
+
     # ==========================================
     # 输出 Log 文件 (JSON 格式)
     # ==========================================
-    log_dir = os.path.join("results", "exp_unified", "logs")
-    os.makedirs(log_dir, exist_ok=True)
-    
-    log_filename = f"{args.mode}.json"
-    log_path = os.path.join(log_dir, log_filename)
-
     print(f"📝 Generating Log file: {log_path} ...")
-    
-    log_data = {
-        "mode": args.mode,
-        "total_count": len(testset),
-        "items": []
-    }
-
-    for item in testset:
-        log_data["items"].append({
-            "test_id": item.get('test_id'),
-            "last_frame_path": item.get('last_frame_path')
-        })
-    
+
     try:
-        with open(log_path, 'w', encoding='utf-8') as f_log:
-            json.dump(log_data, f_log, indent=4, ensure_ascii=False)
+        write_log(log_path, log_rows_path, {"mode": args.mode, "total_count": stats['valid']}, delta)
         print(f"✅ Log Saved to: {log_path}")
     except Exception as e:
         print(f"❌ Error writing log file: {e}")
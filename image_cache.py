@@ -0,0 +1,164 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from image_prefetch import load_rgb
+from token_budget import budget_size
+
+
+def resize_to_budget(img, max_pixels):
+    """等比缩放到不超过 max_pixels 像素；已在预算内则原样返回"""
+    new_size = budget_size(*img.size, max_pixels)
+    if new_size == img.size:
+        return img
+    return img.resize(new_size, Image.BICUBIC)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DigestMemo:
+    """
+    按 (path, size, mtime_ns) 记忆 file_digest 的结果：文件大小和 mtime 未变时不重新读取内容。
+    entries 为 {path: [size, mtime_ns, digest]}，默认只在本次运行内有效；
+    传入从状态文件读出的 dict (如 pipeline.py) 即可跨运行复用。可在多个线程中调用。
+    """
+
+    def __init__(self, entries=None):
+        self.entries = {} if entries is None else entries
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        st = os.stat(path)
+        with self._lock:
+            cached = self.entries.get(path)
+        if cached and cached[:2] == [st.st_size, st.st_mtime_ns]:
+            return cached[2]
+        digest = file_digest(path)
+        with self._lock:
+            self.entries[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+
+class ImageCache:
+    """
+    缩放后图片的磁盘缓存 (内容寻址)。
+
+    key = sha1(文件内容) + 像素预算，value 为缩放后的 RGB 数组 (.npy，读取时 mmap)。
+    同一张参考图在整个数据集中只解码/缩放一次，文件内容变化后 key 随之变化。
+    缓存总大小超过 max_bytes 时按最近访问时间 (LRU) 淘汰。
+    """
+
+    def __init__(self, cache_dir, max_pixels, max_bytes=20 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._digest = DigestMemo()
+        # key -> [size, last_access]
+        self._index = {}
+        self._total_bytes = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in os.listdir(cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            st = os.stat(os.path.join(cache_dir, name))
+            self._index[name[:-4]] = [st.st_size, st.st_mtime]
+            self._total_bytes += st.st_size
+
+    def _key(self, path):
+        return f"{self._digest(path)}_{self.max_pixels}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def load(self, path):
+        """返回缩放到像素预算内的 RGB 图片，优先读缓存"""
+        key = self._key(path)
+        cache_path = self._path(key)
+
+        with self._lock:
+            entry = self._index.get(key)
+        if entry is not None:
+            try:
+                arr = np.load(cache_path, mmap_mode='r')
+                img = Image.fromarray(np.ascontiguousarray(arr))
+                self._touch(key, cache_path)
+                return img
+            except (OSError, ValueError):
+                # 缓存文件被外部删除或损坏，回退到重新解码
+                self._drop(key)
+
+        img = resize_to_budget(load_rgb(path), self.max_pixels)
+        self._store(key, cache_path, np.asarray(img))
+        return img
+
+    def _touch(self, key, cache_path):
+        with self._lock:
+            self.hits += 1
+            if key in self._index:
+                self._index[key][1] = time.time()
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+
+    def _drop(self, key):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self._total_bytes -= entry[0]
+
+    def _store(self, key, cache_path, arr):
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"⚠️ Image cache write failed ({cache_path}): {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        size = os.path.getsize(cache_path)
+        with self._lock:
+            self.misses += 1
+            old = self._index.get(key)
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._index[key] = [size, time.time()]
+            self._total_bytes += size
+            evict = self._select_evictions(keep=key)
+
+        for old_key in evict:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def _select_evictions(self, keep):
+        """在锁内调用：按最近访问时间从旧到新淘汰，直到总大小回到上限以内"""
+        evict = []
+        if self._total_bytes <= self.max_bytes:
+            return evict
+        for old_key, (size, _) in sorted(self._index.items(), key=lambda kv: kv[1][1]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if old_key == keep:
+                continue
+            del self._index[old_key]
+            self._total_bytes -= size
+            evict.append(old_key)
+        return evict
+
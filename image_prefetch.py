@@ -0,0 +1,53 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+def load_rgb(path):
+    """解码并校验图片：convert 会强制完整解码，截断/损坏的 JPEG 在这里直接抛出异常"""
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+
+def _safe_call(load_fn, task):
+    try:
+        return load_fn(task), None
+    except Exception as e:
+        return None, e
+
+
+def prefetch(batches, load_fn, num_workers=4, queue_depth=1):
+    """
+    后台图片预取：当前批次在 llm.generate 中推理时，线程池提前解码后续批次。
+
+    - batches: 可迭代的批次序列 (每个批次是 task 列表)，按需惰性读取
+    - load_fn: task -> 模型输入 (解码好的图片等)，在线程池中执行
+    - queue_depth: 在当前批次之外最多提前解码多少个批次 (决定内存上限)
+
+    按原顺序逐个 yield (batch, results, wait_time)，results 为 [(task, value, error), ...]，
+    单个 task 的解码错误不影响同批次其他 task；wait_time 为主线程等待解码的秒数。
+    """
+    batches = iter(batches)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        def submit_next():
+            batch = next(batches, None)
+            if batch is None:
+                return False
+            pending.append((batch, [pool.submit(_safe_call, load_fn, task) for task in batch]))
+            return True
+
+        for _ in range(max(0, queue_depth) + 1):
+            if not submit_next():
+                break
+
+        while pending:
+            batch, futures = pending.popleft()
+            t0 = time.time()
+            results = [(task,) + future.result() for task, future in zip(batch, futures)]
+            wait_time = time.time() - t0
+            # 先把下一个批次提交给线程池，再把当前批次交给调用方推理
+            submit_next()
+            yield batch, results, wait_time
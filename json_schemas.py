@@ -0,0 +1,48 @@
+# 解码期约束 (guided decoding) 用的 JSON Schema：放进 sampling 的 "json_schema" 字段，
+# 由推理后端转换为 vLLM 的 guided decoding 参数或 HTTP 请求的 response_format。
+# 输出只能是一个符合 schema 的对象，对象闭合后生成立即结束，不会有前言或 markdown 代码块。
+
+# reasoning 的字符上限：保证对象在 max_tokens 之内闭合，避免截断
+REASONING_MAX_CHARS = 1200
+# MOD_n 编辑指令的字符上限
+MOD_MAX_CHARS = 600
+
+
+def judge_schema(max_reasoning_chars=REASONING_MAX_CHARS):
+    """评测输出：{"reasoning": str, "score": 0-10 的整数}"""
+    return {
+        "type": "object",
+        "properties": {
+            "reasoning": {"type": "string", "maxLength": max_reasoning_chars},
+            "score": {"type": "integer", "minimum": 0, "maximum": 10},
+        },
+        "required": ["reasoning", "score"],
+        "additionalProperties": False,
+    }
+
+
+def group_schema(count, max_reasoning_chars=REASONING_MAX_CHARS):
+    """多候选评测输出：{"candidates": [{"id", "reasoning", "score"}, ...]}，恰好 count 个 (每条请求按组内候选数构造)"""
+    candidate = judge_schema(max_reasoning_chars)
+    candidate["properties"] = {"id": {"type": "integer", "minimum": 1, "maximum": count},
+                               **candidate["properties"]}
+    candidate["required"] = ["id"] + candidate["required"]
+    return {
+        "type": "object",
+        "properties": {
+            "candidates": {"type": "array", "items": candidate, "minItems": count, "maxItems": count},
+        },
+        "required": ["candidates"],
+        "additionalProperties": False,
+    }
+
+
+def mod_schema(count, max_chars=MOD_MAX_CHARS):
+    """SC 批量模板的输出：恰好 MOD_1 .. MOD_count 这些字符串字段"""
+    keys = [f"MOD_{i}" for i in range(1, count + 1)]
+    return {
+        "type": "object",
+        "properties": {key: {"type": "string", "maxLength": max_chars} for key in keys},
+        "required": keys,
+        "additionalProperties": False,
+    }
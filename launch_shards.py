@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# 各脚本的合并步骤：全部分片结束后用同样的参数再跑一次
+MERGE_ARGS = {
+    "vlm_judge.py": ["--merge_shards"],
+    "test_prompt_vllm.py": ["--compact"],
+}
+
+
+def visible_gpus():
+    env = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if env:
+        return [g.strip() for g in env.split(",") if g.strip()]
+    try:
+        out = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return [str(i) for i, line in enumerate(out.splitlines()) if line.startswith("GPU ")]
+
+
+def gpu_groups(gpus, gpus_per_replica):
+    """把 GPU 切成互不重叠的组，每组跑一个副本；凑不满一组的余数闲置"""
+    return [gpus[i:i + gpus_per_replica]
+            for i in range(0, len(gpus) - gpus_per_replica + 1, gpus_per_replica)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run data-parallel replicas of vlm_judge.py / test_prompt_vllm.py on disjoint GPU groups",
+        usage="python launch_shards.py [options] -- vlm_judge.py --input_json a.json b.json --stream")
+    parser.add_argument("--gpus", default=None,
+                        help="Comma-separated GPU ids (default: CUDA_VISIBLE_DEVICES, else all GPUs)")
+    parser.add_argument("--gpus_per_replica", type=int, default=1,
+                        help="Tensor-parallel size of each replica")
+    parser.add_argument("--num_nodes", type=int, default=1,
+                        help="Hosts running this launcher with the same arguments (shared filesystem)")
+    parser.add_argument("--node_rank", type=int, default=0, help="Index of this host in [0, --num_nodes)")
+    parser.add_argument("--log_dir", default="results/exp_unified/logs")
+    parser.add_argument("--no_merge", action="store_true", help="Do not merge shard outputs at the end")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Script and its arguments")
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command or not command[0].endswith(".py"):
+        parser.error("expected a script after '--', e.g. -- vlm_judge.py --input_json a.json")
+    if not 0 <= args.node_rank < args.num_nodes:
+        parser.error("--node_rank must be in [0, --num_nodes)")
+
+    gpus = args.gpus.split(",") if args.gpus else visible_gpus()
+    groups = gpu_groups(gpus, args.gpus_per_replica)
+    if not groups:
+        sys.exit(f"❌ Need at least {args.gpus_per_replica} GPU(s), found {len(gpus)}")
+
+    # 各节点的副本数相同，分片编号在全局连续
+    num_shards = args.num_nodes * len(groups)
+    first_shard = args.node_rank * len(groups)
+    script = os.path.basename(command[0])
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    print(f"🚀 Launching {len(groups)} replica(s) x TP={args.gpus_per_replica} on node "
+          f"{args.node_rank + 1}/{args.num_nodes} ({num_shards} shards in total)")
+    procs = []
+    for k, group in enumerate(groups):
+        shard_index = first_shard + k
+        cmd = [sys.executable] + command + ["--num_shards", str(num_shards),
+                                            "--shard_index", str(shard_index),
+                                            "--tensor_parallel_size", str(len(group))]
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=",".join(group))
+        log_path = os.path.join(args.log_dir, f"{os.path.splitext(script)[0]}.shard{shard_index}of{num_shards}.log")
+        log = open(log_path, 'w', encoding='utf-8')
+        procs.append((shard_index, subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT), log))
+        print(f"   Shard {shard_index}: GPUs {','.join(group)} -> {log_path}")
+
+    t0 = time.time()
+    failed = []
+    try:
+        for shard_index, proc, log in procs:
+            if proc.wait() != 0:
+                failed.append(shard_index)
+            log.close()
+    except KeyboardInterrupt:
+        for _, proc, _ in procs:
+            proc.terminate()
+        raise
+
+    if failed:
+        print(f"❌ Shard(s) {', '.join(map(str, failed))} failed; see logs in {args.log_dir}")
+        sys.exit(1)
+    print(f"✅ All {len(procs)} local shard(s) finished in {time.time() - t0:.1f}s")
+
+    merge_cmd = [sys.executable] + command + MERGE_ARGS.get(script, []) + ["--num_shards", str(num_shards)]
+    if args.no_merge or script not in MERGE_ARGS:
+        return
+    if args.num_nodes > 1:
+        print(f"🧩 After all nodes finish, merge with: {' '.join(merge_cmd[1:])}")
+        return
+    print("🧩 Merging shard outputs...")
+    sys.exit(subprocess.run(merge_cmd).returncode)
+
+
+if __name__ == "__main__":
+    main()
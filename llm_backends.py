@@ -0,0 +1,232 @@
+import io
+import base64
+import random
+import asyncio
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# 统一的生成结果：vLLM 与 HTTP 后端都返回这个结构
+# logprobs: 每个生成位置一个 {token 文本: logprob} 字典 (仅在 sampling 中请求了 logprobs 时存在)
+GenerationResult = namedtuple(
+    "GenerationResult",
+    ["text", "prompt_tokens", "output_tokens", "finish_reason", "logprobs"],
+    defaults=[0, 0, None, None],
+)
+
+
+# ===================== 请求格式 =====================
+# 请求统一使用 OpenAI 风格的 messages：
+#   [{"role": "user", "content": [{"type": "text", "text": ...}, {"type": "image", "image": <PIL.Image>}, ...]}]
+# sampling 为普通 dict，例如 {"temperature": 0.1, "max_tokens": 1024}，或与请求一一对应的 dict 列表；
+# 可选的 "json_schema" 字段 (见 json_schemas.py) 在解码期约束输出必须符合该 JSON Schema
+
+def per_request(sampling, n):
+    return sampling if isinstance(sampling, list) else [sampling] * n
+
+def message_images(messages):
+    return [part["image"] for msg in messages for part in msg["content"] if part["type"] == "image"]
+
+
+def render_plain_chat(messages, image_placeholder):
+    """把 messages 渲染成 <|user|> ... <|assistant|> 形式的提示词，图片位置替换为占位符"""
+    chunks = []
+    for msg in messages:
+        body = "".join(image_placeholder if part["type"] == "image" else part["text"]
+                       for part in msg["content"])
+        chunks.append(f"<|{msg['role']}|>\n{body}\n")
+    return "".join(chunks) + "<|assistant|>\n"
+
+
+# ===================== vLLM (进程内) =====================
+
+class VLLMBackend:
+    """进程内 vllm.LLM 后端；render 负责把 messages 转成模型的提示词字符串"""
+
+    def __init__(self, llm, render):
+        self.llm = llm
+        self.render = render
+
+    def generate(self, requests, sampling):
+        inputs = []
+        for messages in requests:
+            vllm_input = {"prompt": self.render(messages)}
+            images = message_images(messages)
+            if images:
+                vllm_input["multi_modal_data"] = {"image": images}
+            inputs.append(vllm_input)
+
+        if isinstance(sampling, list):
+            params = [self._sampling_params(s) for s in sampling]
+        else:
+            params = self._sampling_params(sampling)
+        outputs = self.llm.generate(inputs, params)
+        return [self._to_result(o) for o in outputs]
+
+    @staticmethod
+    def _sampling_params(sampling):
+        from vllm import SamplingParams
+
+        sampling = dict(sampling)
+        schema = sampling.pop("json_schema", None)
+        if schema is None:
+            return SamplingParams(**sampling)
+        try:
+            from vllm.sampling_params import GuidedDecodingParams
+            return SamplingParams(guided_decoding=GuidedDecodingParams(json=schema), **sampling)
+        except ImportError:
+            # 较新的 vLLM 把 guided decoding 改名为 structured outputs
+            from vllm.sampling_params import StructuredOutputsParams
+            return SamplingParams(structured_outputs=StructuredOutputsParams(json=schema), **sampling)
+
+    @staticmethod
+    def _to_result(output):
+        completion = output.outputs[0]
+        logprobs = None
+        if completion.logprobs:
+            logprobs = [{lp.decoded_token: lp.logprob for lp in position.values()}
+                        for position in completion.logprobs]
+        return GenerationResult(
+            text=completion.text,
+            prompt_tokens=len(output.prompt_token_ids or []),
+            output_tokens=len(completion.token_ids),
+            finish_reason=completion.finish_reason,
+            logprobs=logprobs,
+        )
+
+
+# ===================== OpenAI 兼容 HTTP (vllm serve) =====================
+
+def encode_image(image, fmt="PNG"):
+    """PIL 图片编码为 data URL；默认 PNG 无损，避免二次压缩影响画质评测"""
+    buf = io.BytesIO()
+    image.save(buf, format=fmt)
+    mime = "jpeg" if fmt.upper() == "JPEG" else fmt.lower()
+    return f"data:image/{mime};base64,{base64.b64encode(buf.getvalue()).decode('ascii')}"
+
+
+class OpenAIChatBackend:
+    """
+    OpenAI 兼容 /v1/chat/completions 后端，可把多个轻量 judge 进程指向同一个 `vllm serve`。
+
+    - 后台线程中运行一个常驻 asyncio 事件循环，aiohttp 连接池跨批次复用 (keep-alive)
+    - max_in_flight 限制同时在途的请求数
+    - 连接错误 / 429 / 5xx 按指数退避 (带抖动) 重试，重试耗尽后返回 finish_reason="error"
+    """
+
+    RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, api_base, model, api_key=None, max_in_flight=32, max_retries=5,
+                 timeout=600, image_format="PNG", encode_workers=8):
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.image_format = image_format
+        self.encode_workers = encode_workers
+
+        self._session = None
+        self._semaphore = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def _to_openai_messages(self, messages):
+        converted = []
+        for msg in messages:
+            content = []
+            for part in msg["content"]:
+                if part["type"] == "image":
+                    url = encode_image(part["image"], self.image_format)
+                    content.append({"type": "image_url", "image_url": {"url": url}})
+                else:
+                    content.append({"type": "text", "text": part["text"]})
+            converted.append({"role": msg["role"], "content": content})
+        return converted
+
+    def _payload(self, messages, sampling):
+        sampling = dict(sampling)
+        payload = {"model": self.model, "messages": messages}
+        top_logprobs = sampling.pop("logprobs", None)
+        if top_logprobs:
+            payload["logprobs"] = True
+            payload["top_logprobs"] = top_logprobs
+        schema = sampling.pop("json_schema", None)
+        if schema is not None:
+            # OpenAI 标准的结构化输出参数，vllm serve 以 guided decoding 实现
+            payload["response_format"] = {"type": "json_schema",
+                                          "json_schema": {"name": "output", "schema": schema, "strict": True}}
+        payload.update(sampling)
+        return payload
+
+    def generate(self, requests, sampling):
+        # 图片编码是 CPU 密集操作，放在线程池里并行，避免阻塞事件循环
+        with ThreadPoolExecutor(max_workers=self.encode_workers) as pool:
+            payloads = list(pool.map(lambda m, s: self._payload(self._to_openai_messages(m), s),
+                                     requests, per_request(sampling, len(requests))))
+        future = asyncio.run_coroutine_threadsafe(self._generate_all(payloads), self._loop)
+        return future.result()
+
+    async def _generate_all(self, payloads):
+        import aiohttp
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return await asyncio.gather(*(self._request(p) for p in payloads))
+
+    async def _request(self, payload):
+        import aiohttp
+
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(min(30.0, 0.5 * 2 ** (attempt - 1)) * (0.5 + random.random()))
+            try:
+                async with self._semaphore:
+                    async with self._session.post(self.url, json=payload) as resp:
+                        if resp.status in self.RETRY_STATUS:
+                            last_error = f"HTTP {resp.status}: {(await resp.text())[:200]}"
+                            continue
+                        if resp.status >= 400:
+                            # 其余 4xx (如超出上下文) 重试也不会成功
+                            print(f"❌ Request rejected: HTTP {resp.status}: {(await resp.text())[:200]}")
+                            return GenerationResult(text="", finish_reason="error")
+                        body = await resp.json(content_type=None)
+                return self._to_result(body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = repr(e)
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                # 200 但响应体不是合法的 chat completion (非 JSON、缺少 choices 等)：只让这一条失败
+                print(f"❌ Malformed response: {e!r}")
+                return GenerationResult(text="", finish_reason="error")
+
+        print(f"❌ Request failed after {self.max_retries + 1} attempts: {last_error}")
+        return GenerationResult(text="", finish_reason="error")
+
+    @staticmethod
+    def _to_result(body):
+        choice = body["choices"][0]
+        usage = body.get("usage") or {}
+        logprobs = None
+        if choice.get("logprobs") and choice["logprobs"].get("content"):
+            logprobs = [{top["token"]: top["logprob"] for top in position.get("top_logprobs", [])}
+                        for position in choice["logprobs"]["content"]]
+        return GenerationResult(
+            text=choice["message"].get("content") or "",
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            output_tokens=usage.get("completion_tokens", 0),
+            finish_reason=choice.get("finish_reason"),
+            logprobs=logprobs,
+        )
+
+    def close(self):
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+            self._session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
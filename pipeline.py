@@ -0,0 +1,364 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from image_cache import DigestMemo
+
+# ===================== 阶段定义 =====================
+
+class Stage:
+    """
+    流水线中的一个阶段。
+
+    - cmd: 命令参数列表 (子进程执行) 或无参函数 (进程内执行)
+    - inputs / outputs: 文件或目录；某阶段的输入是另一阶段的输出时自动形成依赖
+    - gpu: GPU 阶段全局串行，CPU 阶段可并发
+    - group / group_args: 同一 group 中同时待运行的阶段合并成一次调用，
+      命令为 cmd + 各阶段 group_args 依次拼接 (例如多个测试集共用一次模型加载)；
+      合并调用失败时按各阶段的输出是否在本次运行中更新分别判定成功与否
+    - image_refs: 测试集 JSON，其中引用的全部图片 (first_frame_path / last_frame_path) 也计入输入签名。
+      build 输出只记录路径，原地重新生成的图片不会改变它
+    """
+
+    def __init__(self, name, cmd, inputs, outputs, gpu=False, group=None, group_args=(), image_refs=()):
+        self.name = name
+        self.cmd = cmd
+        self.inputs = [os.path.normpath(p) for p in inputs]
+        self.outputs = [os.path.normpath(p) for p in outputs]
+        self.gpu = gpu
+        self.group = group
+        self.group_args = list(group_args)
+        self.image_refs = [os.path.normpath(p) for p in image_refs]
+
+    def describe(self):
+        if callable(self.cmd):
+            return f"<{self.cmd.__name__}>"
+        # 解释器路径不计入签名，换环境不会导致全部重跑
+        return " ".join(["python" if arg == sys.executable else arg for arg in self.cmd + self.group_args])
+
+
+def archive_results(dest_dir="results"):
+    """复制评测结果与源 JSON 到 results/，并输出按类别的分数汇总"""
+    os.makedirs(dest_dir, exist_ok=True)
+    for mode in ("egovid", "drone", "walk"):
+        for ext in (".json", ".npz"):
+            shutil.copy2(f"{mode}_metadata_judged_direct{ext}", dest_dir)
+    for source in ("metadata.json", "drone.json", "walk.json"):
+        shutil.copy2(source, dest_dir)
+    subprocess.run([sys.executable, "analyze_results.py", "summary",
+                    *[os.path.join(dest_dir, f"{mode}_metadata_judged_direct.npz") for mode in ("egovid", "drone", "walk")],
+                    "--group_by", "mode", "category",
+                    "--output_json", os.path.join(dest_dir, "score_summary.json")], check=True)
+
+
+def default_stages(config="config.yaml"):
+    """与原 run_judge.sh 相同的流程"""
+    py = sys.executable
+    frames = "results/exp_unified/{}/generated_frames"
+    stages = [
+        # drone 与 walk 共用一次模型加载；结果通过 journal 合并回源 JSON (输入即输出)
+        Stage("prompts", [py, "test_prompt_vllm.py", "--mode", "drone", "walk"],
+              inputs=["config.yaml", "drone.json", "walk.json"], outputs=["drone.json", "walk.json"], gpu=True),
+        Stage("lastframe_drone", [py, "test_lastframe_gen.py", "--mode", "drone"],
+              inputs=["config.yaml", "drone.json"], outputs=[frames.format("drone")], gpu=True),
+        Stage("lastframe_walk", [py, "test_lastframe_gen.py", "--mode", "walk"],
+              inputs=["config.yaml", "walk.json"], outputs=[frames.format("walk")], gpu=True),
+    ]
+    # build 输出相对上次评测完成时的 delta，judge 只评测新增 / 变化的条目并提交 manifest
+    for mode, source in (("egovid", "metadata.json"), ("drone", "drone.json"), ("walk", "walk.json")):
+        stages.append(Stage(f"build_{mode}",
+                            [py, "build.py", "--mode", mode, "--source_json", source, "--incremental",
+                             "--image_dir", frames.format(mode), "--output_path", f"./{mode}_metadata.json"],
+                            inputs=[source, frames.format(mode)], outputs=[f"{mode}_metadata.json"]))
+    for mode in ("egovid", "drone", "walk"):
+        # 三个测试集的评测阶段同时待运行时合并为一次 vlm_judge.py 调用 (模型只加载一次)。
+        # 生成帧原地重新生成 (如 SC4_MOD_k.jpg 同名覆盖) 时 build 输出不变，
+        # 因此生成帧目录与测试集引用的全部图片 (含首帧) 也是评测的输入
+        stages.append(Stage(f"judge_{mode}",
+                            [py, "vlm_judge.py", "--config", config, "--columnar", "npz", "--incremental",
+                             "--input_json"],
+                            inputs=[config, f"{mode}_metadata.json", frames.format(mode)],
+                            outputs=[f"{mode}_metadata_judged_direct.json", f"{mode}_metadata_judged_direct.npz"],
+                            gpu=True, group="judge", group_args=[f"{mode}_metadata.json"],
+                            image_refs=[f"{mode}_metadata.json"]))
+    stages.append(Stage("archive", archive_results,
+                        inputs=[f"{mode}_metadata_judged_direct.npz" for mode in ("egovid", "drone", "walk")],
+                        outputs=["results/score_summary.json"]))
+    return stages
+
+
+# ===================== 内容签名 =====================
+
+class Signatures:
+    """
+    文件按内容 (sha1) 签名，(size, mtime_ns) 未变时复用上次的 hash；
+    目录按其中所有文件的 (相对路径, size, mtime_ns) 签名，避免每次读取上万张图片。
+    """
+
+    def __init__(self, cache):
+        # cache 为状态文件中的 {path: [size, mtime_ns, digest]}，跨运行复用
+        self.digest = DigestMemo(cache)
+
+    def path(self, path):
+        if os.path.isdir(path):
+            h = hashlib.sha1()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    st = os.stat(full)
+                    h.update(f"{os.path.relpath(full, path)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+            return "dir:" + h.hexdigest()
+        if not os.path.isfile(path):
+            return None
+        return self.digest(path)
+
+    @staticmethod
+    def image_refs(testset):
+        """测试集引用的全部图片的 (路径, size, mtime_ns) 签名；文件缺失也计入签名"""
+        if not os.path.isfile(testset):
+            return None
+        from vlm_judge import iter_test_items
+        paths = sorted({item[key] for item in iter_test_items(testset)
+                        for key in ("first_frame_path", "last_frame_path") if item.get(key)})
+        h = hashlib.sha1()
+        for path in paths:
+            try:
+                st = os.stat(path)
+                h.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+            except OSError:
+                h.update(f"{path}\0missing\n".encode())
+        return "refs:" + h.hexdigest()
+
+    def inputs(self, stage):
+        payload = {"cmd": stage.describe(), "inputs": {p: self.path(p) for p in stage.inputs}}
+        if stage.image_refs:
+            payload["image_refs"] = {p: self.image_refs(p) for p in stage.image_refs}
+        return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def outputs(self, stage):
+        return {p: self.path(p) for p in stage.outputs}
+
+
+# ===================== 调度 =====================
+
+class Pipeline:
+    def __init__(self, stages, state_path, log_dir, jobs=4):
+        self.stages = {s.name: s for s in stages}
+        self.order = [s.name for s in stages]
+        self.state_path = state_path
+        self.log_dir = log_dir
+        self.jobs = jobs
+        self.state = {"stages": {}, "hashes": {}}
+        if os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+        self.signatures = Signatures(self.state.setdefault("hashes", {}))
+        self.deps = self._dependencies()
+
+    def _dependencies(self):
+        producers = {}
+        for stage in self.stages.values():
+            for path in stage.outputs:
+                producers.setdefault(path, []).append(stage.name)
+        deps = {}
+        for stage in self.stages.values():
+            deps[stage.name] = sorted({p for path in stage.inputs for p in producers.get(path, [])
+                                       if p != stage.name})
+        self._check_acyclic(deps)
+        return deps
+
+    def _check_acyclic(self, deps):
+        visiting, visited = set(), set()
+
+        def visit(name, path):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"pipeline has a cycle: {' -> '.join(path + [name])}")
+            visiting.add(name)
+            for dep in deps[name]:
+                visit(dep, path + [name])
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in deps:
+            visit(name, [])
+
+    def is_stale(self, name):
+        stage = self.stages[name]
+        record = self.state["stages"].get(name)
+        if record is None:
+            return True, "never ran"
+        if any(not os.path.exists(p) for p in stage.outputs):
+            return True, "output missing"
+        if record["outputs"] != self.signatures.outputs(stage):
+            return True, "output changed since last run"
+        if record["inputs"] != self.signatures.inputs(stage):
+            return True, "input changed"
+        return False, "up to date"
+
+    def _save_state(self):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def _outputs_updated(stage, since):
+        """合并调用部分失败时判定单个阶段：全部输出都存在且在本次运行开始后写过"""
+        return all(os.path.exists(p) and os.path.getmtime(p) >= since for p in stage.outputs)
+
+    def _run(self, names):
+        """在线程池中执行一个阶段 (或合并执行同 group 的多个阶段)，返回 (names, {name: 是否成功}, 秒数)"""
+        stages = [self.stages[n] for n in names]
+        t0 = time.time()
+        log_path = os.path.join(self.log_dir, f"pipeline_{'+'.join(names)}.log")
+        try:
+            if callable(stages[0].cmd):
+                stages[0].cmd()
+                return names, {n: True for n in names}, time.time() - t0
+            cmd = stages[0].cmd + [arg for s in stages for arg in s.group_args]
+            with open(log_path, 'w', encoding='utf-8') as log:
+                log.write("$ " + " ".join(cmd) + "\n")
+                log.flush()
+                ok = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode == 0
+            if ok or len(stages) == 1:
+                return names, {n: ok for n in names}, time.time() - t0
+            # 合并调用中某个测试集失败时，其余已写出结果的阶段仍算成功
+            return names, {s.name: self._outputs_updated(s, t0) for s in stages}, time.time() - t0
+        except Exception as e:
+            print(f"❌ [{'+'.join(names)}] {e}")
+            return names, {n: False for n in names}, time.time() - t0
+
+    def run(self, force=(), dry_run=False):
+        os.makedirs(self.log_dir, exist_ok=True)
+        status = {}
+        pending = list(self.order)
+        running = {}
+        gpu_busy = False
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                started = False
+                for name in list(pending):
+                    if name not in pending:
+                        continue
+                    deps = self.deps[name]
+                    if any(status.get(d) in ("failed", "blocked") for d in deps):
+                        status[name] = "blocked"
+                        pending.remove(name)
+                        print(f"⏭️ [{name}] blocked by a failed dependency")
+                        continue
+                    if not all(status.get(d) in ("skipped", "done", "planned") for d in deps):
+                        continue
+                    stale, reason = (True, "forced") if name in force else self.is_stale(name)
+                    # dry run 时上游并未真正运行，输出是否变化未知，按需要重跑计
+                    if not stale and any(status.get(d) == "planned" for d in deps):
+                        stale, reason = True, "upstream will re-run"
+                    if not stale:
+                        status[name] = "skipped"
+                        pending.remove(name)
+                        print(f"✔️ [{name}] {reason}, skipped")
+                        continue
+                    stage = self.stages[name]
+                    if stage.gpu and gpu_busy:
+                        continue
+                    # 同组还有成员在等上游时先不启动，等它们就绪后合并成一次调用 (只要还有阶段在运行就不会卡住)
+                    if stage.group and running and any(
+                            self.stages[other].group == stage.group and other != name
+                            and not all(status.get(d) in ("skipped", "done", "planned") for d in self.deps[other])
+                            for other in pending):
+                        continue
+
+                    batch = [name]
+                    if stage.group:
+                        batch += [other for other in pending if other != name
+                                  and self.stages[other].group == stage.group
+                                  and all(status.get(d) in ("skipped", "done", "planned") for d in self.deps[other])
+                                  and (other in force or self.is_stale(other)[0])]
+                    for n in batch:
+                        pending.remove(n)
+                    print(f"▶️ [{'+'.join(batch)}] {reason}: {self.stages[batch[0]].describe()}"
+                          + "".join(" " + " ".join(self.stages[n].group_args) for n in batch[1:]))
+                    if dry_run:
+                        for n in batch:
+                            status[n] = "planned"
+                        started = True
+                        continue
+                    if stage.gpu:
+                        gpu_busy = True
+                    running[pool.submit(self._run, batch)] = stage.gpu
+                    started = True
+
+                if not running:
+                    if pending and not started:
+                        raise RuntimeError(f"pipeline stalled with pending stages: {pending}")
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if running.pop(future):
+                        gpu_busy = False
+                    names, results, seconds = future.result()
+                    for n in names:
+                        ok = results[n]
+                        status[n] = "done" if ok else "failed"
+                        if ok:
+                            # 输入签名在运行后记录：输入即输出的阶段 (如 prompts) 以写回后的内容为准
+                            self.state["stages"][n] = {
+                                "inputs": self.signatures.inputs(self.stages[n]),
+                                "outputs": self.signatures.outputs(self.stages[n]),
+                                "finished_at": time.time(),
+                            }
+                    self._save_state()
+                    failed = [n for n in names if not results[n]]
+                    if not failed:
+                        print(f"✅ [{'+'.join(names)}] finished in {seconds:.1f}s")
+                    elif len(failed) == len(names):
+                        print(f"❌ [{'+'.join(names)}] failed in {seconds:.1f}s")
+                    else:
+                        print(f"⚠️ [{'+'.join(names)}] finished in {seconds:.1f}s; failed: {', '.join(failed)}")
+        return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run prompt generation -> build -> judge as a DAG, "
+                                                 "skipping stages whose inputs have not changed")
+    parser.add_argument("--config", default="config.yaml", help="Config passed to vlm_judge.py")
+    parser.add_argument("--state", default="results/exp_unified/logs/pipeline_state.json")
+    parser.add_argument("--log_dir", default="results/exp_unified/logs")
+    parser.add_argument("--jobs", type=int, default=4, help="Max stages running at the same time")
+    parser.add_argument("--force", nargs='*', default=[],
+                        help="Stages to re-run even if up to date (downstream stages re-run only if the forced "
+                             "stage's outputs change)")
+    parser.add_argument("--only", nargs='*', default=None, help="Run only these stages (and nothing downstream)")
+    parser.add_argument("--dry_run", action="store_true", help="Only print which stages would run")
+    args = parser.parse_args()
+
+    stages = default_stages(args.config)
+    if args.only is not None:
+        unknown = set(args.only) - {s.name for s in stages}
+        if unknown:
+            parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+        stages = [s for s in stages if s.name in args.only]
+
+    pipeline = Pipeline(stages, args.state, args.log_dir, args.jobs)
+    t0 = time.time()
+    status = pipeline.run(force=set(args.force), dry_run=args.dry_run)
+
+    failed = [n for n, s in status.items() if s in ("failed", "blocked")]
+    ran = [n for n, s in status.items() if s in ("done", "planned")]
+    print(f"{'❌' if failed else '🎉'} Pipeline {'planned' if args.dry_run else 'finished'} in {time.time() - t0:.1f}s: "
+          f"{len(ran)} ran, {sum(1 for s in status.values() if s == 'skipped')} skipped, {len(failed)} failed")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import numpy as np
+from collections import namedtuple
+from PIL import Image
+
+# 预过滤判定：不调用模型，直接作为该条目的 eval 结果
+Prefiltered = namedtuple("Prefiltered", ["eval"])
+
+# 统计量在缩小后的灰度图上计算 (像素值 0-255)
+STATS_SIZE = 64
+HASH_SIZE = 8
+
+
+def gray_array(img, width=STATS_SIZE, height=None):
+    return np.asarray(img.convert("L").resize((width, height or width), Image.BILINEAR), dtype=np.float32)
+
+
+def dhash(img, hash_size=HASH_SIZE):
+    """差分感知哈希：缩到 (hash_size+1) x hash_size 灰度图，比较相邻像素得到 hash_size^2 位"""
+    px = gray_array(img, hash_size + 1, hash_size)
+    bits = (px[:, 1:] > px[:, :-1]).ravel()
+    return int(np.packbits(bits).tobytes().hex(), 16)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def image_stats(img_gen, img_ref=None):
+    """生成图的方差，以及 (有参考图时) 与参考图的逐像素差异和感知哈希距离"""
+    gen = gray_array(img_gen)
+    stats = {"gen_std": round(float(gen.std()), 3)}
+    if img_ref is not None:
+        diff = np.abs(gen - gray_array(img_ref))
+        stats.update({
+            "mean_abs_diff": round(float(diff.mean()), 3),
+            "max_abs_diff": round(float(diff.max()), 3),
+            "dhash_distance": hamming(dhash(img_gen), dhash(img_ref)),
+        })
+    return stats
+
+
+class PixelPrefilter:
+    """
+    便宜的像素级检查，拦截明显无效的生成结果：
+    - corrupt_output: 生成图无法完整解码 (截断 / 损坏)
+    - blank_output:   生成图几乎是纯色 (灰度标准差 < blank_std)
+    - no_edit:        与参考图几乎一致 (缩略图最大像素差 <= no_edit_max_diff 且感知哈希距离 <= no_edit_hash)
+
+    判定为其中之一的条目得到固定分数 score，并在 eval 中记录原因和统计量。
+    no_edit 用最大像素差而不是平均差：只改了一小块区域的编辑平均差很小，但最大差很大。
+    """
+
+    def __init__(self, score=0, blank_std=2.0, no_edit_max_diff=8.0, no_edit_hash=2):
+        self.score = score
+        self.blank_std = blank_std
+        self.no_edit_max_diff = no_edit_max_diff
+        self.no_edit_hash = no_edit_hash
+
+    def verdict(self, check, reasoning, stats=None):
+        return Prefiltered({"reasoning": reasoning, "score": self.score, "tier": "prefilter",
+                            "prefilter": {"check": check, "stats": stats or {}}})
+
+    def check(self, img_gen, img_ref=None):
+        """返回 Prefiltered，或 None (需要模型评测)"""
+        stats = image_stats(img_gen, img_ref)
+        if stats["gen_std"] < self.blank_std:
+            return self.verdict("blank_output", "Pixel pre-filter: the generated image is blank (near-uniform).",
+                                stats)
+        if img_ref is not None and stats["max_abs_diff"] <= self.no_edit_max_diff \
+                and stats["dhash_distance"] <= self.no_edit_hash:
+            return self.verdict("no_edit", "Pixel pre-filter: the generated image is (nearly) identical to the reference; "
+                                           "no edit was applied.", stats)
+        return None
+
+    def corrupt(self, error):
+        return self.verdict("corrupt_output",
+                            f"Pixel pre-filter: the generated image could not be decoded ({error}).")
@@ -0,0 +1,89 @@
+import threading
+
+# 提示词模板中的图片位置标记：标记之前的静态指令排在图片前面，便于引擎的 prefix cache 复用
+IMAGE_SLOT = "[[IMAGE]]"
+
+
+def split_image_slot(text, image):
+    """按 IMAGE_SLOT 把提示词拆成 message content；没有标记时图片放在最前 (原有布局)"""
+    if IMAGE_SLOT not in text:
+        return [{"type": "image", "image": image}, {"type": "text", "text": text}]
+    head, tail = text.split(IMAGE_SLOT, 1)
+    content = []
+    if head:
+        content.append({"type": "text", "text": head})
+    content.append({"type": "image", "image": image})
+    if tail:
+        content.append({"type": "text", "text": tail})
+    return content
+
+
+def strip_image_slot(text):
+    """去掉 IMAGE_SLOT 及其占用的换行，还原加标记前的提示词 (split_image_slot 随后把图片放在最前)"""
+    for marker in (IMAGE_SLOT + "\n", "\n" + IMAGE_SLOT, IMAGE_SLOT):
+        if marker in text:
+            return text.replace(marker, "", 1)
+    return text
+
+
+class PromptBuilder:
+    """
+    缓存 chat 模板渲染结果：同一种 messages 结构 (角色 + 各 part 类型) 只真正渲染一次。
+
+    首次渲染时用哨兵字符串代替各文本段，切分得到静态片段 (chat 包装、图片占位符等)，
+    之后每条请求只需把文本段拼接进去。首条请求会与直接渲染的结果比对，
+    不一致 (例如模板会 trim 文本) 则该结构退回逐条渲染。
+    """
+
+    def __init__(self, render):
+        self.render_fn = render
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, messages):
+        signature = tuple((msg["role"], tuple(part["type"] for part in msg["content"]))
+                          for msg in messages)
+        segments = self._segments.get(signature)
+        if segments is None:
+            segments = self._compile(messages)
+            with self._lock:
+                self._segments[signature] = segments
+        if segments is False:
+            return self.render_fn(messages)
+        return self._fill(segments, messages)
+
+    @staticmethod
+    def _fill(segments, messages):
+        texts = [part["text"] for msg in messages for part in msg["content"] if part["type"] == "text"]
+        chunks = [segments[0]]
+        for text, segment in zip(texts, segments[1:]):
+            chunks.append(text)
+            chunks.append(segment)
+        return "".join(chunks)
+
+    def _compile(self, messages):
+        sentinels = []
+        probe = []
+        for msg in messages:
+            content = []
+            for part in msg["content"]:
+                if part["type"] == "text":
+                    sentinel = f"\x00TEXT{len(sentinels)}\x00"
+                    sentinels.append(sentinel)
+                    content.append({"type": "text", "text": sentinel})
+                else:
+                    content.append(part)
+            probe.append({"role": msg["role"], "content": content})
+
+        rendered = self.render_fn(probe)
+        segments = []
+        for sentinel in sentinels:
+            if rendered.count(sentinel) != 1:
+                return False
+            head, rendered = rendered.split(sentinel)
+            segments.append(head)
+        segments.append(rendered)
+
+        if self._fill(segments, messages) != self.render_fn(messages):
+            return False
+        return segments
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from image_cache import DigestMemo
+
+
+def cache_key(*parts):
+    """把决定结果的全部输入 (可 JSON 序列化) 哈希成缓存 key"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    持久化的结果缓存 (SQLite 单文件，多个进程 / 分片可共享同一个文件)。
+
+    key 由调用方用 cache_key() 对决定结果的全部输入 (图片内容 hash、提示词、模型、采样参数、模板版本) 哈希得到，
+    value 为可 JSON 序列化的结果；namespace 区分不同用途 (例如评测结果与提示词生成结果)。
+    总大小超过 max_bytes 时按最近访问时间 (LRU) 淘汰。
+    命中时只在内存中记录访问，写入新结果或 close() 时再批量更新访问时间，避免每次查询都提交事务。
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3, namespace="judge"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.digest = DigestMemo()
+        # 命中但尚未写回访问时间的 key
+        self._touched = set()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 预取线程中查询，连接由 _lock 串行化
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self._conn.commit()
+
+    def get(self, key):
+        """返回缓存的结果，未命中返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM results WHERE namespace = ? AND key = ?",
+                                     (self.namespace, key)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched.add(key)
+        return json.loads(row[0])
+
+    def put_many(self, entries):
+        """写入 [(key, value), ...]，随后写回访问时间并按大小上限淘汰"""
+        now = time.time()
+        rows = []
+        for key, value in entries:
+            text = json.dumps(value, ensure_ascii=False)
+            rows.append((self.namespace, key, text, len(text.encode("utf-8")), now))
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows)
+                self._flush_touched(now)
+                self._evict()
+
+    def _flush_touched(self, now):
+        """在锁和事务内调用"""
+        if self._touched:
+            self._conn.executemany("UPDATE results SET last_used = ? WHERE namespace = ? AND key = ?",
+                                   [(now, self.namespace, key) for key in self._touched])
+            self._touched.clear()
+
+    def _evict(self):
+        """在锁和事务内调用：按最近访问时间从旧到新删除，直到总大小回到上限以内"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evict = []
+        for rowid, size in self._conn.execute("SELECT rowid, size FROM results ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evict.append((rowid,))
+            total -= size
+        self._conn.executemany("DELETE FROM results WHERE rowid = ?", evict)
+
+    def close(self):
+        with self._lock:
+            with self._conn:
+                self._flush_touched(time.time())
+            self._conn.close()
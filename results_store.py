@@ -0,0 +1,90 @@
+import os
+import numpy as np
+
+# 列式结果：每个评测条目一行，分数缺失为 NaN
+#   status: ok (有数值分数) / no_score (解析出 JSON 但没有分数) / failed (输出无法解析) / missing (未评测)
+STRING_COLUMNS = ["test_id", "mode", "prompt_key", "category", "original_id", "status", "tier"]
+FLOAT_COLUMNS = ["score", "expected_score"]
+
+
+def prompt_category(prompt_key):
+    """SC4_MOD_2 -> SC4；egovid 等没有 MOD 后缀的 prompt_key 原样返回"""
+    return prompt_key.split("_MOD_")[0] if prompt_key else ""
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def result_row(item):
+    """把一个 _judged_direct 条目压成一行"""
+    if 'eval_direct' not in item:
+        status, evaluation = "missing", None
+    else:
+        evaluation = item['eval_direct']
+        status = "failed" if evaluation is None else "no_score"
+    if not isinstance(evaluation, dict):
+        evaluation = {}
+    score = _number(evaluation.get("score"))
+    if status == "no_score" and not np.isnan(score):
+        status = "ok"
+    return {
+        "test_id": str(item.get('test_id', "")),
+        "mode": item.get('mode') or "",
+        "prompt_key": item.get('prompt_key') or "",
+        "category": prompt_category(item.get('prompt_key')),
+        "original_id": str(item.get('original_id', "")),
+        "status": status,
+        "tier": evaluation.get("tier") or "",
+        "score": score,
+        "expected_score": _number(evaluation.get("expected_score")),
+    }
+
+
+def to_columns(items):
+    rows = [result_row(item) for item in items]
+    columns = {name: np.array([r[name] for r in rows], dtype=str) for name in STRING_COLUMNS}
+    columns.update({name: np.array([r[name] for r in rows], dtype=np.float64) for name in FLOAT_COLUMNS})
+    return columns
+
+
+def columnar_path(output_file, fmt):
+    """xxx_judged_direct.json -> xxx_judged_direct.npz / .parquet"""
+    return os.path.splitext(output_file)[0] + "." + fmt
+
+
+def write_columnar(path, items):
+    """写出 .npz (仅依赖 numpy) 或 .parquet (需要 pyarrow)，先写临时文件再原子替换"""
+    columns = to_columns(items)
+    tmp_path = path + ".tmp"
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow); use npz instead")
+        pq.write_table(pa.table({name: col.tolist() if col.dtype.kind == "U" else col
+                                 for name, col in columns.items()}), tmp_path)
+    else:
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **columns)
+    os.replace(tmp_path, path)
+    return len(columns["test_id"])
+
+
+def read_results(path):
+    """读取列式结果 (.npz / .parquet)，或直接从 _judged_direct.json(l) 转换，返回 {列名: ndarray}"""
+    if path.endswith(".npz"):
+        with np.load(path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        return {name: np.asarray(table.column(name).to_numpy(zero_copy_only=False),
+                                 dtype=np.float64 if name in FLOAT_COLUMNS else str)
+                for name in table.column_names}
+    from vlm_judge import iter_test_items
+    return to_columns(iter_test_items(path))
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class RunMetrics:
+    """
+    一次评测 / 提示词生成运行的指标：各阶段耗时、每个批次的 token 数与吞吐、解析失败率，
+    以及最终失败的条目 (test_id -> 原因) 和经修复 / 重试挽回的条目数。
+
+    items / images 按数据集条目去重计数 (级联的完整评测、重试、修复不重复计入)，
+    发给后端的请求数单独记为 requests。
+
+    结束时用 write(prefix) 写出 <prefix>.json (机器可读报告) 和 <prefix>.prom
+    (Prometheus textfile collector 格式)。
+    """
+
+    def __init__(self, job, dataset):
+        self.job = job
+        self.dataset = dataset
+        self.started_at = time.time()
+        self.stage_seconds = {}
+        self.batches = []
+        self.parse_ok = 0
+        self.parse_failed = 0
+        self.item_ids = set()
+        # test_id -> {"reason", "detail", "attempts"}；条目之后成功时由 clear_failure 移除
+        self.failures = {}
+        self.recovered = {}
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - t0)
+
+    def add_stage_time(self, name, seconds):
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+
+    def record_batch(self, results, seconds, images=None, item_ids=None):
+        """
+        results 为后端返回的 GenerationResult 列表，seconds 为该批次 generate 的墙钟时间。
+        images / item_ids 与 results 对齐：每个请求的图片数和它覆盖的数据集条目 id 列表；
+        只有第一次出现的条目计入 items 与 images
+        """
+        prompt_tokens = sum(r.prompt_tokens or 0 for r in results)
+        output_tokens = sum(r.output_tokens or 0 for r in results)
+        new_items, new_images = 0, 0
+        for k, ids in enumerate(item_ids or []):
+            new = [i for i in ids if i not in self.item_ids]
+            if new:
+                self.item_ids.update(new)
+                new_items += len(new)
+                new_images += images[k] if images else 0
+        self.batches.append({
+            "requests": len(results),
+            "items": new_items,
+            "images": new_images,
+            "images_sent": sum(images or []),
+            "seconds": round(seconds, 4),
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "truncated": sum(1 for r in results if r.finish_reason == "length"),
+            "errors": sum(1 for r in results if r.finish_reason == "error"),
+            "output_tokens_per_sec": round(output_tokens / seconds, 2) if seconds > 0 else None,
+        })
+
+    def record_parse(self, ok):
+        if ok:
+            self.parse_ok += 1
+        else:
+            self.parse_failed += 1
+
+    def record_failure(self, key, reason, detail=None):
+        attempts = self.failures.get(key, {}).get("attempts", 0) + 1
+        self.failures[key] = {"reason": reason, "detail": detail, "attempts": attempts}
+
+    def clear_failure(self, key):
+        self.failures.pop(key, None)
+
+    def record_recovered(self, kind, count):
+        """kind: repair (纯文本修复成功) / regenerate (重新生成成功)"""
+        if count:
+            self.recovered[kind] = self.recovered.get(kind, 0) + count
+
+    def failures_by_reason(self):
+        counts = {}
+        for failure in self.failures.values():
+            counts[failure["reason"]] = counts.get(failure["reason"], 0) + 1
+        return counts
+
+    def summary(self):
+        wall = time.time() - self.started_at
+        items = sum(b["items"] for b in self.batches)
+        requests = sum(b["requests"] for b in self.batches)
+        gen_seconds = sum(b["seconds"] for b in self.batches)
+        prompt_tokens = sum(b["prompt_tokens"] for b in self.batches)
+        output_tokens = sum(b["output_tokens"] for b in self.batches)
+        images = sum(b["images"] for b in self.batches)
+        parsed = self.parse_ok + self.parse_failed
+        batch_latency = [b["seconds"] for b in self.batches]
+
+        def rate(n, seconds):
+            return round(n / seconds, 3) if seconds > 0 else None
+
+        return {
+            "job": self.job,
+            "dataset": self.dataset,
+            "started_at": self.started_at,
+            "wall_seconds": round(wall, 3),
+            "items": items,
+            "images": images,
+            "requests": requests,
+            "images_sent": sum(b["images_sent"] for b in self.batches),
+            "batches": len(self.batches),
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "truncated": sum(b["truncated"] for b in self.batches),
+            "errors": sum(b["errors"] for b in self.batches),
+            "parse_failures": self.parse_failed,
+            "parse_failure_rate": round(self.parse_failed / parsed, 4) if parsed else None,
+            "failed_items": len(self.failures),
+            "failures_by_reason": self.failures_by_reason(),
+            "recovered": dict(self.recovered),
+            "items_per_sec": rate(items, wall),
+            "images_per_sec": rate(images, wall),
+            "requests_per_sec": rate(requests, wall),
+            "prompt_tokens_per_sec": rate(prompt_tokens, gen_seconds),
+            "output_tokens_per_sec": rate(output_tokens, gen_seconds),
+            "seconds_per_item": round(wall / items, 4) if items else None,
+            "batch_latency_p50": _percentile(batch_latency, 0.5),
+            "batch_latency_p90": _percentile(batch_latency, 0.9),
+            "batch_latency_max": max(batch_latency) if batch_latency else None,
+            "stage_seconds": {k: round(v, 3) for k, v in self.stage_seconds.items()},
+        }
+
+    def print_summary(self):
+        s = self.summary()
+        stages = ", ".join(f"{k}={v:.1f}s" for k, v in s["stage_seconds"].items())
+        print(f"📈 {s['items']} items ({s['requests']} requests) in {s['wall_seconds']:.1f}s "
+              f"({s['items_per_sec'] or 0:.2f} items/s, {s['images_per_sec'] or 0:.2f} images/s); "
+              f"tokens in/out: {s['prompt_tokens']}/{s['output_tokens']} "
+              f"({s['output_tokens_per_sec'] or 0:.1f} out tok/s); "
+              f"parse failures: {s['parse_failures']}")
+        if stages:
+            print(f"   Stages: {stages}")
+        if s["recovered"]:
+            print(f"   Recovered: {', '.join(f'{k}={v}' for k, v in s['recovered'].items())}")
+        if s["failed_items"]:
+            reasons = ", ".join(f"{k}={v}" for k, v in sorted(s["failures_by_reason"].items()))
+            print(f"❌ {s['failed_items']} item(s) failed permanently ({reasons}); see the run report")
+
+    def write(self, prefix):
+        """写出 <prefix>.json 与 <prefix>.prom，返回两者路径"""
+        summary = self.summary()
+        json_path = prefix + ".json"
+        with open(json_path, 'w', encoding='utf-8') as f:
+            failures = [{"test_id": key, **failure} for key, failure in self.failures.items()]
+            json.dump({"summary": summary, "failures": failures, "batches": self.batches}, f,
+                      indent=4, ensure_ascii=False)
+
+        prom_path = prefix + ".prom"
+        tmp_path = prom_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self._prometheus(summary))
+        # textfile collector 可能随时读取，原子替换避免读到半个文件
+        os.replace(tmp_path, prom_path)
+        return json_path, prom_path
+
+    def _prometheus(self, s):
+        labels = f'job="{self.job}",dataset="{os.path.basename(self.dataset)}"'
+        metrics = [
+            ("items_total", "counter", "Distinct dataset items sent to the model", s["items"]),
+            ("images_total", "counter", "Images of those items (first request per item)", s["images"]),
+            ("requests_total", "counter", "Requests sent to the model, including cascade passes and retries",
+             s["requests"]),
+            ("prompt_tokens_total", "counter", "Prompt tokens", s["prompt_tokens"]),
+            ("output_tokens_total", "counter", "Generated tokens", s["output_tokens"]),
+            ("truncated_total", "counter", "Outputs stopped by max_tokens", s["truncated"]),
+            ("parse_failures_total", "counter", "Outputs that could not be parsed", s["parse_failures"]),
+            ("failed_items_total", "counter", "Items without a result at the end of the run", s["failed_items"]),
+            ("parse_failure_ratio", "gauge", "Share of outputs that could not be parsed", s["parse_failure_rate"]),
+            ("wall_seconds", "gauge", "Wall time of the run", s["wall_seconds"]),
+            ("items_per_second", "gauge", "End-to-end item throughput", s["items_per_sec"]),
+            ("requests_per_second", "gauge", "End-to-end request throughput", s["requests_per_sec"]),
+            ("output_tokens_per_second", "gauge", "Generation throughput", s["output_tokens_per_sec"]),
+            ("run_timestamp_seconds", "gauge", "Unix time the run started", s["started_at"]),
+        ]
+        lines = []
+        for name, kind, help_text, value in metrics:
+            if value is None:
+                continue
+            lines.append(f"# HELP judge_{name} {help_text}")
+            lines.append(f"# TYPE judge_{name} {kind}")
+            lines.append(f"judge_{name}{{{labels}}} {value}")
+        lines.append("# HELP judge_stage_seconds Wall time per pipeline stage")
+        lines.append("# TYPE judge_stage_seconds gauge")
+        for stage, seconds in s["stage_seconds"].items():
+            lines.append(f'judge_stage_seconds{{{labels},stage="{stage}"}} {seconds}')
+        return "\n".join(lines) + "\n"
@@ -1,48 +1,88 @@
 import os
+import sys
+import glob
 os.environ["VLLM_WORKER_MULTIPROC_METHOD"] = "spawn"
 import json
 import yaml
 import math
 import time
 from datetime import datetime
-from PIL import Image
-from transformers import AutoProcessor
-import torch.multiprocessing as mp
-
-# try:
-#     mp.set_start_method('spawn', force=True)
-# except RuntimeError:
-#     pass
-
-from vllm import LLM, SamplingParams
-import torch
 import argparse
+from image_prefetch import load_rgb, prefetch
+from concurrent.futures import ThreadPoolExecutor
+from image_cache import resize_to_budget, DigestMemo
+from token_budget import (TokenBudget, TOKEN_PATCH, estimate_image_tokens, estimate_text_tokens, image_size,
+                          processor_token_patch)
+from run_metrics import RunMetrics
+from json_schemas import mod_schema
+from result_cache import ResultCache, cache_key
+from llm_backends import VLLMBackend, OpenAIChatBackend, render_plain_chat
+from prompt_builder import PromptBuilder, split_image_slot, strip_image_slot
+
+# torch / vllm / transformers 只在真正构建进程内引擎时才导入 (见 main)，
+# --help、--compact、--dry_run 与 HTTP 后端都不需要它们
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--mode", type=str, default=None)
-args, _ = parser.parse_known_args()
+parser.add_argument("--config", default="./config.yaml")
+parser.add_argument("--mode", type=str, nargs='+', default=None,
+                    help="One or more modes; all of them share one model load")
+parser.add_argument("--prefetch_workers", type=int, default=4)
+parser.add_argument("--prefetch_depth", type=int, default=1)
+parser.add_argument("--backend", choices=["vllm", "openai"], default="vllm")
+parser.add_argument("--api_base", default="http://localhost:8000/v1")
+parser.add_argument("--api_model", default=None)
+parser.add_argument("--api_key", default=os.environ.get("OPENAI_API_KEY"))
+parser.add_argument("--max_in_flight", type=int, default=32)
+parser.add_argument("--max_retries", type=int, default=5)
+parser.add_argument("--compact", action="store_true",
+                    help="Only merge pending journals into the source JSON, then exit")
+parser.add_argument("--tensor_parallel_size", type=int, default=None,
+                    help="GPUs per engine (default: all visible GPUs)")
+parser.add_argument("--num_shards", type=int, default=1,
+                    help="Split the items round-robin into this many shards (one per replica)")
+parser.add_argument("--shard_index", type=int, default=0, help="Shard processed by this process")
+parser.add_argument("--max_pixels", type=int, default=0,
+                    help="Pixel budget per image: larger frames are downscaled (default 0 = keep original size)")
+parser.add_argument("--token_patch", type=int, default=None,
+                    help="Pixels per visual token side used to estimate prompt length "
+                         f"(default: read from the model's processor, else {TOKEN_PATCH} as for Qwen3-VL)")
+parser.add_argument("--max_model_len", type=int, default=32768)
+parser.add_argument("--batch_size", type=int, default=50, help="Max tasks per generate() call")
+parser.add_argument("--batch_token_budget", type=int, default=None,
+                    help="Pack tasks into batches of at most this many estimated prompt tokens, sorted by length "
+                         "(default: fixed --batch_size chunks)")
+parser.add_argument("--guided_json", action="store_true",
+                    help="Constrain SC batch outputs to exactly the MOD_1..MOD_n JSON object at decode time")
+parser.add_argument("--memo_db", default=None,
+                    help="SQLite memo of generated prompts keyed by image content, template, instruction, model and "
+                         "sampling; repeats across runs are served without calling the model")
+parser.add_argument("--memo_max_gb", type=float, default=1.0, help="Size cap of the memo store (LRU eviction)")
+parser.add_argument("--no_dedupe", action="store_true",
+                    help="Generate identical tasks (same image content and prompt) separately instead of once per run")
+parser.add_argument("--legacy_prompt_layout", action="store_true",
+                    help="Use the original prompt layout (image first) instead of static-instructions-first")
+parser.add_argument("--dry_run", action="store_true",
+                    help="Check config, inputs and image paths, render the prompts and estimate tokens "
+                         "without loading a model")
 
 # ===================== 配置加载 =====================
 def load_config(config_path="./config.yaml"):
     with open(config_path, 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
 
-CONFIG = load_config()
-if args.mode:
-    INPUT_MODE = args.mode.lower()
-else:
-    INPUT_MODE = CONFIG['paths'].get('input_mode', 'egovid').lower()
-    base_json = CONFIG['paths']['json_file']
-base_json = CONFIG['paths']['json_file']
-if INPUT_MODE in ['drone', 'walk']:
-    # 假设 base_json 是 metadata.json，这里替换为 drone.json / walk.json
-    JSON_PATH = os.path.join(os.path.dirname(base_json), f"{INPUT_MODE}.json")
-else:
-    JSON_PATH = base_json
-MODEL_PATH = CONFIG['models']['vlm_path']
-RESULT_ROOT = CONFIG['paths']['result_root']
+def input_modes(config, modes=None):
+    if modes:
+        return [m.lower() for m in modes]
+    return [config['paths'].get('input_mode', 'egovid').lower()]
+
+def resolve_json_path(mode, base_json):
+    if mode in ['drone', 'walk']:
+        # 假设 base_json 是 metadata.json，这里替换为 drone.json / walk.json
+        return os.path.join(os.path.dirname(base_json), f"{mode}.json")
+    return base_json
 
 # ===================== [STRICT] System Prompts =====================
+# [[IMAGE]] (IMAGE_SLOT) 标记图片插入位置：之前的静态指令在整个批次中相同，可被 prefix cache 复用
 
 # --- 1. EGOVID Prompt (From image_edit_1/testset_prompt.py) ---
 SYSTEM_PROMPT_EGOVID = """
@@ -64,6 +104,7 @@ Steps:
 [Edit Command]: Place the watermelon inside the white mesh bag. The hand is now adjusting the bag opening. The soil and grass background remains unchanged.
 
 ### Now process this:
+[[IMAGE]]
 [Start Frame]: (The image provided above)
 [Instruction]: {instruction}
 [Edit Command]:"""
@@ -84,7 +125,8 @@ SC1_BATCH_TEMPLATE = """Task: Generate {count} distinct spatial camera movement
 Output strictly in JSON format:
 {{
   "MOD_1": "...", "MOD_2": "...", "MOD_3": "...", "MOD_4": "...", "MOD_5": "...", "MOD_6": "..."
-}}"""
+}}
+[[IMAGE]]"""
 
 # ===================== SC2: Background Transition (Original) =====================
 SC2_BATCH_TEMPLATE = """Task: Write {count} background transition commands for [SC2].
@@ -103,7 +145,8 @@ SC2_BATCH_TEMPLATE = """Task: Write {count} background transition commands for [
 Output strictly in JSON format:
 {{
   "MOD_1": "...", "MOD_2": "...", "MOD_3": "...", "MOD_4": "...", "MOD_5": "..."
-}}"""
+}}
+[[IMAGE]]"""
 
 # ===================== SC4: Dynamic Activity (New) =====================
 SC4_BATCH_TEMPLATE = """Task: Generate {count} distinct dynamic activity commands for [SC-4].
@@ -124,15 +167,21 @@ Goal: Based on the provided starting frame, describe a 5-second realistic moveme
 Output strictly in JSON format:
 {{
   "MOD_1": "...", "MOD_2": "...", "MOD_3": "...", "MOD_4": "..."
-}}"""
+}}
+[[IMAGE]]"""
 
 # ===================== SC5: Lighting/Atmosphere (Original) =====================
 SC5_BATCH_TEMPLATE = """Task: Write {count} lighting/atmosphere commands. Change ONLY light/weather, keep geometry identical.
 [Consistency]: DO NOT change the geometry or identity of any objects.
-Output strictly in JSON format: {{ "MOD_1": "...", "MOD_2": "...", "MOD_3": "...", "MOD_4": "..." , "MOD_5": "...", "MOD_6": "..."}}"""
+Output strictly in JSON format: {{ "MOD_1": "...", "MOD_2": "...", "MOD_3": "...", "MOD_4": "..." , "MOD_5": "...", "MOD_6": "..."}}
+[[IMAGE]]"""
 
 
 
+# 各 SC 批量模板生成的 MOD 数量 (同时决定 --guided_json 的 MOD_1..MOD_n schema)
+SC_BATCH_COUNTS = {"SC1_BATCH": 6, "SC2_BATCH": 5, "SC4_BATCH": 3, "SC5_BATCH": 6}
+
+
 # ===================== 任务构建逻辑 =====================
 def build_tasks(data_items, mode):
     tasks = []
@@ -151,120 +200,458 @@ def build_tasks(data_items, mode):
 
         # --- Case 2: DRONE ---
         elif mode == 'drone':
-            # tasks.append((idx, "SC1_BATCH", SC1_BATCH_TEMPLATE.format(count=6)))
-            # tasks.append((idx, "SC2_BATCH", SC2_BATCH_TEMPLATE.format(count=5)))
+            # tasks.append((idx, "SC1_BATCH", SC1_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC1_BATCH"])))
+            # tasks.append((idx, "SC2_BATCH", SC2_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC2_BATCH"])))
             tasks.append((idx, "SC4_BATCH",
-                               SC4_BATCH_TEMPLATE.format(count=3, object="contextual agents", density="various",
-                                                         activity="various")))
-            # tasks.append((idx, "SC5_BATCH", SC5_BATCH_TEMPLATE.format(count=6)))
+                               SC4_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC4_BATCH"], object="contextual agents",
+                                                         density="various", activity="various")))
+            # tasks.append((idx, "SC5_BATCH", SC5_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC5_BATCH"])))
 
         # --- Case 3: WALK ---
         elif mode == 'walk':
-            # tasks.append((idx, "SC1_BATCH", SC1_BATCH_TEMPLATE.format(count=6)))
-            # tasks.append((idx, "SC2_BATCH", SC2_BATCH_TEMPLATE.format(count=5)))
+            # tasks.append((idx, "SC1_BATCH", SC1_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC1_BATCH"])))
+            # tasks.append((idx, "SC2_BATCH", SC2_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC2_BATCH"])))
             tasks.append((idx, "SC4_BATCH",
-                               SC4_BATCH_TEMPLATE.format(count=3, object="contextual agents", density="various",
-                                                         activity="various")))
-            # tasks.append((idx, "SC5_BATCH", SC5_BATCH_TEMPLATE.format(count=6)))
+                               SC4_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC4_BATCH"], object="contextual agents",
+                                                         density="various", activity="various")))
+            # tasks.append((idx, "SC5_BATCH", SC5_BATCH_TEMPLATE.format(count=SC_BATCH_COUNTS["SC5_BATCH"])))
             
     return tasks
 
-# ===================== 主逻辑 =====================
-def main():
-    if not os.path.exists(JSON_PATH):
-        print(f"❌ JSON not found: {JSON_PATH}")
-        return
-
-    with open(JSON_PATH, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+# ===================== 追加写日志 (Journal) =====================
+# 生成结果不再每个批次整体重写源 JSON，而是追加到 <json>.journal.jsonl：
+#   {"idx": 条目下标, "id": 条目 id, "field": 字段名, "value": 值}   生成的字段
+#   {"idx": 条目下标, "id": 条目 id, "task": 任务名}                  任务完成标记
+# 每个批次 fsync 一次；结束时 (或 --compact) 原子地合并回源 JSON 并删除 journal。
+# 分片运行 (--num_shards > 1) 时每个分片写自己的 <json>.journal.shardKofN.jsonl，
+# 且不回写源 JSON；全部分片结束后用 --compact 统一合并。
+def journal_path(json_path, shard=None):
+    if shard is not None:
+        shard_index, num_shards = shard
+        return json_path + f".journal.shard{shard_index}of{num_shards}.jsonl"
+    return json_path + ".journal.jsonl"
+
+def journal_files(json_path):
+    return sorted(glob.glob(glob.escape(json_path) + ".journal*.jsonl"))
+
+def replay_journal(data, path, repair=True):
+    """把 journal 回放到 data 上，返回已完成的 (idx, task) 集合；repair=False 时不修补半行 (只读)"""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    applied = 0
+    line = "\n"
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                # 崩溃时写了一半的末行
+                continue
+            idx = rec['idx']
+            if idx >= len(data) or data[idx].get('id') != rec.get('id'):
+                print(f"⚠️ Journal entry does not match source item {idx}, skipped")
+                continue
+            if 'task' in rec:
+                completed.add((idx, rec['task']))
+            else:
+                data[idx][rec['field']] = rec['value']
+                applied += 1
+    if repair and not line.endswith("\n"):
+        # 给半行补上换行，避免后续追加的记录与它粘在同一行
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("\n")
+    print(f"♻️ Replayed journal {path}: {applied} fields, {len(completed)} completed tasks")
+    return completed
+
+def compact_journal(json_path, data):
+    """原子地把 (已回放 journal 的) data 写回源 JSON，然后删除 journal"""
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, json_path)
+    for path in journal_files(json_path):
+        os.remove(path)
+    print(f"💾 Compacted results into {json_path}")
 
-    all_tasks = build_tasks(data, INPUT_MODE)
-    
-    if not all_tasks:
-        print("🎉 No tasks to process.")
-        return
+# ===================== 主逻辑 =====================
+def task_tokens(data, budget):
+    """按首帧的文件头尺寸与指令长度估计任务的提示词 token 数；同一张图只读一次文件头"""
+    sizes = {}
 
-    # 初始化 vLLM (显存优化)
-    num_gpus = torch.cuda.device_count()
+    def cost(task):
+        path = data[task[0]]['first_frame_path']
+        if path not in sizes:
+            try:
+                sizes[path] = image_size(path)
+            except (OSError, ValueError):
+                # 读不了的图交给解码阶段报错
+                sizes[path] = None
+        tokens = estimate_text_tokens(task[2])
+        if sizes[path]:
+            tokens += estimate_image_tokens(*sizes[path], budget.max_pixels, budget.token_patch)
+        return tokens
+
+    return cost
+
+def task_sampling(sampling, field_name, guided_json=False):
+    """guided_json 时 SC 批量任务在解码期约束为恰好 MOD_1..MOD_n 的 JSON 对象；egovid 的自由文本不受约束"""
+    if guided_json and field_name in SC_BATCH_COUNTS:
+        return dict(sampling, json_schema=mod_schema(SC_BATCH_COUNTS[field_name]))
+    return sampling
+
+
+def output_fields(mode, field_name, generated_text):
+    """一条生成结果要写入条目的字段 [(key, value), ...] 及是否解析成功 (SC 批量任务的 JSON 展开为 SC4_MOD_1 等)"""
+    if mode == 'egovid':
+        return [(field_name, generated_text)], bool(generated_text)
+    # JSON 解析 (Drone/Walk)
     try:
-        llm = LLM(
-            model=MODEL_PATH, 
-            trust_remote_code=True, 
-            tensor_parallel_size=num_gpus,
-            gpu_memory_utilization=0.90,
-            limit_mm_per_prompt={"image": 1},
-            max_model_len=32768
-        )
-        processor = AutoProcessor.from_pretrained(MODEL_PATH, trust_remote_code=True)
-    except Exception as e:
-        print(f"❌ Model Init Failed: {e}")
-        return
-
-    batch_size = 50
-    sampling_params = SamplingParams(temperature=0.2, max_tokens=1024)
-    total_chunks = math.ceil(len(all_tasks) / batch_size)
-
-    print(f"⚡ Starting Inference for {len(all_tasks)} tasks...")
-
-    for i in range(0, len(all_tasks), batch_size):
-        chunk_tasks = all_tasks[i : i + batch_size]
-        vllm_inputs = []
-        
-        for (item_idx, field_name, prompt_text) in chunk_tasks:
+        start = generated_text.find('{')
+        end = generated_text.rfind('}') + 1
+        if start != -1 and end != -1:
+            json_data = json.loads(generated_text[start:end])
+            prefix = field_name.split('_')[0]
+            return [(f"{prefix}_{key}", val) for key, val in json_data.items()], True
+        return [(f"{field_name}_raw", generated_text)], False
+    except Exception:
+        return [(f"{field_name}_error", generated_text)], False
+
+
+def batched(tasks, size):
+    """把任务流按 size 切成批次，惰性读取 (去重与推理交替进行)"""
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def task_key(task, data, sampling, fingerprint, digest, guided_json=False):
+    """
+    任务的记忆 key：首帧内容 hash + 任务名 (模板) + 渲染后的完整指令 + 采样参数 (含 JSON schema)
+    + fingerprint (模型、像素预算)。内容相同的任务 (重复的首帧、重复导出的指令) 得到相同的 key。
+    """
+    item_idx, field_name, prompt_text = task
+    return cache_key(fingerprint, task_sampling(sampling, field_name, guided_json), field_name, prompt_text,
+                     digest(data[item_idx]['first_frame_path']))
+
+
+def run_mode(backend, sampling, mode, json_path, data, all_tasks, batch_size=50, shard=None, budget=None,
+             prefetch_workers=4, prefetch_depth=1, guided_json=False, memo=None, fingerprint=None, dedupe=True,
+             metrics=None):
+    """
+    用已加载的模型处理单个 mode 的全部任务，每个批次的结果追加到 journal。
+    dedupe 时内容相同的任务在本次运行中只生成一次，结果写给所有副本；
+    memo (result_cache.ResultCache) 中已有的任务直接取结果，新生成且解析成功的结果写回 memo。
+    """
+    journal = open(journal_path(json_path, shard), 'a', encoding='utf-8')
+
+    def set_field(item_idx, key, value):
+        data[item_idx][key] = value
+        journal.write(json.dumps({"idx": item_idx, "id": data[item_idx].get('id'),
+                                  "field": key, "value": value}, ensure_ascii=False) + "\n")
+
+    def complete_task(task, fields):
+        item_idx, field_name, _ = task
+        for key, value in fields:
+            set_field(item_idx, key, value)
+        journal.write(json.dumps({"idx": item_idx, "id": data[item_idx].get('id'),
+                                  "task": field_name}, ensure_ascii=False) + "\n")
+
+    # key -> 内容相同的全部任务 (只有第一个进入推理)；(item_idx, field_name) -> key
+    # key -> memo 中已有的结果 / 本次已生成的结果
+    copies = {}
+    keys = {}
+    served = {}
+    generated = {}
+    stats = {"served": 0, "late_copies": 0, "unique": 0}
+    digest_pool = None
+
+    def dedupe_tasks():
+        """按原顺序产出需要推理的任务；首帧 hash 在线程池中计算，与前面批次的推理重叠"""
+        for task in all_tasks:
             try:
-                item = data[item_idx]
-                image_path = item['first_frame_path']
-                image = Image.open(image_path).convert("RGB")
-                
-                messages = [{"role": "user", "content": [
-                    {"type": "image", "image": image_path},
-                    {"type": "text", "text": prompt_text}
-                ]}]
-                text_input = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-                
-                vllm_inputs.append({
-                    "prompt": text_input,
-                    "multi_modal_data": {"image": image}
-                })
-            except Exception as e:
-                print(f"⚠️ Error preparing input: {e}")
+                key = task_key(task, data, sampling, fingerprint, lambda path: digests[path].result(), guided_json)
+            except OSError:
+                # 读不了的图交给解码阶段报错
+                stats["unique"] += 1
+                yield task
                 continue
-
-        if vllm_inputs:
+            if key in generated:
+                # 原任务所在批次已经推理完，直接复用结果
+                complete_task(task, generated[key])
+                stats["late_copies"] += 1
+                continue
+            if key not in served and key not in copies and memo is not None:
+                cached = memo.get(key)
+                if cached is not None:
+                    served[key] = cached
+            if key in served:
+                complete_task(task, served[key])
+                stats["served"] += 1
+            elif key in copies:
+                copies[key].append(task)
+            else:
+                copies[key] = [task]
+                keys[(task[0], task[1])] = key
+                stats["unique"] += 1
+                yield task
+
+    tasks = all_tasks
+    if dedupe or memo is not None:
+        # 本次运行中每个首帧只 hash 一次 (hash 不持久化，每次运行都会重新计算；memo 只保存生成结果)
+        digest = memo.digest if memo is not None else DigestMemo()
+        digest_pool = ThreadPoolExecutor(max_workers=max(1, prefetch_workers))
+        digests = {}
+        for idx, _, _ in all_tasks:
+            path = data[idx]['first_frame_path']
+            if path not in digests:
+                digests[path] = digest_pool.submit(digest, path)
+        tasks = dedupe_tasks()
+
+    if budget is not None and budget.batch_tokens:
+        # 按 token 预算装箱 (长度相近的任务同批)，每批仍不超过 batch_size 条；装箱需要全部任务
+        tasks = list(tasks)
+        chunk_list = budget.batches(tasks, task_tokens(data, budget), max_items=batch_size)
+        total_chunks = len(chunk_list)
+        chunks = iter(chunk_list)
+        print(f"⚡ [{mode}] Starting Inference for {len(tasks)} tasks in {total_chunks} batches...")
+    elif digest_pool is not None:
+        # 去重边算边推理：批次数事先未知
+        total_chunks = None
+        chunks = batched(tasks, batch_size)
+        print(f"⚡ [{mode}] Starting Inference for {len(all_tasks)} tasks (deduplicated while generating)...")
+    else:
+        total_chunks = math.ceil(len(all_tasks) / batch_size)
+        chunks = batched(all_tasks, batch_size)
+        print(f"⚡ [{mode}] Starting Inference for {len(all_tasks)} tasks in {total_chunks} batches...")
+    metrics = metrics or RunMetrics("prompt_gen", json_path)
+
+    max_pixels = budget.max_pixels if budget is not None else None
+    load_task_image = lambda task: resize_to_budget(load_rgb(data[task[0]]['first_frame_path']), max_pixels)
+    prefetched = prefetch(chunks, load_task_image, prefetch_workers, prefetch_depth)
+
+    for chunk_idx, (chunk_tasks, results, wait_time) in enumerate(prefetched):
+        metrics.add_stage_time("image_decode_wait", wait_time)
+        requests = []
+        prepared_tasks = []
+        
+        for (item_idx, field_name, prompt_text), image, error in results:
+            if error is not None:
+                print(f"⚠️ Error preparing input for {data[item_idx].get('id', item_idx)}: {error}")
+                continue
+            request = [{"role": "user", "content": split_image_slot(prompt_text, image)}]
+            if budget is not None:
+                tokens = budget.request_tokens(request)
+                if not budget.fits(tokens):
+                    print(f"❌ Skipping {data[item_idx].get('id', item_idx)}/{field_name}: ~{tokens} prompt tokens "
+                          f"+ {budget.max_output_tokens} output tokens exceed max_model_len={budget.max_model_len}")
+                    continue
+            requests.append(request)
+            prepared_tasks.append((item_idx, field_name, prompt_text))
+
+        if requests:
             try:
-                outputs = llm.generate(vllm_inputs, sampling_params)
+                with metrics.stage("generate"):
+                    t0 = time.perf_counter()
+                    request_sampling = [task_sampling(sampling, task[1], guided_json)
+                                        for task in prepared_tasks] if guided_json else sampling
+                    outputs = backend.generate(requests, request_sampling)
+                metrics.record_batch(outputs, time.perf_counter() - t0, images=[1] * len(requests),
+                                     item_ids=[[task[0]] for task in prepared_tasks])
                 
+                memo_entries = []
                 for j, output in enumerate(outputs):
-                    original_task = chunk_tasks[j]
+                    original_task = prepared_tasks[j]
                     item_idx, field_name, _ = original_task
-                    generated_text = output.outputs[0].text.strip()
-                    
-                    if INPUT_MODE == 'egovid':
-                        data[item_idx][field_name] = generated_text
-                    else:
-                        # JSON 解析 (Drone/Walk)
-                        try:
-                            start = generated_text.find('{')
-                            end = generated_text.rfind('}') + 1
-                            if start != -1 and end != -1:
-                                json_data = json.loads(generated_text[start:end])
-                                prefix = field_name.split('_')[0]
-                                for key, val in json_data.items():
-                                    full_key = f"{prefix}_{key}"
-                                    data[item_idx][full_key] = val
-                            else:
-                                data[item_idx][f"{field_name}_raw"] = generated_text
-                        except Exception:
-                            data[item_idx][f"{field_name}_error"] = generated_text
+                    fields, ok = output_fields(mode, field_name, output.text.strip())
+                    metrics.record_parse(ok)
+
+                    key = keys.get((item_idx, field_name))
+                    for task in copies.get(key, [original_task]):
+                        complete_task(task, fields)
+                    if key is not None:
+                        generated[key] = fields
+                    if ok and key is not None:
+                        memo_entries.append((key, fields))
+                if memo is not None and memo_entries:
+                    with metrics.stage("memo_write"):
+                        memo.put_many(memo_entries)
 
             except Exception as e:
                 print(f"❌ Batch Inference Error: {e}")
 
-        # 实时保存
-        with open(JSON_PATH, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        # 实时保存：只追加本批次的结果
+        with metrics.stage("journal_write"):
+            journal.flush()
+            os.fsync(journal.fileno())
         
-        print(f"✅ Batch {i//batch_size + 1}/{total_chunks} Done.")
+        print(f"✅ [{mode}] Batch {chunk_idx + 1}{f'/{total_chunks}' if total_chunks else ''} Done.")
+
+    if digest_pool is not None:
+        digest_pool.shutdown()
+        journal.flush()
+        duplicates = sum(len(tasks) - 1 for tasks in copies.values()) + stats["late_copies"]
+        print(f"🧠 [{mode}] {len(all_tasks)} tasks: {stats['served']} served from memo, {duplicates} duplicate(s) of "
+              f"another task, {stats['unique']} generated")
+    journal.close()
+    metrics.print_summary()
+    report_prefix = os.path.splitext(json_path)[0] + "_prompt_gen"
+    if shard is not None:
+        report_prefix += f".shard{shard[0]}of{shard[1]}"
+    report_json, _ = metrics.write(report_prefix + ".report")
+    print(f"   Run report: {report_json}")
+
+def dry_run(jobs, budget, workers=4):
+    """不加载模型：检查首帧图片、用文件头尺寸估计 token 数并渲染第一条提示词，返回是否没有问题"""
+    ok = True
+    for mode, json_path, data, all_tasks in jobs:
+        paths = sorted({data[idx].get('first_frame_path') or "" for idx, _, _ in all_tasks})
+        [(_, results, _)] = list(prefetch([paths], image_size, workers, 0))
+        sizes = {path: size for path, size, error in results if error is None}
+        bad = [(path, error) for path, _, error in results if error is not None]
+
+        tokens = [estimate_text_tokens(text) + (estimate_image_tokens(*sizes[data[idx]['first_frame_path']],
+                                                                      budget.max_pixels, budget.token_patch)
+                                                if data[idx].get('first_frame_path') in sizes else 0)
+                  for idx, _, text in all_tasks]
+        too_long = sum(1 for t in tokens if not budget.fits(t))
+
+        print(f"🔍 [{mode}] {json_path}: {len(data)} items, {len(all_tasks)} pending tasks, "
+              f"{len(paths)} distinct images ({len(bad)} unreadable)")
+        if tokens:
+            print(f"   Estimated prompt tokens: min {min(tokens)}, mean {sum(tokens) / len(tokens):.0f}, "
+                  f"max {max(tokens)}; {too_long} task(s) exceed max_model_len={budget.max_model_len}")
+        for path, error in bad[:5]:
+            print(f"   ❌ {path or '<empty first_frame_path>'}: {error}")
+        if all_tasks:
+            idx, field_name, text = all_tasks[0]
+            messages = [{"role": "user", "content": split_image_slot(text, None)}]
+            print(f"   Sample prompt ({data[idx].get('id', idx)}/{field_name}):")
+            print(render_plain_chat(messages, "<image>"))
+        ok = ok and not bad and not too_long
+    return ok
+
+def main():
+    args, _ = parser.parse_known_args()
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard_index must be in [0, --num_shards)")
+    shard = (args.shard_index, args.num_shards) if args.num_shards > 1 else None
+
+    config = load_config(args.config)
+    model_path = config['models']['vlm_path']
+    base_json = config['paths']['json_file']
+
+    # 先为所有 mode 构建任务，确认确实有工作再加载模型
+    jobs = []
+    for mode in input_modes(config, args.mode):
+        json_path = resolve_json_path(mode, base_json)
+        if not os.path.exists(json_path):
+            print(f"❌ JSON not found: {json_path}")
+            continue
+
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        # 回放上次中断留下的 journal，跳过已完成的任务。
+        # 分片运行时只读自己的 journal：其他分片可能正在追加，回放会给它们的半行补换行
+        if shard is not None and not args.compact:
+            paths = [p for p in (journal_path(json_path), journal_path(json_path, shard)) if os.path.exists(p)]
+        else:
+            paths = journal_files(json_path)
+        completed = set()
+        for path in paths:
+            completed |= replay_journal(data, path, repair=not args.dry_run)
+        if args.compact:
+            if journal_files(json_path):
+                compact_journal(json_path, data)
+            continue
+
+        all_tasks = [task for task in build_tasks(data, mode) if (task[0], task[1]) not in completed]
+        if args.legacy_prompt_layout:
+            # 提示词文本恢复原样，memo key 随之区分两种布局
+            all_tasks = [(idx, field_name, strip_image_slot(text)) for idx, field_name, text in all_tasks]
+        if shard is not None:
+            all_tasks = [task for task in all_tasks if task[0] % args.num_shards == args.shard_index]
+        if all_tasks:
+            jobs.append((mode, json_path, data, all_tasks))
+        elif completed and shard is None and not args.dry_run:
+            compact_journal(json_path, data)
+    
+    if args.compact:
+        return
+
+    sampling = {"temperature": 0.2, "max_tokens": 1024}
+    budget = TokenBudget(args.max_model_len, sampling["max_tokens"], args.batch_token_budget, args.max_pixels,
+                         args.token_patch or TOKEN_PATCH)
+
+    if args.dry_run:
+        if not dry_run(jobs, budget, args.prefetch_workers):
+            sys.exit(1)
+        print("✅ Dry run passed")
+        return
+
+    if not jobs:
+        print("🎉 No tasks to process.")
+        return
+
+    memo = None
+    if args.memo_db:
+        memo = ResultCache(args.memo_db, int(args.memo_max_gb * 1024 ** 3), namespace="prompt_gen")
+        print(f"🧠 Prompt memo: {args.memo_db}")
+
+    if args.backend == "openai":
+        api_model = args.api_model or model_path
+        print(f"🌐 Using OpenAI-compatible backend: {args.api_base} (model={api_model})")
+        backend = OpenAIChatBackend(args.api_base, api_model, api_key=args.api_key,
+                                    max_in_flight=args.max_in_flight, max_retries=args.max_retries)
+    else:
+        import torch
+        from vllm import LLM
+        from transformers import AutoProcessor
+
+        # 初始化 vLLM (显存优化)，所有 mode 共用一次模型加载
+        num_gpus = args.tensor_parallel_size or torch.cuda.device_count()
+        try:
+            llm = LLM(
+                model=model_path, 
+                trust_remote_code=True, 
+                tensor_parallel_size=num_gpus,
+                gpu_memory_utilization=0.90,
+                limit_mm_per_prompt={"image": 1},
+                max_model_len=args.max_model_len
+            )
+            processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True)
+        except Exception as e:
+            print(f"❌ Model Init Failed: {e}")
+            return
+        if args.token_patch is None:
+            budget.token_patch = processor_token_patch(processor) or TOKEN_PATCH
+        render = lambda messages: processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        # chat 包装只渲染一次，之后每条只拼接指令文本
+        backend = VLLMBackend(llm, PromptBuilder(render))
+
+    for mode, json_path, data, all_tasks in jobs:
+        run_mode(backend, sampling, mode, json_path, data, all_tasks, args.batch_size, shard, budget,
+                 args.prefetch_workers, args.prefetch_depth, args.guided_json, memo,
+                 {"model": args.api_model or model_path, "max_pixels": args.max_pixels}, not args.no_dedupe)
+        if shard is None:
+            compact_journal(json_path, data)
+        else:
+            print(f"🧩 [{mode}] Shard {args.shard_index + 1}/{args.num_shards} done; "
+                  f"run with --compact after all shards finish")
+
+    if args.backend == "openai":
+        backend.close()
+    if memo is not None:
+        print(f"   Memo: {memo.hits} hits, {memo.misses} misses")
+        memo.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
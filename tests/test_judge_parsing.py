@@ -0,0 +1,170 @@
+"""vlm_judge 的输出解析与打分：logprobs 加权分数、多候选输出、修复 / 重新生成的重试路径"""
+import math
+
+import pytest
+
+from llm_backends import GenerationResult, per_request
+from run_metrics import RunMetrics
+from vlm_judge import (DIRECT_OUTPUT_FORMAT, JudgeSpec, RetryPolicy, generate_parsed, merge_parsed,
+                       parse_direct_output, parse_group_output, score_from_logprobs, settle_failures)
+
+
+# ===================== score_from_logprobs =====================
+
+def test_logprob_score_merges_tokens_with_whitespace():
+    result = GenerationResult("7", logprobs=[{"7": math.log(0.6), "8": math.log(0.3), " 7": math.log(0.1)}])
+    scored = score_from_logprobs(result)
+    assert scored["score"] == 7
+    assert scored["expected_score"] == pytest.approx(7.3)
+    assert scored["confidence"] == pytest.approx(0.7)
+
+
+def test_logprob_score_renormalizes_partial_top_k():
+    # 非数字 token 占去的概率不计入分数分布
+    result = GenerationResult("7", logprobs=[{"7": math.log(0.4), "8": math.log(0.2), "The": math.log(0.3)}])
+    scored = score_from_logprobs(result)
+    assert scored["score"] == 7
+    assert scored["expected_score"] == pytest.approx(22 / 3, abs=1e-4)
+    assert scored["confidence"] == pytest.approx(2 / 3, abs=1e-4)
+    assert set(scored["score_probs"]) == {"7", "8"}
+
+
+def test_logprob_score_splits_one_into_ten_with_second_position():
+    result = GenerationResult("10", logprobs=[{"1": math.log(0.8), "9": math.log(0.2)},
+                                              {"0": math.log(0.75), "<|im_end|>": math.log(0.25)}])
+    scored = score_from_logprobs(result)
+    assert scored["score"] == 10
+    assert scored["score_probs"] == {"1": 0.2, "9": 0.2, "10": 0.6}
+    assert scored["expected_score"] == pytest.approx(0.2 * 1 + 0.2 * 9 + 0.6 * 10)
+
+
+def test_logprob_score_without_second_position_follows_the_other_digits():
+    # 生成的不是 "1"，拿不到 P("0" | "1")："1" 的概率归到其余数字众数所在的一侧
+    high = score_from_logprobs(GenerationResult("9", logprobs=[{"9": math.log(0.6), "1": math.log(0.4)}]))
+    assert high["score_probs"] == {"9": 0.6, "10": 0.4}
+    low = score_from_logprobs(GenerationResult("2", logprobs=[{"2": math.log(0.6), "1": math.log(0.4)}]))
+    assert low["score_probs"] == {"1": 0.4, "2": 0.6}
+
+
+def test_logprob_score_without_digits_is_none():
+    assert score_from_logprobs(GenerationResult("The", logprobs=[{"The": math.log(0.9), "I": math.log(0.1)}])) is None
+
+
+def test_score_from_text_when_logprobs_are_missing():
+    assert score_from_logprobs(GenerationResult("Score: 8")) == {"score": 8, "expected_score": 8.0,
+                                                                 "confidence": None}
+    assert score_from_logprobs(GenerationResult("42")) is None
+    assert score_from_logprobs(GenerationResult("")) is None
+
+
+# ===================== parse_group_output =====================
+
+def group(text, size=3):
+    return parse_group_output(GenerationResult(text), size)
+
+
+def test_group_output_maps_ids_and_leaves_missing_candidates_empty():
+    evals = group('{"candidates": [{"id": 2, "reasoning": "b", "score": 6}, {"id": 1, "score": 4}]}')
+    assert evals == [{"reasoning": None, "score": 4}, {"reasoning": "b", "score": 6}, None]
+
+
+def test_group_output_falls_back_to_position_for_bad_ids():
+    evals = group('{"candidates": [{"score": 1}, {"id": 9, "score": 2}, {"id": "3", "score": 3}]}')
+    assert [e["score"] for e in evals] == [1, 2, 3]
+
+
+def test_group_output_keeps_first_duplicate_and_skips_non_objects():
+    evals = group('{"candidates": ["oops", {"id": 1, "score": 5}, {"id": 1, "score": 9}]}')
+    assert evals[0]["score"] == 5
+    assert evals[1:] == [None, None]
+
+
+def test_group_output_inside_a_code_fence():
+    text = 'Here you go:\n```json\n{"candidates": [{"id": 1, "score": 7}]}\n```'
+    assert group(text, 1) == [{"reasoning": None, "score": 7}]
+
+
+@pytest.mark.parametrize("text", ["not json", '{"candidates": "x"}', '{"scores": [1, 2]}', "[1, 2, 3]",
+                                  '{"candidates": [{"id": 1, "score": 7}'])
+def test_malformed_group_output_is_none(text):
+    assert group(text) is None
+
+
+def test_merge_keeps_existing_candidate_scores():
+    entry = [("candidate", {"test_id": "a"}), ("candidate", {"test_id": "b"})]
+    assert merge_parsed(entry, [{"score": 3}, None], [{"score": 9}, {"score": 5}]) == [{"score": 3}, {"score": 5}]
+    assert merge_parsed(entry, None, [{"score": 9}, None]) == [{"score": 9}, None]
+
+
+# ===================== 修复与重试 =====================
+
+class ScriptedBackend:
+    """
+    script: 条目 (请求文本) -> {"generate": [...], "repair": [...]}，按第几次请求返回预设的 (text, finish_reason)。
+    修复请求 (含 "Judge output:") 按其中的原始输出找回所属条目
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.owner = {text: name for name, steps in script.items() for text, _ in steps["generate"] if text}
+        self.attempts = {}
+        self.sampling = []
+
+    def generate(self, requests, sampling):
+        results = []
+        for messages, params in zip(requests, per_request(sampling, len(requests))):
+            text = "".join(part["text"] for part in messages[0]["content"] if part["type"] == "text")
+            kind = "repair" if "Judge output:" in text else "generate"
+            name = self.owner[text.split("Judge output:")[-1].strip()] if kind == "repair" else text
+            self.attempts[(name, kind)] = self.attempts.get((name, kind), 0) + 1
+            self.sampling.append((name, kind, params["max_tokens"]))
+            output, finish_reason = self.script[name][kind][self.attempts[(name, kind)] - 1]
+            results.append(GenerationResult(output, 10, 5, finish_reason))
+        return results
+
+
+def request(text):
+    return [{"role": "user", "content": [{"type": "text", "text": text}]}]
+
+
+def test_repair_then_regenerate_then_give_up():
+    good = ('{"reasoning": "ok", "score": 8}', "stop")
+    script = {
+        # 第一次就成功
+        "a": {"generate": [good]},
+        # 无法解析的输出经纯文本修复挽回
+        "b": {"generate": [("I would say 6 out of 10", "stop")],
+              "repair": [('{"reasoning": "repaired", "score": 6}', "stop")]},
+        # 被截断，修复也拿不到分数，重新生成成功
+        "c": {"generate": [('{"reasoning": "long', "length"), good],
+              "repair": [('{"reasoning": "long", "score": null}', "stop")]},
+        # 请求出错 (无输出可修复)，重试仍失败
+        "d": {"generate": [("", "error"), ("", "error")]},
+    }
+    backend = ScriptedBackend(script)
+    spec = JudgeSpec(None, {"temperature": 0.1, "max_tokens": 64}, parse_direct_output, None,
+                     RetryPolicy(1, 256, DIRECT_OUTPUT_FORMAT))
+    items = [{"test_id": name} for name in "abcd"]
+    metrics = RunMetrics("judge", "test.json")
+
+    judged, evals = generate_parsed(backend, spec, [request(name) for name in "abcd"], items, metrics)
+    settle_failures(metrics, judged, evals)
+
+    assert [e and e["score"] for e in evals] == [8, 6, 8, None]
+    assert metrics.recovered == {"repair": 1, "regenerate": 1}
+    assert list(metrics.failures) == ["d"]
+    assert metrics.failures["d"]["reason"] == "generation_error"
+    assert metrics.failures["d"]["attempts"] == 2
+    # 重新生成的请求使用 retry.max_tokens，修复不重新生成已成功的条目
+    assert ("c", "generate", 256) in backend.sampling and ("d", "generate", 256) in backend.sampling
+    assert backend.attempts[("a", "generate")] == 1
+
+
+def test_no_retry_policy_records_failures_once():
+    backend = ScriptedBackend({"a": {"generate": [("no json here", "stop")]}})
+    spec = JudgeSpec(None, {"temperature": 0.1, "max_tokens": 64}, parse_direct_output)
+    metrics = RunMetrics("judge", "test.json")
+    _, evals = generate_parsed(backend, spec, [request("a")], [{"test_id": "a"}], metrics)
+    assert evals == [None]
+    assert metrics.failures["a"]["reason"] == "unparsed"
+    assert backend.attempts == {("a", "generate"): 1}
@@ -0,0 +1,180 @@
+"""OpenAIChatBackend 对一个进程内 aiohttp 桩服务器的行为：在途上限、5xx / 超时重试与退避、结果顺序"""
+import asyncio
+import threading
+import time
+
+import pytest
+from aiohttp import web
+
+import llm_backends
+from llm_backends import OpenAIChatBackend
+
+
+class StubServer:
+    """
+    在后台线程的事件循环中运行 /v1/chat/completions 桩服务。
+    handler(text, attempt) 是协程，text 为请求的文本内容，attempt 为同一 text 的第几次请求 (从 1 开始)，
+    返回 (status, content)；content 为 web.Response 时原样返回 (构造不合法的响应体)。
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.attempts = {}
+        self.arrivals = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    async def _chat(self, request):
+        body = await request.json()
+        text = "".join(part["text"] for msg in body["messages"] for part in msg["content"] if part["type"] == "text")
+        self.attempts[text] = self.attempts.get(text, 0) + 1
+        self.arrivals.setdefault(text, []).append(time.monotonic())
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            status, content = await self.handler(text, self.attempts[text])
+        finally:
+            self.in_flight -= 1
+        if isinstance(content, web.Response):
+            return content
+        if status != 200:
+            return web.Response(status=status, text=content)
+        return web.json_response({"choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+                                  "usage": {"prompt_tokens": 10, "completion_tokens": 2}})
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        self._thread.start()
+        port = asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return f"http://127.0.0.1:{port}/v1"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+@pytest.fixture
+def serve():
+    """serve(handler, **backend_kwargs) -> (server, backend)；测试结束时关闭两者"""
+    opened = []
+
+    def start(handler, **kwargs):
+        server = StubServer(handler)
+        backend = OpenAIChatBackend(server.start(), "stub-model", **kwargs)
+        opened.append((server, backend))
+        return server, backend
+
+    yield start
+    for server, backend in opened:
+        backend.close()
+        server.stop()
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    # 退避时间固定为 0.5 * 2^(attempt-1) * 0.5 秒
+    monkeypatch.setattr(llm_backends.random, "random", lambda: 0.0)
+
+
+def text_request(text):
+    return [{"role": "user", "content": [{"type": "text", "text": text}]}]
+
+
+SAMPLING = {"temperature": 0.0, "max_tokens": 8}
+
+
+def test_results_follow_request_order(serve):
+    # 越靠前的请求返回得越晚，结果仍按请求顺序对应
+    async def handler(text, attempt):
+        await asyncio.sleep(0.01 * (20 - int(text)))
+        return 200, f"answer {text}"
+
+    _, backend = serve(handler)
+    results = backend.generate([text_request(str(i)) for i in range(20)], SAMPLING)
+    assert [r.text for r in results] == [f"answer {i}" for i in range(20)]
+    assert all(r.finish_reason == "stop" and r.output_tokens == 2 for r in results)
+
+
+def test_in_flight_bound(serve):
+    async def handler(text, attempt):
+        await asyncio.sleep(0.05)
+        return 200, text
+
+    server, backend = serve(handler, max_in_flight=3)
+    results = backend.generate([text_request(str(i)) for i in range(24)], SAMPLING)
+    assert len(results) == 24
+    assert server.max_in_flight == 3
+
+
+def test_retries_5xx_with_backoff(serve, no_jitter):
+    async def handler(text, attempt):
+        return (503, "busy") if attempt <= 2 else (200, f"ok {text}")
+
+    server, backend = serve(handler, max_retries=3)
+    results = backend.generate([text_request("a"), text_request("b")], SAMPLING)
+    assert [r.text for r in results] == ["ok a", "ok b"]
+    assert server.attempts == {"a": 3, "b": 3}
+    gaps = [later - earlier for earlier, later in zip(server.arrivals["a"], server.arrivals["a"][1:])]
+    assert gaps[0] >= 0.2 and gaps[1] >= 0.45
+
+
+def test_gives_up_after_max_retries(serve, no_jitter):
+    async def handler(text, attempt):
+        return 500, "boom"
+
+    server, backend = serve(handler, max_retries=2)
+    [result] = backend.generate([text_request("a")], SAMPLING)
+    assert result.finish_reason == "error" and result.text == ""
+    assert server.attempts["a"] == 3
+
+
+def test_retries_timeouts(serve, no_jitter):
+    async def handler(text, attempt):
+        if attempt == 1:
+            await asyncio.sleep(1.0)
+        return 200, f"ok {text}"
+
+    server, backend = serve(handler, max_retries=2, timeout=0.3)
+    [result] = backend.generate([text_request("a")], SAMPLING)
+    assert result.text == "ok a"
+    assert server.attempts["a"] == 2
+
+
+def test_client_errors_are_not_retried(serve, no_jitter):
+    async def handler(text, attempt):
+        return 400, "context length exceeded"
+
+    server, backend = serve(handler, max_retries=3)
+    [result] = backend.generate([text_request("a")], SAMPLING)
+    assert result.finish_reason == "error"
+    assert server.attempts["a"] == 1
+
+
+def test_malformed_responses_fail_only_their_item(serve, no_jitter):
+    bodies = {
+        "missing": web.json_response({"usage": {}}),
+        "empty": web.json_response({"choices": []}),
+        "not_json": web.Response(text="<html>gateway</html>", content_type="text/html"),
+        "bad_json": web.Response(text="{\"choices\": [", content_type="application/json"),
+    }
+
+    async def handler(text, attempt):
+        return 200, bodies.get(text, f"ok {text}")
+
+    server, backend = serve(handler, max_retries=3)
+    names = ["good", "missing", "empty", "not_json", "bad_json"]
+    results = backend.generate([text_request(name) for name in names], SAMPLING)
+    assert results[0].text == "ok good" and results[0].finish_reason == "stop"
+    assert all(r.finish_reason == "error" and r.text == "" for r in results[1:])
+    assert all(server.attempts[name] == 1 for name in names)
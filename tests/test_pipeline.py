@@ -0,0 +1,96 @@
+"""pipeline.Pipeline 的调度：只重跑输入签名变化的阶段及受影响的下游，失败阻塞下游，同 group 合并调用"""
+import sys
+
+from pipeline import Pipeline, Stage
+
+# 子进程阶段：读入 argv[1]，把首行写到 argv[2]；FAIL 开头的输入返回非零
+FIRST_LINE = ("import sys\n"
+              "text = open(sys.argv[1], encoding='utf-8').read()\n"
+              "sys.exit(1) if text.startswith('FAIL') else open(sys.argv[2], 'w', encoding='utf-8')"
+              ".write(text.splitlines()[0] + '\\n')")
+# 合并调用：group_args 为若干 (输入, 输出) 对
+COPY_PAIRS = ("import sys, shutil\n"
+              "for src, dst in zip(sys.argv[1::2], sys.argv[2::2]): shutil.copyfile(src, dst)")
+
+
+def first_line_stage(name, src, dst):
+    return Stage(name, [sys.executable, "-c", FIRST_LINE, str(src), str(dst)], [src], [dst])
+
+
+def make_pipeline(tmp_path, stages):
+    return Pipeline(stages, str(tmp_path / "state.json"), str(tmp_path / "logs"), jobs=2)
+
+
+def diamond(tmp_path):
+    """a -> b，c -> d 两条互不相关的链"""
+    for name in ("a", "c"):
+        (tmp_path / f"{name}.txt").write_text(f"{name} first\n{name} second\n", encoding='utf-8')
+    return [
+        first_line_stage("a", tmp_path / "a.txt", tmp_path / "a.out"),
+        first_line_stage("b", tmp_path / "a.out", tmp_path / "b.out"),
+        first_line_stage("c", tmp_path / "c.txt", tmp_path / "c.out"),
+        first_line_stage("d", tmp_path / "c.out", tmp_path / "d.out"),
+    ]
+
+
+def test_only_stages_with_changed_inputs_rerun(tmp_path):
+    stages = diamond(tmp_path)
+    assert make_pipeline(tmp_path, stages).run() == dict.fromkeys("abcd", "done")
+    assert make_pipeline(tmp_path, stages).run() == dict.fromkeys("abcd", "skipped")
+
+    (tmp_path / "a.txt").write_text("a changed\n", encoding='utf-8')
+    status = make_pipeline(tmp_path, stages).run()
+    assert status == {"a": "done", "b": "done", "c": "skipped", "d": "skipped"}
+    assert (tmp_path / "b.out").read_text(encoding='utf-8') == "a changed\n"
+
+
+def test_downstream_skips_when_upstream_output_is_unchanged(tmp_path):
+    stages = diamond(tmp_path)
+    make_pipeline(tmp_path, stages).run()
+    # 只改第二行：a 重跑，但输出内容不变，b 的输入签名按内容计算，不会重跑
+    (tmp_path / "a.txt").write_text("a first\na edited\n", encoding='utf-8')
+    status = make_pipeline(tmp_path, stages).run()
+    assert status == {"a": "done", "b": "skipped", "c": "skipped", "d": "skipped"}
+
+
+def test_missing_output_and_force_rerun_just_that_stage(tmp_path):
+    stages = diamond(tmp_path)
+    make_pipeline(tmp_path, stages).run()
+    (tmp_path / "d.out").unlink()
+    pipeline = make_pipeline(tmp_path, stages)
+    assert pipeline.is_stale("d") == (True, "output missing")
+    assert pipeline.run()["d"] == "done"
+    assert make_pipeline(tmp_path, stages).run(force={"c"}) == {
+        "a": "skipped", "b": "skipped", "c": "done", "d": "skipped"}
+
+
+def test_dry_run_plans_downstream_without_running(tmp_path):
+    stages = diamond(tmp_path)
+    make_pipeline(tmp_path, stages).run()
+    (tmp_path / "c.txt").write_text("c changed\n", encoding='utf-8')
+    status = make_pipeline(tmp_path, stages).run(dry_run=True)
+    assert status == {"a": "skipped", "b": "skipped", "c": "planned", "d": "planned"}
+    assert (tmp_path / "c.out").read_text(encoding='utf-8') == "c first\n"
+
+
+def test_failed_stage_blocks_downstream_and_is_retried(tmp_path):
+    stages = diamond(tmp_path)
+    (tmp_path / "a.txt").write_text("FAIL\n", encoding='utf-8')
+    assert make_pipeline(tmp_path, stages).run() == {"a": "failed", "b": "blocked", "c": "done", "d": "done"}
+    (tmp_path / "a.txt").write_text("a fixed\n", encoding='utf-8')
+    assert make_pipeline(tmp_path, stages).run() == {"a": "done", "b": "done", "c": "skipped", "d": "skipped"}
+
+
+def test_group_members_share_one_call(tmp_path):
+    stages = []
+    for name in ("x", "y"):
+        (tmp_path / f"{name}.txt").write_text(name, encoding='utf-8')
+        src, dst = str(tmp_path / f"{name}.txt"), str(tmp_path / f"{name}.out")
+        stages.append(Stage(name, [sys.executable, "-c", COPY_PAIRS], [src], [dst],
+                            group="copy", group_args=[src, dst]))
+    assert make_pipeline(tmp_path, stages).run() == {"x": "done", "y": "done"}
+    assert [p.name for p in (tmp_path / "logs").iterdir()] == ["pipeline_x+y.log"]
+
+    (tmp_path / "y.txt").write_text("y changed", encoding='utf-8')
+    assert make_pipeline(tmp_path, stages).run() == {"x": "skipped", "y": "done"}
+    assert (tmp_path / "y.out").read_text(encoding='utf-8') == "y changed"
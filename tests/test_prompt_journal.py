@@ -0,0 +1,103 @@
+"""test_prompt_vllm 的 journal：崩溃后回放 (含写了一半的末行) 与分片 journal 的合并"""
+import json
+
+import yaml
+
+import test_prompt_vllm
+from test_prompt_vllm import compact_journal, journal_files, journal_path, replay_journal
+
+
+def record(data, idx, **fields):
+    return json.dumps({"idx": idx, "id": data[idx]["id"], **fields}, ensure_ascii=False) + "\n"
+
+
+def write_source(path, count):
+    data = [{"id": f"item{i}", "first_frame_path": f"f{i}.jpg"} for i in range(count)]
+    path.write_text(json.dumps(data), encoding='utf-8')
+    return data
+
+
+def test_replay_skips_truncated_trailing_line_and_repairs_it(tmp_path):
+    json_path = tmp_path / "drone.json"
+    data = write_source(json_path, 2)
+    journal = journal_path(str(json_path))
+    with open(journal, 'w', encoding='utf-8') as f:
+        f.write(record(data, 0, field="SC1_MOD_1", value="pan left"))
+        f.write(record(data, 0, task="SC1_BATCH"))
+        f.write(record(data, 1, field="SC1_MOD_1", value="tilt up"))
+        # 崩溃时写了一半的末行
+        f.write(record(data, 1, task="SC1_BATCH")[:20])
+
+    completed = replay_journal(data, journal)
+    assert completed == {(0, "SC1_BATCH")}
+    assert data[0]["SC1_MOD_1"] == "pan left" and data[1]["SC1_MOD_1"] == "tilt up"
+
+    # 半行被补上换行，之后追加的记录不会与它粘在一起
+    with open(journal, 'a', encoding='utf-8') as f:
+        f.write(record(data, 1, task="SC1_BATCH"))
+    fresh = json.loads(json_path.read_text(encoding='utf-8'))
+    assert replay_journal(fresh, journal) == {(0, "SC1_BATCH"), (1, "SC1_BATCH")}
+
+
+def test_read_only_replay_leaves_the_journal_untouched(tmp_path):
+    json_path = tmp_path / "drone.json"
+    data = write_source(json_path, 1)
+    journal = journal_path(str(json_path))
+    half = record(data, 0, field="SC1_MOD_1", value="x")[:15]
+    with open(journal, 'w', encoding='utf-8') as f:
+        f.write(half)
+    assert replay_journal(data, journal, repair=False) == set()
+    with open(journal, 'r', encoding='utf-8') as f:
+        assert f.read() == half
+
+
+def test_replay_skips_records_for_other_items(tmp_path):
+    json_path = tmp_path / "drone.json"
+    data = write_source(json_path, 1)
+    journal = journal_path(str(json_path))
+    with open(journal, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({"idx": 0, "id": "another", "field": "SC1_MOD_1", "value": "x"}) + "\n")
+        f.write(json.dumps({"idx": 5, "id": "item5", "task": "SC1_BATCH"}) + "\n")
+    assert replay_journal(data, journal) == set()
+    assert "SC1_MOD_1" not in data[0]
+
+
+def test_compact_merges_unsharded_then_shard_journals(tmp_path, monkeypatch):
+    json_path = tmp_path / "drone.json"
+    data = write_source(json_path, 12)
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump({
+        "paths": {"json_file": str(tmp_path / "metadata.json")}, "models": {"vlm_path": "unused"}}),
+        encoding='utf-8')
+
+    # 先有一次未分片的运行，之后改为 12 个分片重跑 (item0 的结果被 shard0 重新生成)
+    with open(journal_path(str(json_path)), 'w', encoding='utf-8') as f:
+        f.write(record(data, 0, field="SC1_MOD_1", value="old"))
+        f.write(record(data, 0, task="SC1_BATCH"))
+    for shard_index in range(12):
+        with open(journal_path(str(json_path), (shard_index, 12)), 'w', encoding='utf-8') as f:
+            f.write(record(data, shard_index, field="SC1_MOD_1", value=f"shard{shard_index}"))
+            f.write(record(data, shard_index, task="SC1_BATCH"))
+            if shard_index == 3:
+                f.write(record(data, shard_index, field="SC1_MOD_2", value="cut off")[:25])
+    assert journal_files(str(json_path))[0] == journal_path(str(json_path))
+
+    monkeypatch.setattr("sys.argv", ["test_prompt_vllm.py", "--config", str(tmp_path / "config.yaml"),
+                                     "--mode", "drone", "--compact"])
+    test_prompt_vllm.main()
+
+    merged = json.loads(json_path.read_text(encoding='utf-8'))
+    assert [item["SC1_MOD_1"] for item in merged] == [f"shard{i}" for i in range(12)]
+    assert "SC1_MOD_2" not in merged[3]
+    assert journal_files(str(json_path)) == []
+
+
+def test_compact_journal_replaces_the_source_atomically(tmp_path):
+    json_path = tmp_path / "walk.json"
+    data = write_source(json_path, 1)
+    data[0]["SC4_MOD_1"] = "walk forward"
+    with open(journal_path(str(json_path)), 'w', encoding='utf-8') as f:
+        f.write(record(data, 0, field="SC4_MOD_1", value="walk forward"))
+    compact_journal(str(json_path), data)
+    assert json.loads(json_path.read_text(encoding='utf-8'))[0]["SC4_MOD_1"] == "walk forward"
+    assert not (tmp_path / "walk.json.tmp").exists()
+    assert journal_files(str(json_path)) == []
@@ -0,0 +1,119 @@
+"""vlm_judge 的评测流程与输出解析：用假推理后端代替 vLLM，不需要 GPU"""
+import argparse
+import json
+import os
+from functools import partial
+
+from PIL import Image
+
+import vlm_judge
+from llm_backends import GenerationResult, per_request
+from vlm_judge import JudgeSpec, build_judge_input, parse_direct_output
+
+
+class FakeBackend:
+    """respond(messages, params) -> GenerationResult 或文本；calls 记录每次 generate 的请求数"""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = []
+
+    def generate(self, requests, sampling):
+        self.calls.append(len(requests))
+        results = []
+        for messages, params in zip(requests, per_request(sampling, len(requests))):
+            result = self.respond(messages, params)
+            results.append(result if isinstance(result, GenerationResult)
+                           else GenerationResult(result, 10, 5, "stop"))
+        return results
+
+
+def judge_args(**overrides):
+    args = dict(stream=False, window_size=2, prefetch_workers=2, prefetch_depth=1, retry_failed=False,
+                debug=False, columnar=None, num_shards=1, shard_index=0)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def make_testset(root, name, count):
+    """count 个条目，每个条目一张参考图和一张生成图；.jsonl 按行写出"""
+    items = []
+    for i in range(count):
+        ref, gen = root / f"ref{i}.png", root / f"gen{i}.png"
+        Image.new("RGB", (32, 32), (i * 40, 0, 0)).save(ref)
+        Image.new("RGB", (32, 32), (0, i * 40, 0)).save(gen)
+        items.append({"test_id": f"t{i}", "prompt": f"edit {i}",
+                      "first_frame_path": str(ref), "last_frame_path": str(gen)})
+    path = root / name
+    with open(path, 'w', encoding='utf-8') as f:
+        if name.endswith(".jsonl"):
+            f.writelines(json.dumps(item) + "\n" for item in items)
+        else:
+            json.dump(items, f)
+    return str(path)
+
+
+def direct_spec():
+    return JudgeSpec(build_judge_input, {"temperature": 0.1, "max_tokens": 64}, parse_direct_output)
+
+
+def test_in_memory_jsonl_output_is_one_object_per_line(tmp_path):
+    input_json = make_testset(tmp_path, "set.jsonl", 2)
+    backend = FakeBackend(lambda messages, params: '{"reasoning": "ok", "score": 7}')
+    vlm_judge.judge_dataset(backend, direct_spec(), input_json, judge_args())
+
+    output_file = vlm_judge.judged_output_path(input_json)
+    assert output_file.endswith("_judged_direct.jsonl")
+    with open(output_file, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 2
+    items = list(vlm_judge.iter_test_items(output_file))
+    assert [item["test_id"] for item in items] == ["t0", "t1"]
+    assert all(item["eval_direct"]["score"] == 7 for item in items)
+    assert vlm_judge.previous_scores(output_file).keys() == {"t0", "t1"}
+
+
+def test_build_jsonl_testset_round_trips_through_judge(tmp_path, monkeypatch):
+    import build
+
+    frames = tmp_path / "frames" / "d0"
+    frames.mkdir(parents=True)
+    Image.new("RGB", (32, 32)).save(tmp_path / "ref.jpg")
+    for key in ("SC1_MOD_1", "SC1_MOD_2", "SC2_MOD_1"):
+        Image.new("RGB", (32, 32), (255, 0, 0)).save(frames / f"{key}.jpg")
+    source = [{"id": "d0", "last_frame_path": str(frames), "first_frame_path": str(tmp_path / "ref.jpg"),
+               "SC1_MOD_1": "pan left", "SC1_MOD_2": "tilt up", "SC2_MOD_1": "desert", "SC2_MOD_2": "missing"}]
+    (tmp_path / "drone.json").write_text(json.dumps(source), encoding='utf-8')
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("sys.argv", ["build.py", "--mode", "drone", "--source_json", "drone.json",
+                                     "--image_dir", ".", "--output_path", "drone_testset.jsonl"])
+    build.main()
+    with open(tmp_path / "results" / "exp_unified" / "logs" / "drone.json", 'r', encoding='utf-8') as f:
+        log = json.load(f)
+    assert log["total_count"] == 3 and len(log["items"]) == 3
+
+    backend = FakeBackend(lambda messages, params: '{"reasoning": "ok", "score": 5}')
+    vlm_judge.judge_dataset(backend, direct_spec(), "drone_testset.jsonl", judge_args())
+    items = list(vlm_judge.iter_test_items(vlm_judge.judged_output_path("drone_testset.jsonl")))
+    assert sorted(item["test_id"] for item in items) == ["d0_SC1_MOD_1", "d0_SC1_MOD_2", "d0_SC2_MOD_1"]
+    assert all(item["eval_direct"]["score"] == 5 for item in items)
+
+
+def test_queue_dir_skips_sidecar_files(tmp_path):
+    make_testset(tmp_path, "a.json", 1)
+    make_testset(tmp_path, "b.jsonl", 1)
+    sidecars = ["b_delta.jsonl", "b_delta.manifest.json", "a_delta.json", "a_delta.manifest.json",
+                "a_judged_direct.manifest.json", "drone_prompt_gen.report.json", "drone.json.journal.jsonl",
+                "b_judged_direct.jsonl.ckpt.jsonl", "notes.txt"]
+    for name in sidecars:
+        (tmp_path / name).write_text("{}", encoding='utf-8')
+
+    pending = vlm_judge.pending_queue_files(str(tmp_path), set())
+    assert [os.path.basename(path) for path in pending] == ["a.json", "b.jsonl"]
+
+    # 已有更新的结果的测试集不再返回
+    backend = FakeBackend(lambda messages, params: '{"reasoning": "ok", "score": 3}')
+    vlm_judge.judge_dataset(backend, direct_spec(), str(tmp_path / "a.json"), judge_args())
+    pending = vlm_judge.pending_queue_files(str(tmp_path), set())
+    assert [os.path.basename(path) for path in pending] == ["b.jsonl"]
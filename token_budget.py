@@ -0,0 +1,102 @@
+import math
+from PIL import Image
+
+# 每个视觉 token 覆盖的像素边长 = patch 大小 x 合并窗口：
+# Qwen3-VL 为 16px patch 再 2x2 合并 (32)，Qwen2-VL / Qwen2.5-VL 为 14px patch 再 2x2 合并 (28)
+TOKEN_PATCH = 32
+# 每张图额外的 <|vision_start|> / <|vision_end|>
+IMAGE_SPECIAL_TOKENS = 2
+# 没有 tokenizer 时按字符数粗估文本 token；英文约 4 字符/token，取 3 留出余量
+CHARS_PER_TOKEN = 3
+
+
+def budget_size(width, height, max_pixels):
+    """等比缩放到不超过 max_pixels 像素后的尺寸；已在预算内则原样返回"""
+    if not max_pixels or width * height <= max_pixels:
+        return width, height
+    scale = (max_pixels / float(width * height)) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def estimate_image_tokens(width, height, max_pixels=None, token_patch=TOKEN_PATCH):
+    """按处理器的缩放规则 (像素预算 + 边长取整到 token_patch 的倍数) 估计一张图的视觉 token 数"""
+    width, height = budget_size(width, height, max_pixels)
+    w = max(token_patch, round(width / token_patch) * token_patch)
+    h = max(token_patch, round(height / token_patch) * token_patch)
+    return (w // token_patch) * (h // token_patch) + IMAGE_SPECIAL_TOKENS
+
+
+def processor_token_patch(processor):
+    """从 HF 处理器读取每个视觉 token 的像素边长 (patch_size x merge_size)；读不到时返回 None"""
+    image_processor = getattr(processor, "image_processor", processor)
+    patch = getattr(image_processor, "patch_size", None)
+    merge = getattr(image_processor, "merge_size", None)
+    if isinstance(patch, int) and isinstance(merge, int):
+        return patch * merge
+    return None
+
+
+def estimate_text_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def image_size(path):
+    """只读文件头取得图片尺寸，不解码像素"""
+    with Image.open(path) as img:
+        return img.size
+
+
+class TokenBudget:
+    """
+    请求的 token 估算与按预算分批。
+
+    - max_model_len / max_output_tokens：估计的提示词 token 数加上最大生成长度超过上下文的请求直接拒绝，
+      避免整个批次在引擎里报错
+    - batch_tokens：每个 generate 批次的提示词 token 预算；为 None 时不切分
+    - max_pixels：与图片缩放一致的像素预算，用于从原图尺寸估计视觉 token
+    - token_patch：每个视觉 token 覆盖的像素边长 (取决于模型，见 TOKEN_PATCH)
+    """
+
+    def __init__(self, max_model_len, max_output_tokens, batch_tokens=None, max_pixels=None,
+                 token_patch=TOKEN_PATCH):
+        self.max_model_len = max_model_len
+        self.max_output_tokens = max_output_tokens
+        self.batch_tokens = batch_tokens
+        self.max_pixels = max_pixels
+        self.token_patch = token_patch
+
+    def request_tokens(self, messages):
+        """估计一条 messages 请求 (图片为 PIL.Image) 的提示词 token 数"""
+        tokens = 0
+        for msg in messages:
+            for part in msg["content"]:
+                if part["type"] == "image":
+                    tokens += estimate_image_tokens(*part["image"].size, self.max_pixels, self.token_patch)
+                else:
+                    tokens += estimate_text_tokens(part["text"])
+        return tokens
+
+    def fits(self, prompt_tokens, output_tokens=None):
+        """output_tokens 为该请求实际预留的生成长度，默认 max_output_tokens"""
+        return prompt_tokens + (self.max_output_tokens if output_tokens is None else output_tokens) <= self.max_model_len
+
+    def batches(self, items, cost_fn, max_items=None):
+        """
+        按估计 token 数从大到小排序后贪心装箱：相近长度的请求在同一批，
+        每批提示词 token 之和不超过 batch_tokens (单条超出预算的请求单独成批)。
+        返回批次列表，每批为 items 中元素的列表。
+        """
+        costs = [cost_fn(item) for item in items]
+        order = sorted(range(len(items)), key=lambda i: costs[i], reverse=True)
+
+        batches, current, current_tokens = [], [], 0
+        for i in order:
+            full = self.batch_tokens and current_tokens + costs[i] > self.batch_tokens
+            if current and (full or (max_items and len(current) >= max_items)):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(items[i])
+            current_tokens += costs[i]
+        if current:
+            batches.append(current)
+        return batches
@@ -1,11 +1,27 @@
 import os
+import sys
 import json
 import yaml
 import argparse
 import re
-import torch
-from PIL import Image
-from vllm import LLM, SamplingParams
+import math
+import textwrap
+import time
+import hashlib
+from collections import namedtuple
+from functools import partial, lru_cache
+from itertools import islice
+from image_prefetch import load_rgb, prefetch
+from image_cache import ImageCache, resize_to_budget
+from run_metrics import RunMetrics
+from results_store import columnar_path, write_columnar
+from llm_backends import VLLMBackend, OpenAIChatBackend, message_images, render_plain_chat, per_request
+from prompt_builder import PromptBuilder
+from token_budget import TokenBudget, TOKEN_PATCH, image_size
+from json_schemas import judge_schema, group_schema
+from prefilter import PixelPrefilter, Prefiltered
+from result_cache import ResultCache, cache_key
+from build import delta_paths, save_manifest
 
 # Qwen2-VL / Qwen3-VL 标准图像占位符
 IMAGE_PLACEHOLDER = "<|vision_start|><|image_pad|><|vision_end|>"
@@ -40,6 +56,105 @@ Output JSON format ONLY:
 }}
 """
 
+# 前缀优先布局：静态指令 (每条都相同) 放在图片之前，vLLM 的 prefix cache 可在整个批次复用，
+# 每条不同的编辑指令放在图片之后。--legacy_prompt_layout 可恢复上面的原始布局。
+# 由原始模板派生，两种布局的评测标准始终一致
+DIRECT_SCORE_INSTRUCTIONS = DIRECT_SCORE_TEMPLATE.replace('"{prompt}"', "given after the images.") \
+    .replace("{{", "{").replace("}}", "}")
+
+DIRECT_SCORE_ITEM_TEMPLATE = 'Editing Instruction: "{prompt}"'
+
+# 仅打分模式 (--score_only)：不输出 reasoning，直接从第一个生成 token 的 logprobs 读分数
+SCORE_ONLY_INSTRUCTIONS = DIRECT_SCORE_INSTRUCTIONS.split("Output JSON format ONLY:")[0] + \
+    "Output ONLY the score of Image 2 as a single integer from 0 to 10, with no other text.\n"
+
+# 多候选模式 (--group_size)：一张参考图 + 同一参考图的 K 个编辑结果放进同一条请求，
+# 参考图的视觉 token 只编码、prefill 一次。每个候选后面跟它自己的编辑指令
+GROUP_SCORE_INSTRUCTIONS = """
+Role: Professional Image Editing Judge.
+
+Input:
+- Reference: Original Image (Real Photograph).
+- Candidate 1..N: AI Generated/Edited Images, each produced from the Reference with its OWN Editing Instruction
+  (given right after that candidate).
+
+Task: Evaluate EACH candidate independently, based on how well it executes its own instruction relative to the Reference.
+Do NOT compare candidates with each other; other candidates' instructions do not apply.
+
+Evaluation Criteria (for each candidate):
+1. Instruction Adherence: Did the requested change happen in the candidate?
+2. Consistency: Are the un-edited parts of the candidate consistent with the Reference?
+3. Visual Quality: Rate the realism and quality of the candidate.
+
+IMPORTANT: 
+- The Reference is a real photo and has perfect quality. DO NOT let its quality bias the candidates' scores.
+- If a candidate is blurry, distorted, or fails its prompt, give it a low score even if the Reference looks good.
+- Each score represents the quality and success of that candidate ONLY.
+
+Output JSON format ONLY, one entry per candidate in order:
+{
+    "candidates": [
+        {"id": 1, "reasoning": "Brief analysis of Candidate 1 against its instruction and the Reference...", "score": <0-10 integer>},
+        ...
+    ]
+}
+"""
+
+GROUP_CANDIDATE_TEMPLATE = 'Candidate {index} Editing Instruction: "{prompt}"'
+
+# 多候选模式下每个候选预留的生成 token 数 (reasoning 要求简短)
+GROUP_OUTPUT_TOKENS_PER_CANDIDATE = 512
+
+# 纯文本 JSON 修复：把无法解析 / 不完整的原始输出交给模型改写成规定格式，不带图片，远比重新评测便宜
+REPAIR_TEMPLATE = """
+The text below is the output of an image editing judge. It should be valid JSON, but it is malformed or incomplete.
+Rewrite it as valid JSON in exactly this format:
+{format}
+Keep the judge's own reasoning and scores. Do NOT invent a score that the text does not state; use null instead.
+Output the JSON ONLY.
+
+Judge output:
+{output}
+"""
+
+# 修复时要求的输出格式，直接取自对应评测模板
+DIRECT_OUTPUT_FORMAT = DIRECT_SCORE_INSTRUCTIONS.split("Output JSON format ONLY:")[1]
+GROUP_OUTPUT_FORMAT = GROUP_SCORE_INSTRUCTIONS.split("Output JSON format ONLY, one entry per candidate in order:")[1]
+
+# 模板版本：全部模板文本的 hash，修改任何模板后旧的评测缓存自动失效
+TEMPLATE_VERSION = hashlib.sha1("\n".join([
+    DIRECT_SCORE_TEMPLATE, DIRECT_SCORE_INSTRUCTIONS, DIRECT_SCORE_ITEM_TEMPLATE, SCORE_ONLY_INSTRUCTIONS,
+    GROUP_SCORE_INSTRUCTIONS, GROUP_CANDIDATE_TEMPLATE, REPAIR_TEMPLATE,
+]).encode("utf-8")).hexdigest()[:12]
+
+# 一种评测方式：请求构造 (item -> messages)、采样参数、输出解析 (GenerationResult -> eval 结果)，
+# 以及可选的 token 预算 (token_budget.TokenBudget：超长请求拒绝、按预算分批) 和失败重试策略 (RetryPolicy)
+JudgeSpec = namedtuple("JudgeSpec", ["build_input", "sampling", "parse_output", "budget", "retry"],
+                       defaults=[None, None])
+
+# 失败重试：最多 max_retries 轮重新生成，max_tokens 为重试时的生成长度 (None 沿用原值)，
+# repair_format 为纯文本 JSON 修复要求的格式 (None 不做修复，例如从 logprobs 读分数的 score-only)
+RetryPolicy = namedtuple("RetryPolicy", ["max_retries", "max_tokens", "repair_format"])
+
+# 两级评测：screen (JudgeSpec，便宜的初筛) 给所有条目打分，只有初筛分落在 band=(low, high) 内
+# 或初筛失败的条目再走 full (JudgeSpec，完整 reasoning)。build_input 同时构造两级的 messages；
+# screen_backend 为 None 时两级共用同一个推理后端
+CascadeSpec = namedtuple("CascadeSpec", ["build_input", "screen", "full", "band", "screen_backend"],
+                         defaults=[None])
+
+# 多候选评测：build_input 把每个条目构造成 Candidate，按参考图分组后每组最多 group_size 个候选
+# 合成一条请求 (受 budget 的上下文长度约束)，parse_output 返回与组内候选对齐的 eval 列表。
+# sampling["max_tokens"] 与 budget.max_output_tokens 都按单个候选计，每条请求按组内实际候选数预留
+GroupedSpec = namedtuple("GroupedSpec", ["build_input", "sampling", "parse_output", "budget", "group_size", "retry"],
+                         defaults=[None])
+Candidate = namedtuple("Candidate", ["ref_path", "ref_image", "gen_image", "prompt"])
+
+# 持久化评测缓存：build_input 对命中的条目返回 Cached (不解码图片)，其余返回 CacheMiss，
+# 未命中的条目交给 inner (JudgeSpec / CascadeSpec) 评测，有分数的结果写回 cache (result_cache.ResultCache)
+CachedSpec = namedtuple("CachedSpec", ["build_input", "inner", "cache"])
+Cached = namedtuple("Cached", ["eval"])
+CacheMiss = namedtuple("CacheMiss", ["key", "input"])
+
 
 def load_config(config_path):
     with open(config_path, 'r') as f:
@@ -66,104 +181,1260 @@ def extract_json(text):
     return None
 
 
+def iter_test_items(path):
+    """逐条读取测试集：.jsonl 按行流式读取，.json 整体加载后逐条返回"""
+    if path.endswith(".jsonl"):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+
+
+def select_items(input_json, limit=None, shard=None):
+    """
+    按 (shard_index, num_shards) 轮转取出本分片的条目，再截取前 limit 条。
+    轮转分片让各副本的条目数与难度分布接近，合并时也只需按原顺序回填。
+    """
+    items = iter_test_items(input_json)
+    if shard is not None:
+        shard_index, num_shards = shard
+        items = islice(items, shard_index, None, num_shards)
+    return islice(items, limit)
+
+
+def build_judge_input(item, load_image=load_rgb, legacy_layout=False, score_only=False):
+    """构造单条评测请求 (messages)；生成图缺失时返回 None，图片解码失败时抛出异常"""
+    gen_path = item.get('last_frame_path')
+    ref_path = item.get('first_frame_path')
+
+    if not gen_path or not os.path.exists(gen_path):
+        print(f"⚠️ Generated image missing: {gen_path}")
+        return None
+
+    img_gen = load_image(gen_path)
+
+    if ref_path and os.path.exists(ref_path):
+        img_ref = load_image(ref_path)
+        content = [
+            {"type": "text", "text": "Image 1 (Ref): "},
+            {"type": "image", "image": img_ref},
+            {"type": "text", "text": "\nImage 2 (Gen): "},
+            {"type": "image", "image": img_gen},
+        ]
+    else:
+        content = [
+            {"type": "text", "text": "Image 2 (Gen): "},
+            {"type": "image", "image": img_gen},
+        ]
+
+    if score_only:
+        content[0] = {"type": "text", "text": SCORE_ONLY_INSTRUCTIONS + "\n" + content[0]["text"]}
+        content.append({"type": "text", "text": "\n" + DIRECT_SCORE_ITEM_TEMPLATE.format(prompt=item['prompt'])})
+    elif legacy_layout:
+        text_direct = DIRECT_SCORE_TEMPLATE.format(prompt=item['prompt'])
+        content.append({"type": "text", "text": f"\n{text_direct}"})
+    else:
+        content[0] = {"type": "text", "text": DIRECT_SCORE_INSTRUCTIONS + "\n" + content[0]["text"]}
+        content.append({"type": "text", "text": "\n" + DIRECT_SCORE_ITEM_TEMPLATE.format(prompt=item['prompt'])})
+
+    return [{"role": "user", "content": content}]
+
+
+def build_candidate_input(item, load_image=load_rgb, load_ref=None):
+    """多候选模式的单个候选；load_ref 可缓存参考图 (同一参考图的兄弟条目共用)，生成图缺失时返回 None"""
+    gen_path = item.get('last_frame_path')
+    ref_path = item.get('first_frame_path')
+
+    if not gen_path or not os.path.exists(gen_path):
+        print(f"⚠️ Generated image missing: {gen_path}")
+        return None
+
+    img_gen = load_image(gen_path)
+    if ref_path and os.path.exists(ref_path):
+        return Candidate(ref_path, (load_ref or load_image)(ref_path), img_gen, item['prompt'])
+    return Candidate(None, None, img_gen, item['prompt'])
+
+
+def build_group_messages(candidates):
+    """一张参考图 + 若干候选合成一条请求：静态指令在前，每个候选后面跟它自己的编辑指令"""
+    content = [{"type": "text", "text": GROUP_SCORE_INSTRUCTIONS + "\n"}]
+    if candidates[0].ref_image is not None:
+        content += [{"type": "text", "text": "Reference: "},
+                    {"type": "image", "image": candidates[0].ref_image}]
+    for index, candidate in enumerate(candidates, 1):
+        content += [
+            {"type": "text", "text": f"\nCandidate {index}: "},
+            {"type": "image", "image": candidate.gen_image},
+            {"type": "text", "text": "\n" + GROUP_CANDIDATE_TEMPLATE.format(index=index, prompt=candidate.prompt)},
+        ]
+    return [{"role": "user", "content": content}]
+
+
+def build_cascade_input(item, load_image=load_rgb, screen_max_pixels=None, legacy_layout=False):
+    """两级评测的输入：{"screen": 低分辨率 score-only 请求, "full": 完整评测请求}，图片只解码一次"""
+    images = {}
+
+    def load_once(path):
+        if path not in images:
+            images[path] = load_image(path)
+        return images[path]
+
+    full = build_judge_input(item, load_once, legacy_layout=legacy_layout)
+    if full is None:
+        return None
+    screen = build_judge_input(item, lambda path: resize_to_budget(load_once(path), screen_max_pixels),
+                               score_only=True)
+    return {"screen": screen, "full": full}
+
+
+def build_prefiltered_input(item, build_input, prefilter, load_image=load_rgb):
+    """像素预过滤：明显无效的生成图直接返回 Prefiltered 判定，其余照常构造评测请求 (图片只解码一次)"""
+    gen_path = item.get('last_frame_path')
+    ref_path = item.get('first_frame_path')
+    if not gen_path or not os.path.exists(gen_path):
+        return build_input(item)
+
+    try:
+        img_gen = load_image(gen_path)
+    except (OSError, SyntaxError, ValueError) as e:
+        return prefilter.corrupt(e)
+    img_ref = load_image(ref_path) if ref_path and os.path.exists(ref_path) else None
+
+    verdict = prefilter.check(img_gen, img_ref)
+    if verdict is not None:
+        return verdict
+    images = {path: img for path, img in ((gen_path, img_gen), (ref_path, img_ref)) if img is not None}
+    return build_input(item, load_image=lambda path: images[path] if path in images else load_image(path))
+
+
+def judgment_key(item, cache, fingerprint):
+    """评测缓存 key：两张图的文件内容 hash + 编辑指令 + 评测配置指纹 (模型、采样参数、模板版本等)"""
+    ref_path = item.get('first_frame_path')
+    ref_digest = cache.digest(ref_path) if ref_path and os.path.exists(ref_path) else None
+    return cache_key(fingerprint, cache.digest(item['last_frame_path']), ref_digest, item['prompt'])
+
+
+def build_cached_input(item, build_input, cache, fingerprint):
+    """先查评测缓存：命中返回 Cached，未命中照常构造请求并带上 key 以便写回"""
+    gen_path = item.get('last_frame_path')
+    if not gen_path or not os.path.exists(gen_path):
+        return build_input(item)
+
+    key = judgment_key(item, cache, fingerprint)
+    cached = cache.get(key)
+    if cached is not None:
+        return Cached(cached)
+    judge_input = build_input(item)
+    return None if judge_input is None else CacheMiss(key, judge_input)
+
+
+def judge_fingerprint(args, judge_cfg, spec):
+    """决定评测结果的配置：任何一项变化都会使缓存 key 变化"""
+    fingerprint = {
+        "template_version": TEMPLATE_VERSION,
+        "model": (args.api_model if args.backend == "openai" else None) or judge_cfg.get('model_path'),
+        "sampling": (spec.full if isinstance(spec, CascadeSpec) else spec).sampling,
+        "score_only": args.score_only,
+        "legacy_layout": args.legacy_prompt_layout,
+        "max_pixels": args.max_pixels,
+        "group_size": args.group_size,
+        # 重试 / 修复决定失败条目最终拿到的结果
+        "retry": {"failure_retries": args.failure_retries, "retry_max_tokens": args.retry_max_tokens,
+                  "no_repair": args.no_repair},
+    }
+    if args.cascade:
+        fingerprint["cascade"] = {"band": list(args.cascade_band), "screen_max_pixels": args.screen_max_pixels,
+                                  "screen_model": args.screen_api_model or judge_cfg.get('screen_model_path')}
+    if args.prefilter:
+        fingerprint["prefilter_score"] = args.prefilter_score
+    return fingerprint
+
+
+def parse_direct_output(result):
+    return extract_json(result.text)
+
+
+def parse_group_output(result, group_size):
+    """多候选输出 -> 长度为 group_size 的 eval 列表 (按 id 对应，缺少 id 时按顺序)；整体无法解析时返回 None"""
+    parsed = extract_json(result.text)
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("candidates"), list):
+        return None
+    evals = [None] * group_size
+    for position, entry in enumerate(parsed["candidates"]):
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get("id")
+        index = index - 1 if isinstance(index, int) and 1 <= index <= group_size else position
+        if index < group_size and evals[index] is None:
+            evals[index] = {"reasoning": entry.get("reasoning"), "score": entry.get("score")}
+    return evals
+
+
+def _token_probs(position):
+    """同一数字可能对应多个 token (如 "7" 与 " 7")，按去空白后的文本合并概率"""
+    probs = {}
+    for token, logprob in position.items():
+        key = (token or "").strip()
+        probs[key] = probs.get(key, 0.0) + math.exp(logprob)
+    return probs
+
+
+def score_from_logprobs(result):
+    """
+    从生成 token 的 logprobs 计算 0-10 分的分布，返回 argmax 分数、期望分数与置信度。
+
+    Qwen 系列 tokenizer 把数字逐位切分，"10" 是 "1" + "0" 两个 token：
+    当首 token 生成的是 "1" 时，用第二个位置的 P("0" | "1") 把 "1" 的概率拆成 1 分和 10 分；
+    否则无法得到条件概率，"1" 的概率按其余数字的众数归到更接近的一侧 (>=5 归 10 分，否则归 1 分)。
+    """
+    if not result.logprobs:
+        match = re.search(r'\d+', result.text or "")
+        if not match or int(match.group()) > 10:
+            return None
+        score = int(match.group())
+        return {"score": score, "expected_score": float(score), "confidence": None}
+
+    first = _token_probs(result.logprobs[0])
+    probs = {s: first.get(str(s), 0.0) for s in range(10)}
+    probs[10] = 0.0
+    p_one = probs[1]
+    if p_one > 0:
+        if (result.text or "").strip().startswith("1") and len(result.logprobs) > 1:
+            p_ten = p_one * _token_probs(result.logprobs[1]).get("0", 0.0)
+        else:
+            others = max((s for s in range(10) if s != 1), key=lambda s: probs[s])
+            p_ten = p_one if others >= 5 else 0.0
+        probs[1], probs[10] = p_one - p_ten, p_ten
+
+    total = sum(probs.values())
+    if total <= 0:
+        return None
+    probs = {s: p / total for s, p in probs.items()}
+    score = max(probs, key=probs.get)
+    return {
+        "score": score,
+        "expected_score": round(sum(s * p for s, p in probs.items()), 4),
+        "confidence": round(probs[score], 4),
+        "score_probs": {str(s): round(p, 4) for s, p in probs.items() if p >= 1e-4},
+    }
+
+
+def render_judge_prompt(messages):
+    """vLLM 后端的提示词：<|user|>\n{图片占位符}\n{评测模板}\n<|assistant|>\n"""
+    return render_plain_chat(messages, IMAGE_PLACEHOLDER)
+
+
+def collect_prefetched(results, metrics=None):
+    """整理预取结果：按 test_id 报告解码错误 (并记入 metrics 的失败列表)，返回 (inputs, items)"""
+    inputs, items = [], []
+    for item, judge_input, error in results:
+        if error is not None:
+            print(f"❌ Error loading images for {item.get('test_id')}: {error}")
+            if metrics:
+                metrics.record_failure(item.get('test_id'), "decode_error", str(error))
+        elif judge_input is not None:
+            inputs.append(judge_input)
+            items.append(item)
+        elif metrics:
+            metrics.record_failure(item.get('test_id'), "missing_image", item.get('last_frame_path'))
+    return inputs, items
+
+
+def has_score(eval_direct):
+    return isinstance(eval_direct, dict) and eval_direct.get("score") is not None
+
+
+def entry_items(entry):
+    """批次中的一个请求对应的条目：普通请求为条目本身，多候选请求为 [(candidate, item), ...]"""
+    return [item for _, item in entry] if isinstance(entry, list) else [entry]
+
+
+def settle_failures(metrics, items, evals):
+    """一个窗口评测完后：有分数的条目从失败列表移除，没有分数且未记录原因的记为 no_score"""
+    for item, eval_direct in zip(items, evals):
+        if has_score(eval_direct):
+            metrics.clear_failure(item['test_id'])
+        elif item['test_id'] not in metrics.failures:
+            metrics.record_failure(item['test_id'], "no_score")
+
+
+# ===================== Streaming / Checkpoint =====================
+
+def load_checkpoint(ckpt_path):
+    """读取 checkpoint (JSONL)，返回 {test_id: eval_direct}；崩溃时写了一半的末行会被忽略"""
+    done = {}
+    if not os.path.exists(ckpt_path):
+        return done
+    with open(ckpt_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[rec['test_id']] = rec.get('eval_direct')
+    return done
+
+
+def write_results(input_json, done, output_file, limit=None, shard=None):
+    """按输入顺序回填 checkpoint 中的结果并逐条写出"""
+    def backfilled():
+        for item in select_items(input_json, limit, shard):
+            if item.get('test_id') in done:
+                item['eval_direct'] = done[item['test_id']]
+            yield item
+    return write_items(output_file, backfilled())
+
+
+def write_items(output_file, items):
+    """逐条写出结果：.jsonl 每行一个条目，.json 为 indent=4 的列表；先写临时文件再原子替换，返回条目数"""
+    is_jsonl = output_file.endswith(".jsonl")
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        count = 0
+        for item in items:
+            if is_jsonl:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            else:
+                # 与 json.dump(indent=4) 的列表格式保持一致
+                f.write(",\n" if count else "[\n")
+                f.write(textwrap.indent(json.dumps(item, indent=4, ensure_ascii=False), " " * 4))
+            count += 1
+        if not is_jsonl:
+            f.write("\n]" if count else "[]")
+    os.replace(tmp_file, output_file)
+    return count
+
+
+def output_slots(entry):
+    """一条请求要生成几份评测：多候选请求 (条目列表) 为组内候选数"""
+    return len(entry) if isinstance(entry, list) else 1
+
+
+def request_sampling(spec, entries):
+    """
+    一批请求的采样参数：多候选请求的 max_tokens 与 JSON schema (--guided_json) 按该组实际的候选数，
+    schema 要求恰好输出组内的候选数 (返回与请求对应的列表)
+    """
+    if not isinstance(spec, GroupedSpec):
+        return spec.sampling
+    sampling = []
+    for entry in entries:
+        params = dict(spec.sampling, max_tokens=spec.sampling["max_tokens"] * len(entry))
+        if "json_schema" in spec.sampling:
+            params["json_schema"] = group_schema(len(entry))
+        sampling.append(params)
+    return sampling
+
+
+def schedule_batches(spec, inputs, items, metrics=None):
+    """
+    按 spec.budget 估计每条请求的 token 数：超出上下文的请求报告后跳过 (并记入 metrics 的失败列表)，
+    其余按长度排序并按批次 token 预算切分。返回 [(inputs, items), ...]
+    """
+    if spec.budget is None:
+        return [(inputs, items)] if inputs else []
+
+    requests = []
+    for messages, item in zip(inputs, items):
+        tokens = spec.budget.request_tokens(messages)
+        output_tokens = spec.budget.max_output_tokens * output_slots(item)
+        if spec.budget.fits(tokens, output_tokens):
+            requests.append((tokens, messages, item))
+        else:
+            test_ids = [i.get('test_id') for i in entry_items(item)]
+            detail = (f"~{tokens} prompt tokens + {output_tokens} output tokens "
+                      f"exceed max_model_len={spec.budget.max_model_len}")
+            print(f"❌ Skipping {', '.join(map(str, test_ids))}: {detail}")
+            for test_id in test_ids if metrics else []:
+                metrics.record_failure(test_id, "context_overflow", detail)
+    return [([r[1] for r in batch], [r[2] for r in batch])
+            for batch in spec.budget.batches(requests, lambda r: r[0])]
+
+
+def generate_timed(backend, spec, inputs, items, metrics):
+    """
+    分批调用推理后端并把每批的耗时、token 数计入 metrics。
+    返回 (items, outputs)：两者对齐，超出上下文被跳过的条目不在其中。
+    """
+    judged_items, outputs = [], []
+    for batch_inputs, batch_items in schedule_batches(spec, inputs, items, metrics):
+        with metrics.stage("generate"):
+            t0 = time.perf_counter()
+            batch_outputs = backend.generate(batch_inputs, request_sampling(spec, batch_items))
+        metrics.record_batch(batch_outputs, time.perf_counter() - t0,
+                             images=[len(message_images(m)) for m in batch_inputs],
+                             item_ids=[[i.get('test_id') for i in entry_items(entry)] for entry in batch_items])
+        judged_items.extend(batch_items)
+        outputs.extend(batch_outputs)
+    return judged_items, outputs
+
+
+def parse_timed(spec, output, metrics):
+    with metrics.stage("parse"):
+        parsed = spec.parse_output(output)
+    metrics.record_parse(parsed is not None)
+    return parsed
+
+
+def entry_complete(entry, parsed):
+    """一个请求的解析结果是否完整：普通请求要有分数，多候选请求要每个候选都有分数"""
+    if isinstance(entry, list):
+        return parsed is not None and all(has_score(e) for e in parsed[:len(entry)])
+    return has_score(parsed)
+
+
+def merge_parsed(entry, old, new):
+    """重试 / 修复的结果与已有结果合并：多候选请求逐个候选保留已有的有效结果"""
+    if isinstance(entry, list):
+        if old is None or new is None:
+            return new if old is None else old
+        return [o if has_score(o) else n for o, n in zip(old, new)]
+    return new if has_score(new) or old is None else old
+
+
+def failure_reason(output, parsed):
+    if output.finish_reason == "error":
+        return "generation_error"
+    if output.finish_reason == "length":
+        return "truncated"
+    return "unparsed" if parsed is None else "no_score"
+
+
+def record_entry_failure(metrics, entry, output, parsed):
+    """把一个失败请求记入失败列表 (多候选请求只记没有分数的候选)，detail 为原始输出开头"""
+    reason, detail = failure_reason(output, parsed), (output.text or "")[:200]
+    if isinstance(entry, list):
+        evals = parsed or [None] * len(entry)
+        for (_, item), eval_direct in zip(entry, evals):
+            if not has_score(eval_direct):
+                metrics.record_failure(item.get('test_id'), reason, detail)
+    else:
+        metrics.record_failure(entry.get('test_id'), reason, detail)
+
+
+def repair_outputs(backend, spec, outputs, entries, metrics):
+    """纯文本 JSON 修复：原始输出 + 目标格式，不带图片，用原解析函数解析修复结果"""
+    requests = [[{"role": "user", "content": [{"type": "text", "text": REPAIR_TEMPLATE.format(
+        format=spec.retry.repair_format, output=output.text)}]}] for output in outputs]
+    with metrics.stage("repair"):
+        t0 = time.perf_counter()
+        sampling = []
+        for params in per_request(request_sampling(spec, entries), len(entries)):
+            repair = {"temperature": 0.0, "max_tokens": params["max_tokens"]}
+            if "json_schema" in params:
+                repair["json_schema"] = params["json_schema"]
+            sampling.append(repair)
+        repaired = backend.generate(requests, sampling)
+    metrics.record_batch(repaired, time.perf_counter() - t0)
+    return [parse_timed(spec, output, metrics) for output in repaired]
+
+
+def retry_spec(spec, requests, entries):
+    """
+    重试用的 spec：max_tokens 调到 retry.max_tokens，但不超过请求在上下文中剩余的空间
+    (多候选请求的 max_tokens 按单个候选计，剩余空间按组内候选数均分)
+    """
+    max_tokens = spec.retry.max_tokens or spec.sampling["max_tokens"]
+    budget = spec.budget
+    if budget is not None:
+        room = min((budget.max_model_len - budget.request_tokens(messages)) // output_slots(entry)
+                   for messages, entry in zip(requests, entries))
+        max_tokens = max(spec.sampling["max_tokens"], min(max_tokens, room))
+        budget = TokenBudget(budget.max_model_len, max_tokens, budget.batch_tokens, budget.max_pixels,
+                             budget.token_patch)
+    return spec._replace(sampling=dict(spec.sampling, max_tokens=max_tokens), budget=budget)
+
+
+def generate_parsed(backend, spec, inputs, items, metrics):
+    """
+    生成并解析一批请求，返回对齐的 (items, 解析结果)；超出上下文被跳过的请求不在其中。
+    失败的请求 (请求出错、被 max_tokens 截断、无法解析、没有分数) 进入重试队列：
+    先把原始输出做纯文本 JSON 修复，仍失败的再重新生成 (最多 spec.retry.max_retries 轮，可用更大的 max_tokens)。
+    每轮失败都记入 metrics 的失败列表，最终成功的条目由 settle_failures 移除。
+    """
+    judged, outputs = generate_timed(backend, spec, inputs, items, metrics)
+    results = {id(entry): (output, parse_timed(spec, output, metrics)) for entry, output in zip(judged, outputs)}
+    requests = {id(entry): x for x, entry in zip(inputs, items)}
+    retry = spec.retry
+
+    attempt = 0
+    while True:
+        pending = [entry for entry in judged if not entry_complete(entry, results[id(entry)][1])]
+        repairable = [entry for entry in pending
+                      if results[id(entry)][0].text and results[id(entry)][0].finish_reason != "error"]
+        if retry and retry.repair_format and repairable:
+            repaired = repair_outputs(backend, spec, [results[id(entry)][0] for entry in repairable], repairable,
+                                      metrics)
+            for entry, parsed in zip(repairable, repaired):
+                output, old = results[id(entry)]
+                results[id(entry)] = (output, merge_parsed(entry, old, parsed))
+            still = [entry for entry in pending if not entry_complete(entry, results[id(entry)][1])]
+            metrics.record_recovered("repair", len(pending) - len(still))
+            pending = still
+
+        for entry in pending:
+            record_entry_failure(metrics, entry, *results[id(entry)])
+        if not pending or not retry or attempt >= retry.max_retries:
+            break
+
+        attempt += 1
+        pending_spec = retry_spec(spec, [requests[id(entry)] for entry in pending], pending)
+        print(f"   Retry {attempt}/{retry.max_retries}: re-generating {len(pending)} failed request(s) "
+              f"(max_tokens={pending_spec.sampling['max_tokens']}"
+              f"{' per candidate' if isinstance(spec, GroupedSpec) else ''})")
+        retried, outputs = generate_timed(backend, pending_spec, [requests[id(entry)] for entry in pending],
+                                          pending, metrics)
+        for entry, output in zip(retried, outputs):
+            results[id(entry)] = (output, merge_parsed(entry, results[id(entry)][1],
+                                                       parse_timed(spec, output, metrics)))
+        metrics.record_recovered("regenerate", sum(1 for entry in retried
+                                                   if entry_complete(entry, results[id(entry)][1])))
+
+    return judged, [results[id(entry)][1] for entry in judged]
+
+
+def screening_score(eval_screen):
+    """初筛结果的分数：优先用概率加权的期望分数，比 argmax 更能反映模型是否犹豫"""
+    if not eval_screen:
+        return None
+    if eval_screen.get("expected_score") is not None:
+        return eval_screen["expected_score"]
+    return eval_screen.get("score")
+
+
+def judge_cascade(backend, spec, inputs, items, metrics):
+    """
+    两级评测一个批次：全部条目先走 screen，初筛分在 band 内 (含边界) 或初筛失败的再走 full。
+    eval_direct 同时记录两级：
+        {"score": 最终分数, "tier": "screen" | "full", "screening": 初筛结果, "full": 完整评测结果或 None}
+    """
+    screen_items, screen_evals = judge_batch(spec.screen_backend or backend, spec.screen,
+                                             [x["screen"] for x in inputs], items, metrics)
+    full_inputs = {id(item): x["full"] for item, x in zip(items, inputs)}
+    screenings = {id(item): eval_screen for item, eval_screen in zip(screen_items, screen_evals)}
+    low, high = spec.band
+
+    evals = {}
+    escalate = []
+    for item, eval_screen in zip(screen_items, screen_evals):
+        score = screening_score(eval_screen)
+        if score is None or low <= score <= high:
+            escalate.append(item)
+        else:
+            evals[id(item)] = {"score": eval_screen["score"], "tier": "screen",
+                               "screening": eval_screen, "full": None}
+
+    full_items, full_evals = judge_batch(backend, spec.full, [full_inputs[id(item)] for item in escalate],
+                                         escalate, metrics)
+    for item, eval_full in zip(full_items, full_evals):
+        score = eval_full.get("score") if isinstance(eval_full, dict) else None
+        evals[id(item)] = {"score": score, "tier": "full",
+                           "screening": screenings[id(item)], "full": eval_full}
+
+    if screen_items:
+        print(f"   Cascade: {len(escalate)}/{len(screen_items)} items escalated to full evaluation "
+              f"(band {low}-{high})")
+    judged_items = [item for item in items if id(item) in evals]
+    return judged_items, [evals[id(item)] for item in judged_items]
+
+
+def group_candidates(spec, candidates, items):
+    """
+    按参考图路径分组 (保持首次出现的顺序)，每组最多 spec.group_size 个候选；
+    加入下一个候选会使估计的提示词 token 加上按候选数预留的输出超出上下文时提前结束当前组。
+    返回 ([[(candidate, item), ...], ...], 因上下文不足提前结束的组数)
+    """
+    by_ref = {}
+    for candidate, item in zip(candidates, items):
+        by_ref.setdefault(candidate.ref_path, []).append((candidate, item))
+
+    groups, truncated = [], 0
+    for members in by_ref.values():
+        current = []
+        for member in members:
+            if current and len(current) >= spec.group_size:
+                groups.append(current)
+                current = []
+            elif current and not spec.budget.fits(
+                    spec.budget.request_tokens(build_group_messages([c for c, _ in current + [member]])),
+                    spec.budget.max_output_tokens * (len(current) + 1)):
+                groups.append(current)
+                current = []
+                truncated += 1
+            current.append(member)
+        groups.append(current)
+    return groups, truncated
+
+
+def judge_grouped(backend, spec, inputs, items, metrics):
+    """多候选评测一批条目：同一参考图的候选合成一条请求，输出的分数列表映射回各自的条目"""
+    groups, truncated = group_candidates(spec, inputs, items)
+    group_inputs = [build_group_messages([c for c, _ in group]) for group in groups]
+    judged_groups, parsed = generate_parsed(backend, spec, group_inputs, groups, metrics)
+
+    judged_items, evals = [], []
+    for group, group_evals in zip(judged_groups, parsed):
+        group_evals = group_evals or [None] * len(group)
+        for position, ((_, item), eval_direct) in enumerate(zip(group, group_evals)):
+            if eval_direct is not None:
+                eval_direct["group"] = {"size": len(group), "position": position + 1}
+            judged_items.append(item)
+            evals.append(eval_direct)
+    if groups:
+        print(f"   Grouped: {len(items)} items in {len(groups)} requests "
+              f"(avg {len(items) / len(groups):.1f} candidates per reference)")
+    if truncated:
+        print(f"⚠️ {truncated} group(s) closed before --group_size={spec.group_size} candidates: prompt + "
+              f"{spec.budget.max_output_tokens} output tokens per candidate exceed "
+              f"max_model_len={spec.budget.max_model_len} (raise --max_model_len or lower --group_size / --max_pixels)")
+    return judged_items, evals
+
+
+def judge_cached(backend, spec, inputs, items, metrics):
+    """缓存命中的条目直接取结果，其余交给 spec.inner 评测；有分数的新结果写回缓存 (失败的下次重试)"""
+    results = {id(item): x.eval for x, item in zip(inputs, items) if isinstance(x, Cached)}
+    misses = [(x, item) for x, item in zip(inputs, items) if not isinstance(x, Cached)]
+    keys = {id(item): x.key for x, item in misses if isinstance(x, CacheMiss)}
+
+    judged_items, evals = judge_batch(backend, spec.inner,
+                                      [x.input if isinstance(x, CacheMiss) else x for x, _ in misses],
+                                      [item for _, item in misses], metrics)
+    entries = [(keys[id(item)], eval_direct) for item, eval_direct in zip(judged_items, evals)
+               if id(item) in keys and has_score(eval_direct)]
+    if entries:
+        with metrics.stage("cache_write"):
+            spec.cache.put_many(entries)
+
+    results.update(zip(map(id, judged_items), evals))
+    if items:
+        print(f"   Judgment cache: {len(items) - len(misses)}/{len(items)} items served from cache")
+    judged_items = [item for item in items if id(item) in results]
+    return judged_items, [results[id(item)] for item in judged_items]
+
+
+def judge_batch(backend, spec, inputs, items, metrics):
+    """评测一批已构造好的请求，返回对齐的 (items, eval 结果)；被跳过的条目不在其中"""
+    if isinstance(spec, CachedSpec):
+        return judge_cached(backend, spec, inputs, items, metrics)
+
+    verdicts = {id(item): x.eval for x, item in zip(inputs, items) if isinstance(x, Prefiltered)}
+    if verdicts:
+        # 预过滤命中的条目不进模型，其余照常评测后按原顺序合并
+        rest = [(x, item) for x, item in zip(inputs, items) if id(item) not in verdicts]
+        judged_items, evals = judge_batch(backend, spec, [x for x, _ in rest], [item for _, item in rest], metrics)
+        results = dict(zip(map(id, judged_items), evals))
+        results.update(verdicts)
+        print(f"   Pre-filter: {len(verdicts)}/{len(items)} items scored without the model")
+        judged_items = [item for item in items if id(item) in results]
+        return judged_items, [results[id(item)] for item in judged_items]
+
+    if isinstance(spec, CascadeSpec):
+        return judge_cascade(backend, spec, inputs, items, metrics)
+    if isinstance(spec, GroupedSpec):
+        return judge_grouped(backend, spec, inputs, items, metrics)
+    return generate_parsed(backend, spec, inputs, items, metrics)
+
+
+def judge_streaming(backend, spec, input_json, output_file, window_size, limit=None,
+                    num_workers=4, queue_depth=1, metrics=None, shard=None, retry_failed=False, stale_ids=None):
+    """
+    流式评测：每次只解码一个窗口的图片 (另有 queue_depth 个窗口在后台预取)，
+    推理后立即释放，结果逐条追加到 checkpoint。重启时读取 checkpoint 跳过已完成的 test_id；
+    retry_failed 时 checkpoint 中没有分数的条目重新评测。
+    stale_ids 不为 None 时为增量评测：沿用已有结果文件中有分数的条目，stale_ids 中的条目重新评测。
+    """
+    metrics = metrics or RunMetrics("judge", input_json)
+    ckpt_path = output_file + ".ckpt.jsonl"
+    done = load_checkpoint(ckpt_path)
+    if stale_ids is not None:
+        kept = previous_scores(output_file, stale_ids)
+        for test_id in stale_ids:
+            done.pop(test_id, None)
+        done.update((test_id, eval_direct) for test_id, eval_direct in kept.items() if test_id not in done)
+        retry_failed = True
+    if retry_failed:
+        failed = [test_id for test_id, eval_direct in done.items() if not has_score(eval_direct)]
+        for test_id in failed:
+            del done[test_id]
+        print(f"🔁 Re-queueing {len(failed)} failed item(s) from the checkpoint")
+    if done:
+        print(f"♻️ Resuming from checkpoint: {len(done)} items already judged ({ckpt_path})")
+
+    pending = (item for item in select_items(input_json, limit, shard)
+               if item.get('test_id') not in done)
+
+    windows = iter(lambda: list(islice(pending, window_size)), [])
+
+    with open(ckpt_path, 'a', encoding='utf-8') as ckpt:
+        for window_idx, (window, results, wait_time) in enumerate(
+                prefetch(windows, spec.build_input, num_workers, queue_depth), 1):
+            metrics.add_stage_time("image_decode_wait", wait_time)
+            inputs_direct, judged_items = collect_prefetched(results, metrics)
+
+            judged_items, evals_direct = judge_batch(backend, spec, inputs_direct, judged_items, metrics)
+            settle_failures(metrics, judged_items, evals_direct)
+            # 提交后立即释放本窗口的图片
+            del inputs_direct
+
+            for item, eval_direct in zip(judged_items, evals_direct):
+                done[item['test_id']] = eval_direct
+                ckpt.write(json.dumps({"test_id": item['test_id'], "eval_direct": eval_direct},
+                                      ensure_ascii=False) + "\n")
+            with metrics.stage("checkpoint_write"):
+                ckpt.flush()
+                os.fsync(ckpt.fileno())
+
+            print(f"   Window {window_idx}: judged {len(evals_direct)}/{len(window)} items "
+                  f"(total done: {len(done)})")
+
+    with metrics.stage("result_write"):
+        return write_results(input_json, done, output_file, limit, shard)
+
+
+def judge_in_memory(backend, spec, input_json, output_file, limit=None, num_workers=4, metrics=None,
+                    shard=None, retry_failed=False, stale_ids=None):
+    """
+    一次性评测：整个测试集的图片解码后一次提交推理后端，最后统一写出。
+    retry_failed 时沿用已有结果文件中有分数的条目，只评测其余条目；
+    stale_ids 不为 None 时 (增量评测) 同样沿用，但其中的条目重新评测。
+    """
+    metrics = metrics or RunMetrics("judge", input_json)
+    with metrics.stage("load_testset"):
+        test_data = list(select_items(input_json, limit, shard))
+        pending = test_data
+        if (retry_failed or stale_ids is not None) and os.path.exists(output_file):
+            previous = previous_scores(output_file, stale_ids or ())
+            for item in test_data:
+                if item.get('test_id') in previous:
+                    item['eval_direct'] = previous[item['test_id']]
+            pending = [item for item in test_data if 'eval_direct' not in item]
+            print(f"🔁 Re-judging {len(pending)} failed or missing item(s); "
+                  f"{len(test_data) - len(pending)} kept from {output_file}")
+
+    # 线程池并行解码全部图片
+    with metrics.stage("image_decode"):
+        [(_, results, _)] = list(prefetch([pending], spec.build_input, num_workers, 0))
+    inputs_direct, judged_items = collect_prefetched(results, metrics)
+
+    # 批量推理
+    if inputs_direct:
+        hits = sum(1 for x in inputs_direct if isinstance(x, Cached))
+        print(f"   {len(inputs_direct) - hits} item(s) to judge" +
+              (f", {hits} served from the judgment cache" if isinstance(spec, CachedSpec) else ""))
+    judged_items, evals_direct = judge_batch(backend, spec, inputs_direct, judged_items, metrics)
+    settle_failures(metrics, judged_items, evals_direct)
+
+    # 结果回填
+    for item, eval_direct in zip(judged_items, evals_direct):
+        item['eval_direct'] = eval_direct
+
+    # 保存结果 (.jsonl 测试集的结果同样逐行写出)
+    with metrics.stage("result_write"):
+        return write_items(output_file, test_data)
+
+
+def previous_scores(output_file, exclude=()):
+    """已有结果文件中有分数的条目 {test_id: eval_direct}，跳过 exclude 中的 test_id"""
+    if not os.path.exists(output_file):
+        return {}
+    return {item.get('test_id'): item['eval_direct'] for item in iter_test_items(output_file)
+            if item.get('test_id') not in exclude and has_score(item.get('eval_direct'))}
+
+
+def incremental_stale_ids(input_json, output_file, judge_key):
+    """
+    --incremental：build.py --incremental 的 delta 中新增 / 变化的条目需要重新评测，其余沿用上次的结果
+    (测试集中已删除的条目写结果时自然去掉)。没有 delta、没有上次结果，或上次评测的配置不同时返回 None (全量评测)
+    """
+    delta_path, pending_path = delta_paths(input_json)
+    if not (os.path.exists(delta_path) and os.path.exists(pending_path)):
+        print(f"   Incremental: no pending delta for {input_json}, judging every item")
+        return None
+    if not os.path.exists(output_file):
+        print(f"   Incremental: no previous result {output_file}, judging every item")
+        return None
+    with open(pending_path, 'r', encoding='utf-8') as f:
+        manifest_path = json.load(f)["manifest_path"]
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            if json.load(f).get("judge_key") != judge_key:
+                print(f"   Incremental: judge settings changed since {manifest_path}, judging every item")
+                return None
+    stale_ids = {item.get('test_id') for item in iter_test_items(delta_path)}
+    print(f"🔁 Incremental: re-judging {len(stale_ids)} added/changed item(s) from {delta_path}")
+    return stale_ids
+
+
+def commit_delta(input_json, output_file, judge_key):
+    """
+    结果写出后提交 build.py 的待提交 manifest (作为下一次增量构建的对比基准)，delta 随之用完删除。
+    流式 checkpoint 也一并删除：下一次增量评测从结果文件沿用，不能再从旧 checkpoint 续跑
+    """
+    ckpt_path = output_file + ".ckpt.jsonl"
+    if os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+    delta_path, pending_path = delta_paths(input_json)
+    if not os.path.exists(pending_path):
+        return
+    with open(pending_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest["judge_key"] = judge_key
+    save_manifest(manifest["manifest_path"], manifest)
+    os.remove(pending_path)
+    if os.path.exists(delta_path):
+        os.remove(delta_path)
+    print(f"   Manifest committed: {manifest['manifest_path']}")
+
+
+def judged_output_path(input_json, shard=None):
+    if shard is not None:
+        shard_index, num_shards = shard
+        return input_json.replace(".json", f"_judged_direct.shard{shard_index}of{num_shards}.json")
+    return input_json.replace(".json", "_judged_direct.json")
+
+
+def merge_shards(input_json, num_shards, limit=None):
+    """把各分片的评测结果按测试集原顺序合并成一个 _judged_direct 文件"""
+    done = {}
+    for shard_index in range(num_shards):
+        shard_file = judged_output_path(input_json, (shard_index, num_shards))
+        if not os.path.exists(shard_file):
+            raise FileNotFoundError(f"missing shard output {shard_file}")
+        for item in iter_test_items(shard_file):
+            if 'eval_direct' in item:
+                done[item.get('test_id')] = item['eval_direct']
+
+    output_file = judged_output_path(input_json)
+    # --debug 时每个分片只评测了前 limit 条，轮转分片下正好对应原文件的前 limit * num_shards 条
+    total = write_results(input_json, done, output_file, limit and limit * num_shards)
+    print(f"🧩 Merged {num_shards} shards ({len(done)}/{total} items judged) into {output_file}")
+    return output_file
+
+
+def save_columnar(output_file, fmt):
+    """在 JSON 结果旁写一份列式结果 (test_id / mode / prompt_key / score / 解析状态)，供 analyze_results.py 使用"""
+    path = columnar_path(output_file, fmt)
+    count = write_columnar(path, iter_test_items(output_file))
+    print(f"   Columnar results: {path} ({count} rows)")
+
+
+def run_report_prefix(output_file):
+    """运行报告与 Prometheus textfile 写在结果文件旁边：xxx_judged_direct.report.json / .prom"""
+    return os.path.splitext(output_file)[0] + ".report"
+
+
+def shard_of(args):
+    return (args.shard_index, args.num_shards) if args.num_shards > 1 else None
+
+
+def judge_dataset(backend, spec, input_json, args, judge_key=None):
+    """
+    用已加载的推理后端评测单个测试集，结果写到该测试集自己的 _judged_direct 文件。
+    judge_key (--incremental) 为评测配置的 hash，记录在提交的 manifest 中
+    """
+    shard = shard_of(args)
+    output_file = judged_output_path(input_json, shard)
+    limit = 5 if args.debug else None
+    stale_ids = incremental_stale_ids(input_json, output_file, judge_key) if judge_key else None
+
+    # === Phase: Visual Evaluation (Direct Scoring Only) ===
+    print(f"👁️ Running Direct Scoring Evaluation: {input_json}"
+          + (f" (shard {args.shard_index + 1}/{args.num_shards})" if shard else ""))
+    metrics = RunMetrics("judge", input_json)
+
+    if args.stream:
+        print(f"   Streaming mode: window_size={args.window_size}")
+        total = judge_streaming(backend, spec, input_json, output_file,
+                                args.window_size, limit, args.prefetch_workers, args.prefetch_depth,
+                                metrics, shard, args.retry_failed, stale_ids)
+    else:
+        total = judge_in_memory(backend, spec, input_json, output_file, limit,
+                                args.prefetch_workers, metrics, shard, args.retry_failed, stale_ids)
+
+    print(f"✅ Evaluation Complete ({total} items). Saved to: {output_file}")
+    if judge_key:
+        commit_delta(input_json, output_file, judge_key)
+    if args.columnar:
+        save_columnar(output_file, args.columnar)
+    metrics.print_summary()
+    for test_id, failure in islice(metrics.failures.items(), 10):
+        print(f"   ❌ {test_id}: {failure['reason']}" + (f" ({failure['detail'][:80]})" if failure['detail'] else ""))
+    report_json, _ = metrics.write(run_report_prefix(output_file))
+    print(f"   Run report: {report_json}")
+
+
+# dry run 用图片文件头尺寸代替解码后的图片 (token 估算只需要 .size)
+ImageHeader = namedtuple("ImageHeader", ["size"])
+
+
+def dry_run_dataset(input_json, args, budget):
+    """不加载模型检查一个测试集：图片路径、文件头可读性、token 估算，并渲染第一条提示词。返回是否没有问题"""
+    limit = 5 if args.debug else None
+    items = list(select_items(input_json, limit, shard_of(args)))
+
+    def inspect(item):
+        gen_path = item.get('last_frame_path')
+        ref_path = item.get('first_frame_path')
+        if not gen_path or not os.path.exists(gen_path):
+            return None
+        messages = build_judge_input(item, load_image=lambda path: ImageHeader(image_size(path)),
+                                     legacy_layout=args.legacy_prompt_layout, score_only=args.score_only)
+        missing_ref = not ref_path or not os.path.exists(ref_path)
+        return messages, budget.request_tokens(messages), missing_ref
+
+    [(_, results, _)] = list(prefetch([items], inspect, args.prefetch_workers, 0))
+    missing_gen = sum(1 for _, value, error in results if error is None and value is None)
+    unreadable = [(item, error) for item, _, error in results if error is not None]
+    checked = [value for _, value, error in results if error is None and value is not None]
+    tokens = [t for _, t, _ in checked]
+    too_long = sum(1 for t in tokens if not budget.fits(t))
+
+    print(f"🔍 {input_json}: {len(items)} items, {len(checked)} judgeable, {missing_gen} missing generated image, "
+          f"{sum(1 for _, _, m in checked if m)} without reference, {len(unreadable)} unreadable")
+    if tokens:
+        print(f"   Estimated prompt tokens: min {min(tokens)}, mean {sum(tokens) / len(tokens):.0f}, max {max(tokens)}; "
+              f"{too_long} item(s) exceed max_model_len={budget.max_model_len}")
+        print("   Sample prompt:")
+        print(render_judge_prompt(checked[0][0]))
+    for item, error in unreadable[:5]:
+        print(f"   ❌ {item.get('test_id')}: {error}")
+    return bool(checked) and not unreadable and not too_long
+
+
+def dry_run(args, judge_cfg):
+    """--dry_run：检查配置与全部输入，不加载模型、不需要 GPU"""
+    max_tokens = 2 if args.score_only else 1024
+    budget = TokenBudget(args.max_model_len, max_tokens, args.batch_token_budget, args.max_pixels, args.token_patch)
+    model_path = judge_cfg.get('model_path')
+    print(f"🧪 Dry run: model={model_path}, backend={args.backend}, max_model_len={args.max_model_len}, "
+          f"max_pixels={args.max_pixels}")
+    ok = True
+    if args.backend == "vllm" and (not model_path or (os.path.isabs(model_path) and not os.path.exists(model_path))):
+        print(f"❌ judge.model_path not found: {model_path}")
+        ok = False
+
+    inputs = list(args.input_json)
+    if args.queue_dir:
+        inputs += pending_queue_files(args.queue_dir, set(inputs), shard_of(args))
+    for input_json in inputs:
+        try:
+            ok = dry_run_dataset(input_json, args, budget) and ok
+        except Exception as e:
+            print(f"❌ Failed to read {input_json}: {e}")
+            ok = False
+    return ok
+
+
+# 写在测试集旁边、不是测试集的文件：build.py --incremental 的 delta 与待提交 manifest (delta_paths 的命名)、
+# 评测 manifest、提示词生成与评测的运行报告
+QUEUE_SIDECAR_SUFFIXES = tuple(sorted({path[1:] for ext in (".json", ".jsonl") for path in delta_paths("x" + ext)})) + \
+    (".manifest.json", ".report.json")
+
+
+def is_testset_name(name):
+    """队列目录中的文件名是否为测试集：排除评测结果 / checkpoint (_judged_direct)、提示词生成 journal 及其他旁路文件"""
+    if not name.endswith((".json", ".jsonl")) or "_judged_direct" in name or ".journal" in name:
+        return False
+    return not name.endswith(QUEUE_SIDECAR_SUFFIXES)
+
+
+def pending_queue_files(queue_dir, seen, shard=None):
+    """扫描队列目录，返回尚未评测 (或输入比结果更新) 的测试集"""
+    pending = []
+    for name in sorted(os.listdir(queue_dir)):
+        if not is_testset_name(name):
+            continue
+        path = os.path.join(queue_dir, name)
+        if path in seen:
+            continue
+        output_file = judged_output_path(path, shard)
+        if os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(path):
+            continue
+        pending.append(path)
+    return pending
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", default="edit_pipeline/config.yaml")
-    parser.add_argument("--input_json", required=True, help="Testset JSON generated by build_testset.py")
+    parser.add_argument("--input_json", nargs='+', default=[],
+                        help="Testset JSON(s) generated by build.py; all are judged with one model load")
+    parser.add_argument("--queue_dir", default=None,
+                        help="Work queue directory: judge every testset JSON in it that has no up-to-date result")
     parser.add_argument("--debug", action="store_true", help="Run on first 5 items only")
+    parser.add_argument("--stream", action="store_true",
+                        help="Streaming mode: judge in bounded windows with checkpoint/resume")
+    parser.add_argument("--window_size", type=int, default=256,
+                        help="Items per window in streaming mode")
+    parser.add_argument("--prefetch_workers", type=int, default=4,
+                        help="Threads decoding images in the background")
+    parser.add_argument("--prefetch_depth", type=int, default=1,
+                        help="Windows decoded ahead of the one being judged")
+    parser.add_argument("--image_cache_dir", default=None,
+                        help="Cache resized images on disk, keyed by file content hash")
+    parser.add_argument("--max_pixels", type=int, default=0,
+                        help="Pixel budget per image: larger frames are downscaled before judging "
+                             "(default 0 = keep original size, so scores match unscaled baselines)")
+    parser.add_argument("--token_patch", type=int, default=TOKEN_PATCH,
+                        help="Pixels per visual token side used to estimate prompt length "
+                             "(32 for Qwen3-VL, 28 for Qwen2-VL / Qwen2.5-VL)")
+    parser.add_argument("--max_model_len", type=int, default=7000,
+                        help="Engine context length; requests estimated to exceed it are skipped instead of failing the batch")
+    parser.add_argument("--batch_token_budget", type=int, default=None,
+                        help="Pack each window into generate() calls of at most this many estimated prompt tokens, "
+                             "sorted by length (default: one call per window)")
+    parser.add_argument("--image_cache_max_gb", type=float, default=20.0,
+                        help="Size cap of the image cache (LRU eviction)")
+    parser.add_argument("--backend", choices=["vllm", "openai"], default="vllm",
+                        help="vllm: in-process engine; openai: OpenAI-compatible HTTP server (e.g. vllm serve)")
+    parser.add_argument("--api_base", default="http://localhost:8000/v1")
+    parser.add_argument("--api_model", default=None, help="Served model name (defaults to judge.model_path)")
+    parser.add_argument("--api_key", default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--max_in_flight", type=int, default=32, help="Max concurrent HTTP requests")
+    parser.add_argument("--max_retries", type=int, default=5, help="HTTP retries with exponential backoff")
+    parser.add_argument("--score_only", action="store_true",
+                        help="Skip reasoning: read the 0-10 score from next-token logprobs (argmax + expected score)")
+    parser.add_argument("--legacy_prompt_layout", action="store_true",
+                        help="Use the original prompt layout (images first) instead of static-instructions-first")
+    parser.add_argument("--tensor_parallel_size", type=int, default=None,
+                        help="GPUs per engine (default: judge.tensor_parallel_size in config, else all visible GPUs)")
+    parser.add_argument("--num_shards", type=int, default=1,
+                        help="Split every testset round-robin into this many shards (one per replica)")
+    parser.add_argument("--shard_index", type=int, default=0, help="Shard judged by this process")
+    parser.add_argument("--merge_shards", action="store_true",
+                        help="Only merge the --num_shards shard outputs of each --input_json, then exit")
+    parser.add_argument("--cascade", action="store_true",
+                        help="Two-tier judging: a cheap score-only screening pass on every item, "
+                             "full reasoning only for items whose screening score is inside --cascade_band")
+    parser.add_argument("--cascade_band", type=float, nargs=2, default=[3.0, 7.0], metavar=("LOW", "HIGH"),
+                        help="Screening scores in [LOW, HIGH] (inclusive) are escalated to the full evaluation")
+    parser.add_argument("--screen_max_pixels", type=int, default=256 * 28 * 28,
+                        help="Pixel budget per image for the screening pass")
+    parser.add_argument("--screen_api_model", default=None,
+                        help="Served model for the screening pass with --backend openai "
+                             "(defaults to judge.screen_model_path, else the main model)")
+    parser.add_argument("--columnar", choices=["npz", "parquet"], default=None,
+                        help="Also write results as a columnar file next to the JSON (parquet needs pyarrow)")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Score blank, corrupt or unedited generated images without calling the model")
+    parser.add_argument("--prefilter_score", type=int, default=0,
+                        help="Score given to items rejected by the pixel pre-filter")
+    parser.add_argument("--group_size", type=int, default=1,
+                        help="Judge up to this many candidates sharing a first_frame_path in one request "
+                             "(reference encoded once; 1 = one request per item)")
+    parser.add_argument("--guided_json", action="store_true",
+                        help="Constrain outputs to the judge JSON schema at decode time (reasoning length-capped, "
+                             "integer score 0-10); generation stops when the object closes")
+    parser.add_argument("--failure_retries", type=int, default=1,
+                        help="Re-generate failed, unparsed or truncated requests up to this many times "
+                             "(after a text-only JSON repair pass)")
+    parser.add_argument("--retry_max_tokens", type=int, default=None,
+                        help="max_tokens for re-generated requests, per candidate with --group_size (default: unchanged)")
+    parser.add_argument("--no_repair", action="store_true",
+                        help="Skip the text-only repair-to-JSON pass over unparseable outputs")
+    parser.add_argument("--retry_failed", action="store_true",
+                        help="Keep scored items from the existing result / checkpoint and re-judge only the rest")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Re-judge only the items in the build.py --incremental delta, keep the rest from the "
+                             "existing result (removed items are dropped) and commit the build manifest")
+    parser.add_argument("--judgment_cache", default=None,
+                        help="SQLite file caching judgments by image content, prompt, model, sampling and template; "
+                             "only cache misses are sent to the model")
+    parser.add_argument("--judgment_cache_max_gb", type=float, default=1.0,
+                        help="Size cap of the judgment cache (LRU eviction)")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Check config, inputs and image paths, render a prompt and estimate tokens "
+                             "without loading a model")
     args = parser.parse_args()
+    if not args.input_json and not args.queue_dir:
+        parser.error("one of --input_json or --queue_dir is required")
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard_index must be in [0, --num_shards)")
+    if args.cascade and args.score_only:
+        parser.error("--cascade already uses a score-only screening pass; drop --score_only")
+    if args.group_size < 1:
+        parser.error("--group_size must be >= 1")
+    if args.group_size > 1 and (args.cascade or args.score_only):
+        parser.error("--group_size cannot be combined with --cascade or --score_only")
+    if args.guided_json and args.score_only:
+        parser.error("--score_only reads the score from logprobs; --guided_json does not apply")
+    if args.incremental and (args.num_shards > 1 or args.debug):
+        parser.error("--incremental merges into the full result; it cannot be combined with --num_shards or --debug")
+
+    if args.merge_shards:
+        for input_json in args.input_json:
+            output_file = merge_shards(input_json, args.num_shards, 5 if args.debug else None)
+            if args.columnar:
+                save_columnar(output_file, args.columnar)
+        return
 
     cfg = load_config(args.config)
     judge_cfg = cfg.get('judge', {})
 
-    with open(args.input_json, 'r') as f:
-        test_data = json.load(f)
-
-    if args.debug:
-        test_data = test_data[:5]
-
-    # --- 多卡并行逻辑 ---
-    available_gpus = torch.cuda.device_count()
-    # 优先读取 config 中的配置，如果没有则自动使用所有可用显卡
-    # tp_size = judge_cfg.get('tensor_parallel_size', available_gpus)
-    # if tp_size > available_gpus:
-    #     print(
-    #         f"⚠️ Warning: tensor_parallel_size ({tp_size}) > available GPUs ({available_gpus}). Using {available_gpus}.")
-    tp_size = available_gpus
-
-    print(f"🚀 Initializing VLLM (Multi-Image Mode) with TP_SIZE={tp_size}...")
-
-    llm = LLM(
-        model=judge_cfg.get('model_path'),
-        limit_mm_per_prompt={"image": 2},
-        tensor_parallel_size=tp_size,
-        gpu_memory_utilization=judge_cfg.get('gpu_memory_utilization', 0.9),
-        max_model_len=7000,
-        trust_remote_code=True
-    )
-    sampling_params = SamplingParams(temperature=0.1, max_tokens=1024)
+    if args.dry_run:
+        if not dry_run(args, judge_cfg):
+            sys.exit(1)
+        print("✅ Dry run passed")
+        return
 
-    # === Phase: Visual Evaluation (Direct Scoring Only) ===
-    print("👁️ Running Direct Scoring Evaluation...")
+    if args.backend == "openai":
+        api_model = args.api_model or judge_cfg.get('model_path')
+        print(f"🌐 Using OpenAI-compatible backend: {args.api_base} (model={api_model}, "
+              f"max_in_flight={args.max_in_flight})")
+        backend = OpenAIChatBackend(args.api_base, api_model, api_key=args.api_key,
+                                    max_in_flight=args.max_in_flight, max_retries=args.max_retries)
+    else:
+        # 只有进程内引擎才需要 torch / vllm，HTTP 后端与离线 benchmark 无需安装
+        import torch
+        from vllm import LLM
 
-    inputs_direct = []
-    valid_indices = []
+        # --- 多卡并行逻辑 ---
+        available_gpus = torch.cuda.device_count()
+        # 优先使用命令行 / config 中的配置，如果没有则自动使用所有可用显卡
+        # 模型放得下时，多个小 TP 副本 (launch_shards.py) 的吞吐高于一个占满整机的 TP 组
+        tp_size = args.tensor_parallel_size or judge_cfg.get('tensor_parallel_size', available_gpus)
+        if tp_size > available_gpus:
+            print(
+                f"⚠️ Warning: tensor_parallel_size ({tp_size}) > available GPUs ({available_gpus}). Using {available_gpus}.")
+            tp_size = available_gpus
 
-    for idx, item in enumerate(test_data):
-        gen_path = item.get('last_frame_path')
-        ref_path = item.get('first_frame_path')
+        print(f"🚀 Initializing VLLM (Multi-Image Mode) with TP_SIZE={tp_size}...")
 
-        if not gen_path or not os.path.exists(gen_path):
-            print(f"⚠️ Generated image missing: {gen_path}")
-            continue
+        llm = LLM(
+            model=judge_cfg.get('model_path'),
+            # 多候选模式每条请求 1 张参考图 + group_size 张候选图
+            limit_mm_per_prompt={"image": args.group_size + 1},
+            tensor_parallel_size=tp_size,
+            gpu_memory_utilization=judge_cfg.get('gpu_memory_utilization', 0.9),
+            max_model_len=args.max_model_len,
+            trust_remote_code=True
+        )
+        backend = VLLMBackend(llm, PromptBuilder(render_judge_prompt))
 
-        try:
-            img_gen = Image.open(gen_path).convert("RGB")
-            images = [img_gen]
+    # 像素预算对所有图片生效：超大帧既浪费 prefill 也可能撑爆上下文
+    load_image = lambda path: resize_to_budget(load_rgb(path), args.max_pixels)
+    image_cache = None
+    if args.image_cache_dir:
+        image_cache = ImageCache(args.image_cache_dir, args.max_pixels,
+                                 int(args.image_cache_max_gb * 1024 ** 3))
+        load_image = image_cache.load
+        print(f"🗂️ Image cache: {args.image_cache_dir} (max_pixels={args.max_pixels})")
+    build_input = partial(build_judge_input, load_image=load_image,
+                          legacy_layout=args.legacy_prompt_layout, score_only=args.score_only)
+    if args.score_only:
+        # 贪心生成 2 个 token (覆盖 "10")，每个位置取 top-20 logprobs
+        sampling = {"temperature": 0.0, "max_tokens": 2, "logprobs": 20}
+        parse_output = score_from_logprobs
+        print("🎯 Score-only mode: reading the score from next-token logprobs")
+    else:
+        sampling = {"temperature": 0.1, "max_tokens": 1024}
+        parse_output = parse_direct_output
+        if args.guided_json:
+            sampling["json_schema"] = judge_schema()
+    budget = TokenBudget(args.max_model_len, sampling["max_tokens"], args.batch_token_budget, args.max_pixels,
+                         args.token_patch)
+    repair_format = None if args.no_repair or args.score_only else DIRECT_OUTPUT_FORMAT
+    retry = RetryPolicy(args.failure_retries, args.retry_max_tokens, repair_format)
+    spec = JudgeSpec(build_input, sampling, parse_output, budget, retry)
 
-            has_ref = False
-            if ref_path and os.path.exists(ref_path):
-                img_ref = Image.open(ref_path).convert("RGB")
-                images = [img_ref, img_gen]
-                has_ref = True
+    if args.group_size > 1:
+        # 同一参考图的兄弟条目在测试集中相邻，预取线程并行处理时只需缓存最近的几张参考图 (按路径)；
+        # 窗口内的候选本身持有参考图，缓存不必覆盖整个窗口
+        load_ref = lru_cache(maxsize=2 * args.prefetch_workers)(load_image)
+        # max_tokens 按单个候选计，每条请求按组内实际候选数预留
+        sampling = {"temperature": 0.1, "max_tokens": GROUP_OUTPUT_TOKENS_PER_CANDIDATE}
+        if args.guided_json:
+            # 每条请求按组内候选数重新构造 schema (request_sampling)
+            sampling["json_schema"] = group_schema(args.group_size)
+        spec = GroupedSpec(partial(build_candidate_input, load_image=load_image, load_ref=load_ref), sampling,
+                           partial(parse_group_output, group_size=args.group_size),
+                           TokenBudget(args.max_model_len, sampling["max_tokens"], args.batch_token_budget,
+                                       args.max_pixels, args.token_patch),
+                           args.group_size,
+                           retry._replace(repair_format=None if args.no_repair else GROUP_OUTPUT_FORMAT))
+        print(f"👥 Grouped mode: up to {args.group_size} candidates per reference image in one request")
 
-            valid_indices.append(idx)
+    screen_backend = None
+    if args.cascade:
+        screen_sampling = {"temperature": 0.0, "max_tokens": 2, "logprobs": 20}
+        screen = JudgeSpec(None, screen_sampling, score_from_logprobs,
+                           TokenBudget(args.max_model_len, screen_sampling["max_tokens"],
+                                       args.batch_token_budget, args.screen_max_pixels, args.token_patch))
+        screen_model = args.screen_api_model or judge_cfg.get('screen_model_path')
+        if screen_model and args.backend == "openai":
+            screen_backend = OpenAIChatBackend(args.api_base, screen_model, api_key=args.api_key,
+                                               max_in_flight=args.max_in_flight, max_retries=args.max_retries)
+        elif screen_model:
+            # 进程内再加载一个引擎会与主模型争显存；需要小模型初筛时用 vllm serve + --backend openai
+            print(f"⚠️ screen model {screen_model} needs --backend openai; screening with the main model")
+        build_input = partial(build_cascade_input, load_image=load_image,
+                              screen_max_pixels=args.screen_max_pixels, legacy_layout=args.legacy_prompt_layout)
+        spec = CascadeSpec(build_input, screen, spec, tuple(args.cascade_band), screen_backend)
+        print(f"🪜 Cascade mode: screening at max_pixels={args.screen_max_pixels}"
+              f"{f' with {screen_model}' if screen_backend else ''}, full evaluation for scores in "
+              f"[{args.cascade_band[0]}, {args.cascade_band[1]}]")
 
-            if has_ref:
-                img_tokens = f"Image 1 (Ref): {IMAGE_PLACEHOLDER}\nImage 2 (Gen): {IMAGE_PLACEHOLDER}"
-            else:
-                img_tokens = f"Image 2 (Gen): {IMAGE_PLACEHOLDER}"
+    if args.prefilter:
+        # 预过滤包在最外层，两级评测时也在初筛之前生效
+        spec = spec._replace(build_input=partial(build_prefiltered_input, build_input=spec.build_input,
+                                                 prefilter=PixelPrefilter(score=args.prefilter_score),
+                                                 load_image=load_image))
+        print(f"🧹 Pixel pre-filter enabled (score={args.prefilter_score} for blank / corrupt / unedited outputs)")
 
-            text_direct = DIRECT_SCORE_TEMPLATE.format(prompt=item['prompt'])
-            prompt_direct = f"<|user|>\n{img_tokens}\n{text_direct}\n<|assistant|>\n"
+    fingerprint = judge_fingerprint(args, judge_cfg, spec)
+    judgment_cache = None
+    if args.judgment_cache:
+        # 缓存包在最外层：命中的条目连图片都不解码
+        judgment_cache = ResultCache(args.judgment_cache, int(args.judgment_cache_max_gb * 1024 ** 3))
+        spec = CachedSpec(partial(build_cached_input, build_input=spec.build_input, cache=judgment_cache,
+                                  fingerprint=fingerprint),
+                          spec, judgment_cache)
+        print(f"🗃️ Judgment cache: {args.judgment_cache} (template version {TEMPLATE_VERSION})")
 
-            inputs_direct.append({
-                "prompt": prompt_direct,
-                "multi_modal_data": {"image": images}
-            })
+    # 增量评测只沿用同一评测配置下的结果
+    judge_key = cache_key(fingerprint) if args.incremental else None
+    failed = []
 
+    def run(input_json):
+        try:
+            judge_dataset(backend, spec, input_json, args, judge_key)
         except Exception as e:
-            print(f"❌ Error loading images for {item.get('test_id')}: {e}")
+            print(f"❌ Failed to judge {input_json}: {e}")
+            failed.append(input_json)
 
-    # 批量推理
-    outputs_direct = []
-    if inputs_direct:
-        print(f"   Processing {len(inputs_direct)} items...")
-        outputs_direct = llm.generate(inputs_direct, sampling_params)
+    for input_json in args.input_json:
+        run(input_json)
 
-    # 结果回填
-    for i, list_idx in enumerate(valid_indices):
-        item = test_data[list_idx]
-        if i < len(outputs_direct):
-            item['eval_direct'] = extract_json(outputs_direct[i].outputs[0].text)
+    # 队列模式：处理完一轮后重新扫描，期间新放入的测试集也会被处理
+    if args.queue_dir:
+        seen = set()
+        while True:
+            pending = pending_queue_files(args.queue_dir, seen, shard_of(args))
+            if not pending:
+                break
+            for input_json in pending:
+                seen.add(input_json)
+                run(input_json)
+
+    if image_cache:
+        print(f"   Image cache: {image_cache.hits} hits, {image_cache.misses} misses")
+    if judgment_cache:
+        print(f"   Judgment cache: {judgment_cache.hits} hits, {judgment_cache.misses} misses")
+        judgment_cache.close()
 
-    # 保存结果
-    output_file = args.input_json.replace(".json", "_judged_direct.json")
-    with open(output_file, 'w') as f:
-        json.dump(test_data, f, indent=4, ensure_ascii=False)
+    if args.backend == "openai":
+        backend.close()
+    if screen_backend is not None:
+        screen_backend.close()
 
-    print(f"✅ Evaluation Complete. Saved to: {output_file}")
+    if failed:
+        print(f"❌ {len(failed)} dataset(s) failed: {', '.join(failed)}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()